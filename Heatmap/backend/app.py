@@ -7,25 +7,58 @@
 
 import json
 from pymongo import MongoClient
-from flask import Flask, request, Response, jsonify, send_from_directory
+from flask import Flask, Blueprint, current_app, g, request, Response, jsonify, send_from_directory
 import os
 from flask_cors import CORS
 from bson.json_util import loads, dumps, ObjectId
 import pandas as pd
 from io import BytesIO
+import time
+import threading
+from prometheus_client import Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+import tiles
+import clustering
 
 
 
 # MongoDB Connection setup
-# If running not in a container environment, you can use the following line to connect to a local MongoDB install
-#client = MongoClient() #this is for testing on a local machine, when not inside a container
+# If running not in a container environment, set MICROMIX_MONGO_HOST=localhost to connect to a local MongoDB install
 #When using containers, you need to modify 'sudo vim /etc/mongodb.conf' and add in an additional IP under bind_ip
 # '172.17.0.1' is often the Docker default bridge network gateway, allowing containers to connect to the host.
-client = MongoClient('172.17.0.1', 27017)
-# Select the 'micromix' database within MongoDB for storing and retrieving application data.
-db = client.micromix
-# Define collections for storing visualizations and plugins information.
-visualizations = db.visualizations
+#The client is created lazily by each (worker) process, see get_db. These settings are the same as in mongo.py of the
+#Micromix backend.
+MONGO_HOST = os.environ.get('MICROMIX_MONGO_HOST', '172.17.0.1')
+MONGO_PORT = int(os.environ.get('MICROMIX_MONGO_PORT', 27017))
+MONGO_DATABASE = os.environ.get('MICROMIX_MONGO_DATABASE', 'micromix')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MICROMIX_MONGO_MAX_POOL_SIZE', 50))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_SOCKET_TIMEOUT_MS', 0))
+
+client = None
+client_pid = None
+client_lock = threading.Lock()
+
+
+#---
+#Return the micromix database of this process
+#The client is created on first use, and again after a fork (the pid has changed), so worker processes never share
+#the threads and sockets of a client. connect=False delays the first connection until the first query.
+#The lock keeps the threads of a process from creating a client each.
+#---
+def get_db():
+  global client, client_pid
+  if client == None or client_pid != os.getpid():
+    with client_lock:
+      if client == None or client_pid != os.getpid():
+        client = MongoClient(MONGO_HOST, MONGO_PORT,
+                             connect=False,
+                             maxPoolSize=MONGO_MAX_POOL_SIZE,
+                             connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                             serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                             socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS or None)
+        client_pid = os.getpid()
+  return client[MONGO_DATABASE]
 
 
 # #MongoDB needs to be installed
@@ -36,24 +69,98 @@ visualizations = db.visualizations
 #db = client.micromix
 #visualizations = db.visualizations
 
-DEBUG = True
-app = Flask(__name__)
-CORS(app)
+#Session dataframes are kept in the content-addressed blob store of the Micromix backend.
+#The session document only holds a reference ({'blob_id': ..., 'size': ...}), older sessions still store the parquet inline.
+#These settings must match the ones used by the Micromix backend.
+BLOB_STORE = os.environ.get('MICROMIX_BLOB_STORE', 'gridfs')
+BLOB_STORE_PATH = os.environ.get('MICROMIX_BLOB_STORE_PATH', 'blobs')
+#Fields that sessions inherit from their ancestors. These must match sessions.INHERITED_FIELDS of the Micromix backend.
+INHERITED_FIELDS = ('active_matrices', 'preview_matrices', 'transformed_dataframe', 'filtered_dataframe', 'merged_matrices', 'query')
 
-#Testing
-app.config.from_object(__name__)
-app.config['CORS_HEADERS'] = 'Content-Type'
-app.config['FLASK_DEBUG']=1
-app.config['DEBUG'] = True
+
+#---
+#Load a session dataframe from a blob reference or from inline parquet bytes
+#---
+def read_session_df(value):
+  if isinstance(value, dict) and 'blob_id' in value:
+    if BLOB_STORE == 'filesystem':
+      with open(os.path.join(BLOB_STORE_PATH, value['blob_id'][:2], value['blob_id'] + '.parquet'), 'rb') as blob_file:
+        data = blob_file.read()
+    else:
+      import gridfs
+      data = gridfs.GridFS(get_db(), collection='blobs').get(value['blob_id']).read()
+  else:
+    data = value
+  start = time.perf_counter()
+  df = pd.read_parquet(BytesIO(data))
+  PARQUET_SECONDS.labels(operation='read').observe(time.perf_counter() - start)
+  return df
+
+
+#---
+#Load a session document, including the fields it inherits from its ancestors
+#Sessions edited after they were locked only store their changes and reference the locked session (see sessions.py
+#of the Micromix backend). The ancestors are loaded in one query and laid over each other, root first.
+#Returns None if the session does not exist, or if one of its ancestors has been removed (the routes answer 404).
+#---
+def find_session(db_entry_id):
+  db_entry = get_db().visualizations.find_one({"_id": db_entry_id})
+  if db_entry == None or not db_entry.get('ancestors'):
+    return db_entry
+  ancestors = {ancestor['_id']: ancestor for ancestor in get_db().visualizations.find({'_id': {'$in': db_entry['ancestors']}}, {key: True for key in INHERITED_FIELDS})}
+  resolved = {}
+  for ancestor_id in db_entry['ancestors']:
+    if ancestor_id not in ancestors:
+      print("The session {} is missing its ancestor {}".format(db_entry_id, ancestor_id))
+      return None
+    resolved.update({key: value for key, value in ancestors[ancestor_id].items() if key in INHERITED_FIELDS})
+  resolved.update(db_entry)
+  return resolved
+
+
+DEBUG = os.environ.get('MICROMIX_DEBUG', 'on') != 'off' # Switched off in the production image (see Dockerfile)
+
+#The routes are registered by the application factory create_app (at the end of this file)
+routes = Blueprint('heatmap', __name__)
+
+
+#---
+#Prometheus metrics, served at '/metrics'
+#With PROMETHEUS_MULTIPROC_DIR set (see Dockerfile), the gunicorn workers share their metrics through this folder.
+#---
+REQUEST_SECONDS = Histogram('heatmap_request_duration_seconds', 'Latency of the HTTP requests.', ['method', 'endpoint', 'status'])
+PARQUET_SECONDS = Histogram('heatmap_parquet_seconds', 'Time spent decoding parquet.', ['operation'])
+
+@routes.before_app_request
+def start_timer():
+  g.metrics_start = time.perf_counter()
+
+@routes.after_app_request
+def observe_request(response):
+  if 'metrics_start' in g:
+    #The route template keeps the number of label values small (no session IDs)
+    endpoint = request.url_rule.rule if request.url_rule != None else 'unmatched'
+    REQUEST_SECONDS.labels(method=request.method, endpoint=endpoint, status=response.status_code).observe(time.perf_counter() - g.metrics_start)
+  return response
+
+@routes.route('/metrics', methods=['GET'])
+def respond_metrics():
+  if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+  return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
 
 #Testing
-@app.route('/status', methods=['GET'])
+@routes.route('/status', methods=['GET'])
 def status():
   return 'alive'
 
 
 
-@app.route('/config', methods=['GET', 'POST'])
+@routes.route('/config', methods=['GET', 'POST'])
 def respond_config():
   #Print the ID to terminal
   print("DB Config=",request.form['url'])
@@ -63,27 +170,132 @@ def respond_config():
     print("id found in DB")
     db_entry_id = ObjectId(loads(request.form['url']))
     #Find the object id in the visualisations database
-    db_entry = db.visualizations.find_one({"_id": db_entry_id})
+    db_entry = find_session(db_entry_id)
+    if db_entry == None:
+      return jsonify({"error": "Session not found"}), 404
+    #Rows and columns can be ordered by clustering (see clustering.py)
+    try:
+      spec = clustering.parse_spec(request.form)
+    except ValueError as e:
+      return jsonify({"error": "Invalid clustering", "details": str(e)}), 400
     #Check if the df is filtered or transformed
     try:
       #Converts entry from .json into pandas parquet
-      data = pd.read_parquet(BytesIO(db_entry['filtered_dataframe'])).to_json(orient='records')
+      data = read_ordered_df(db_entry['filtered_dataframe'], spec).to_json(orient='records')
     except:
       #The mockup db_entry stores the empty transformed_dataframe as a list, so don't convert that one.
       #Convert transformed into pandas parquet
-      if type(db_entry['transformed_dataframe']) == bytes: 
-        data = pd.read_parquet(BytesIO(db_entry['transformed_dataframe'])).to_json(orient='records')
+      if type(db_entry['transformed_dataframe']) in (bytes, dict): 
+        data = read_ordered_df(db_entry['transformed_dataframe'], spec).to_json(orient='records')
       else:
         data = db_entry['transformed_dataframe']
   
   print("Data successfully passed to heatmap!")
   return Response(data, mimetype="application/json")
-  
+
+
+#---
+#Load a session dataframe, ordered by the clustering of the request (if there is one)
+#---
+def read_ordered_df(value, spec):
+  df = read_session_df(value)
+  if spec == None:
+    return df
+  return clustering.reorder(df, tiles.frame_key(value), spec)
+
+
+#---
+#Return the stored dataframe of a session that the heatmap shows: the filtered one, if there is one
+#Returns None if the session has no stored dataframe (e.g. the mockup session).
+#---
+def session_frame(db_entry):
+  frame = db_entry.get('filtered_dataframe')
+  if type(frame) not in (bytes, dict):
+    frame = db_entry.get('transformed_dataframe')
+  return frame if type(frame) in (bytes, dict) else None
+
+
+#---
+#Describe the tile pyramid of the dataframe of a session (see tiles.py)
+#The same dataframe as in '/config' is used (the filtered one, if there is one, ordered by the clustering of the
+#request). The pyramid is built on the first request. If 'tiled' is false, the dataframe is small enough to be loaded
+#from '/config' as before.
+#---
+@routes.route('/tiles/meta', methods=['GET', 'POST'])
+def respond_tile_meta():
+  try:
+    spec = clustering.parse_spec(request.values)
+  except ValueError as e:
+    return jsonify({"error": "Invalid clustering", "details": str(e)}), 400
+  try:
+    db_entry = find_session(ObjectId(loads(request.values['url'])))
+    if db_entry == None:
+      return jsonify({"error": "Session not found"}), 404
+    frame = session_frame(db_entry)
+    if frame == None:
+      return jsonify({"tiled": False}), 200
+    if spec == None:
+      meta = tiles.get_meta(tiles.frame_key(frame), lambda: read_session_df(frame))
+    else:
+      #A clustered dataframe has its own pyramid
+      meta = tiles.get_meta(clustering.ordered_key(tiles.frame_key(frame), spec), lambda: read_ordered_df(frame, spec))
+    return jsonify(meta), 200
+  except Exception as e:
+    print("Error building tiles:", e)
+    return jsonify({"error": "Failed to build tiles", "details": str(e)}), 500
+
+
+#---
+#Serve one tile of the pyramid, by level and position
+#Tiles are keyed by the content of the dataframe, so they never change and can be cached by the browser.
+#---
+@routes.route('/tiles/<key>/<int:level>/<int:tile_row>/<int:tile_column>', methods=['GET'])
+def respond_tile(key, level, tile_row, tile_column):
+  tile = tiles.read_tile(key, level, tile_row, tile_column)
+  if tile == None:
+    return jsonify({"error": "Tile not found"}), 404
+  response = jsonify(tile)
+  response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+  return response
+
+
+#---
+#Cluster the rows and/or columns of the dataframe of a session (see clustering.py)
+#Returns the order of the rows (positions in the dataframe) and of the numeric columns (positions and names). The result is cached,
+#so only the first request of a dataframe and clustering does the work.
+#---
+@routes.route('/cluster', methods=['GET', 'POST'])
+def respond_cluster():
+  try:
+    spec = clustering.parse_spec(request.values)
+  except ValueError as e:
+    return jsonify({"error": "Invalid clustering", "details": str(e)}), 400
+  if spec == None:
+    return jsonify({"error": "Invalid clustering", "details": "Set 'cluster' to rows, columns or both."}), 400
+  try:
+    db_entry = find_session(ObjectId(loads(request.values['url'])))
+    if db_entry == None:
+      return jsonify({"error": "Session not found"}), 404
+    frame = session_frame(db_entry)
+    if frame == None:
+      return jsonify({"error": "Session has no dataframe"}), 404
+    #The dataframe is only read if one of the orderings is not cached yet
+    loaded = {}
+    def load_df():
+      if 'df' not in loaded:
+        loaded['df'] = read_session_df(frame)
+      return loaded['df']
+    result = {axis: clustering.get_order(tiles.frame_key(frame), load_df, axis, spec['metric'], spec['method']) for axis in spec['axes']}
+    return jsonify(result), 200
+  except Exception as e:
+    print("Error clustering:", e)
+    return jsonify({"error": "Failed to cluster", "details": str(e)}), 500
+
 
 #---
 #Save user defined heatmap settings
 #---
-@app.route('/save-settings', methods=['POST'])
+@routes.route('/save-settings', methods=['POST'])
 def save_settings():
   #print("Save request received")
 
@@ -111,7 +323,7 @@ def save_settings():
 #---
 #Load user defined heatmap settings
 #---
-@app.route('/get-user-settings/<db_entry_id>', methods=['GET'])
+@routes.route('/get-user-settings/<db_entry_id>', methods=['GET'])
 def get_user_settings(db_entry_id):
     #print("--in get-user-settings--")
     #print("db_entry_id: ", db_entry_id)
@@ -132,8 +344,35 @@ def get_user_settings(db_entry_id):
     except Exception as e:
         # Error message if not found
         response = {"error": "Failed to load settings", "details": str(e)}
-        app.logger.error(response)  # Log the error details
+        current_app.logger.error(response)  # Log the error details
         return jsonify(response), 500
 
 
-client.close()
+
+#---
+#Readiness check, the backend is ready if MongoDB can be reached (status 503 otherwise)
+#---
+@routes.route('/ready', methods=['GET'])
+def ready():
+  try:
+    get_db().client.admin.command('ping')
+    return jsonify({"status": "ready"}), 200
+  except Exception as e:
+    print("Not ready:", e)
+    return jsonify({"status": "unavailable", "details": str(e)}), 503
+
+
+
+#---
+#Application factory, called by 'flask run' and once per worker process by gunicorn ('app:create_app()')
+#---
+def create_app():
+  app = Flask(__name__)
+  CORS(app)
+
+  app.config.from_object(__name__)
+  app.config['CORS_HEADERS'] = 'Content-Type'
+  app.config['FLASK_DEBUG'] = 1 if DEBUG else 0
+  app.config['DEBUG'] = DEBUG
+  app.register_blueprint(routes)
+  return app
@@ -0,0 +1,228 @@
+#--------------------------------
+#
+# Hierarchical clustering of the heatmap
+#
+#--------------------------------
+
+#Rows and columns of the heatmap can be ordered by hierarchical clustering (SciPy), instead of sending the data to an
+#external service (see plugins/Clustergrammer.py of the Micromix backend):
+#  - The metric (METRICS) and the linkage method (METHODS) can be chosen. 'ward', 'centroid' and 'median' are only
+#    defined for the euclidean metric.
+#  - Rows are clustered over all numeric columns. Columns are clustered within their subtable (the columns with the same
+#    '(title) ' prefix, see tiles.py), so the subtables stay together.
+#  - Above CLUSTER_EXACT_MAX_ROWS rows, the distance matrix becomes too large. The rows are then grouped into
+#    CLUSTER_APPROXIMATE_GROUPS groups by k-means, the centroids of the groups are clustered hierarchically, and the rows
+#    of a group are ordered by their distance to its centroid.
+#The linkage matrices and the orderings are stored in CLUSTER_CACHE_DIR, keyed by the blob ID of the dataframe (see
+#tiles.frame_key), the axis, the metric and the method. A dataframe is clustered only once, and every page load after
+#that only reads the ordering.
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.cluster.vq import kmeans2
+from scipy.spatial.distance import pdist
+
+
+#Configuration
+CLUSTER_CACHE_DIR = os.environ.get('MICROMIX_CLUSTER_CACHE_DIR', 'cluster_cache')
+CLUSTER_EXACT_MAX_ROWS = int(os.environ.get('MICROMIX_CLUSTER_EXACT_MAX_ROWS', 5000)) #Larger dataframes are clustered approximately
+CLUSTER_APPROXIMATE_GROUPS = int(os.environ.get('MICROMIX_CLUSTER_APPROXIMATE_GROUPS', 500)) #k of the k-means step
+CLUSTER_SEED = 0 #Seed of the k-means step, so the same dataframe is always ordered the same way
+
+AXES = ('rows', 'columns')
+METRICS = ('euclidean', 'correlation', 'cosine', 'cityblock', 'chebyshev', 'braycurtis', 'canberra')
+METHODS = ('average', 'complete', 'single', 'weighted', 'ward', 'centroid', 'median')
+EUCLIDEAN_METHODS = ('ward', 'centroid', 'median')
+
+_cluster_lock = threading.Lock()
+
+
+#---
+#Read and check the clustering of a request ('cluster': 'rows', 'columns' or 'both', 'metric' and 'method')
+#Returns None if the request does not ask for clustering. Raises ValueError for unknown values.
+#---
+def parse_spec(values):
+  cluster = values.get('cluster')
+  if cluster in (None, '', 'undefined', 'none'):
+    return None
+  axes = AXES if cluster == 'both' else (cluster,)
+  spec = {
+    'axes': axes,
+    'metric': values.get('metric') or 'euclidean',
+    'method': values.get('method') or 'average',
+  }
+  for axis in axes:
+    if axis not in AXES:
+      raise ValueError('Unknown axis {}, use one of rows, columns or both.'.format(axis))
+  if spec['metric'] not in METRICS:
+    raise ValueError('Unknown metric {}, use one of {}.'.format(spec['metric'], ', '.join(METRICS)))
+  if spec['method'] not in METHODS:
+    raise ValueError('Unknown method {}, use one of {}.'.format(spec['method'], ', '.join(METHODS)))
+  if spec['method'] in EUCLIDEAN_METHODS and spec['metric'] != 'euclidean':
+    raise ValueError('The method {} needs the euclidean metric.'.format(spec['method']))
+  return spec
+
+
+#---
+#Return the key of a clustered dataframe, e.g. for its tiles: the sha256 of the key of the dataframe and the clustering
+#---
+def ordered_key(key, spec):
+  description = json.dumps([key, list(spec['axes']), spec['metric'], spec['method']])
+  return hashlib.sha256(description.encode()).hexdigest()
+
+
+#---
+#Return the ordering of the rows or columns of a dataframe, clustering it first if needed
+#load_df is only called (to read the dataframe) if the ordering is not in the cache yet.
+#---
+def get_order(key, load_df, axis, metric, method):
+  path = os.path.join(CLUSTER_CACHE_DIR, key, '{}_{}_{}.npz'.format(axis, metric, method))
+  result = read_result(path)
+  if result == None:
+    with _cluster_lock:
+      result = read_result(path)
+      if result == None:
+        result = cluster(load_df(), axis, metric, method)
+        write_result(path, result)
+  order = {
+    'axis': axis,
+    'metric': metric,
+    'method': method,
+    'approximate': bool(result['approximate']),
+    'order': result['order'].tolist(),
+  }
+  if 'names' in result:
+    order['names'] = [str(result['names'][index]) for index in order['order']]
+  return order
+
+
+#---
+#Read a clustering from the cache, None if it is not there
+#---
+def read_result(path):
+  try:
+    with np.load(path) as stored:
+      return {key: stored[key] for key in stored.files}
+  except FileNotFoundError:
+    return None
+
+
+#---
+#Store a clustering in the cache
+#Written to a temporary file first, so other processes never read a half-written file.
+#---
+def write_result(path, result):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  handle, temporary_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path))
+  try:
+    with os.fdopen(handle, 'wb') as result_file:
+      np.savez(result_file, **result)
+    os.replace(temporary_path, path)
+  except Exception:
+    os.remove(temporary_path)
+    raise
+
+
+#---
+#Cluster the rows or the columns of a dataframe
+#Returns the order (positions in the dataframe for rows, positions among the numeric columns for columns), whether it
+#is approximate, the linkage matrices ('linkage_0', 'linkage_1', ... one per subtable for columns), and the names of
+#the numeric columns (columns only).
+#---
+def cluster(df, axis, metric, method):
+  columns, titles, values = numeric_values(df)
+  result = {'approximate': np.array(False)}
+  if axis == 'rows':
+    if len(values) > CLUSTER_EXACT_MAX_ROWS:
+      order, result['linkage_0'] = approximate_order(values, metric, method)
+      result['approximate'] = np.array(True)
+    else:
+      order, result['linkage_0'] = exact_order(values, metric, method)
+  else:
+    #Each subtable is clustered on its own, and the subtables keep their position
+    order = []
+    start = 0
+    for index in range(1, len(titles) + 1):
+      if index == len(titles) or titles[index] != titles[start]:
+        group_order, result['linkage_{}'.format(len(order))] = exact_order(values[:, start:index].T, metric, method)
+        order.append(group_order + start)
+        start = index
+    order = np.concatenate(order) if len(order) > 0 else np.zeros(0, dtype=int)
+    result['names'] = np.array([str(column) for column in columns], dtype=str)
+  result['order'] = np.asarray(order, dtype=np.int64)
+  return result
+
+
+#---
+#Return the numeric columns of a dataframe (as in tiles.py, the first column holds the row labels), their subtable
+#titles, and their values, with missing values replaced by 0
+#---
+def numeric_values(df):
+  numeric_columns = [column for column in df.columns[1:] if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])]
+  titles = [str(column)[:str(column).index(') ') + 1] if str(column).startswith('(') and ') ' in str(column) else None for column in numeric_columns]
+  values = df[numeric_columns].to_numpy(dtype=np.float64) if len(numeric_columns) > 0 else np.zeros((len(df), 0))
+  values[~np.isfinite(values)] = 0
+  return numeric_columns, titles, values
+
+
+#---
+#Cluster the rows of a matrix hierarchically and return the order of the leaves and the linkage matrix
+#---
+def exact_order(values, metric, method):
+  if len(values) < 2:
+    return np.arange(len(values)), np.zeros((0, 4))
+  distances = pdist(values, metric=metric)
+  #Constant rows have no correlation (or cosine) distance, they are placed as far as the farthest pair
+  missing = ~np.isfinite(distances)
+  if missing.any():
+    distances[missing] = distances[~missing].max() if (~missing).any() else 0
+  linkage_matrix = linkage(distances, method=method)
+  return leaves_list(linkage_matrix), linkage_matrix
+
+
+#---
+#Cluster the rows of a large matrix approximately
+#The rows are grouped by k-means and the centroids are clustered hierarchically. For the correlation and cosine metric,
+#the rows are standardized first, so the euclidean distance of k-means follows the metric.
+#---
+def approximate_order(values, metric, method):
+  points = values
+  if metric == 'correlation':
+    points = values - values.mean(axis=1, keepdims=True)
+  if metric in ('correlation', 'cosine'):
+    norms = np.linalg.norm(points, axis=1, keepdims=True)
+    points = np.divide(points, norms, out=np.zeros_like(points), where=norms > 0)
+  groups = min(CLUSTER_APPROXIMATE_GROUPS, len(values))
+  centroids, membership = kmeans2(points, groups, minit='++', seed=CLUSTER_SEED)
+
+  #Groups that k-means left empty are dropped
+  used = np.unique(membership)
+  group_order, linkage_matrix = exact_order(centroids[used], metric, method)
+  order = []
+  for group in used[group_order]:
+    members = np.flatnonzero(membership == group)
+    distances = np.linalg.norm(points[members] - centroids[group], axis=1)
+    order.append(members[np.argsort(distances, kind='stable')])
+  return np.concatenate(order), linkage_matrix
+
+
+#---
+#Reorder a dataframe by the clustering of a request
+#The numeric columns are reordered among their own positions, so the text columns stay where they are.
+#---
+def reorder(df, key, spec):
+  for axis in spec['axes']:
+    order = get_order(key, lambda: df, axis, spec['metric'], spec['method'])['order']
+    if axis == 'rows':
+      df = df.iloc[order]
+    else:
+      numeric_columns = numeric_values(df.iloc[:0])[0]
+      ordered_columns = iter([numeric_columns[index] for index in order])
+      df = df[[next(ordered_columns) if column in numeric_columns else column for column in df.columns]]
+  return df.reset_index(drop=True)
@@ -0,0 +1,45 @@
+#--------------------------------
+#
+# gunicorn settings of the production image (see Dockerfile)
+#
+#--------------------------------
+
+# Each worker process creates its own application with create_app() and its own MongoDB client (see get_db in app.py).
+# All settings can be changed with environment variables.
+
+import os
+
+
+# The application factory, called once in every worker process.
+wsgi_app = 'app:create_app()'
+
+bind = os.environ.get('MICROMIX_BIND', '0.0.0.0:3000')
+workers = int(os.environ.get('MICROMIX_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('MICROMIX_THREADS', 8))
+
+timeout = int(os.environ.get('MICROMIX_WORKER_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('MICROMIX_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# The application is not loaded before the workers are forked, so no worker inherits connections of the master process.
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+
+# With PROMETHEUS_MULTIPROC_DIR set, every worker writes its metrics to this folder and '/metrics' returns the metrics
+# of all workers. The folder is emptied on startup, and the metrics of exited workers are marked as dead.
+def on_starting(server):
+    multiprocess_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiprocess_dir:
+        os.makedirs(multiprocess_dir, exist_ok=True)
+        for file_name in os.listdir(multiprocess_dir):
+            os.remove(os.path.join(multiprocess_dir, file_name))
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,303 @@
+#--------------------------------
+#
+# Level-of-detail tile pyramid of the heatmap
+#
+#--------------------------------
+
+#'/config' sends the whole dataframe as records, and the frontend draws every cell. For tens of thousands of genes, this
+#stalls the browser. Here, the numeric columns of a dataframe are aggregated into a pyramid of levels:
+#  - Level 0 holds the cells themselves, level 1 blocks of 2 x 2 cells, level 2 blocks of 4 x 4 cells, and so on, until
+#    a level fits into a single tile. A block holds the mean and the maximum of its cells (missing values are ignored).
+#  - Column blocks never cross the border of a subtable (the columns with the same '(title) ' prefix), so each block
+#    keeps its subtable and its gradient.
+#  - Each level is cut into tiles of TILE_SIZE x TILE_SIZE blocks. The frontend requests the tiles of the level that
+#    matches its zoom, and only those in its viewport.
+#The pyramid of a dataframe is built once and stored in TILE_CACHE_DIR as NumPy files, which are memory-mapped to read a
+#tile. It is keyed by the blob ID (the sha256 of the dataframe, see blob_store.py of the Micromix backend), so it never
+#has to be invalidated and is shared by all worker processes. Dataframes with fewer than TILE_MIN_CELLS cells are not
+#tiled, the frontend loads them from '/config' as before.
+#The cache is limited to TILE_CACHE_MAX_BYTES. The modification time of meta.json is updated whenever a pyramid is opened
+#(get_meta), and after a new pyramid is built, the least recently opened ones are removed until the cache fits again.
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+
+#Configuration
+TILE_CACHE_DIR = os.environ.get('MICROMIX_TILE_CACHE_DIR', 'tile_cache')
+TILE_CACHE_MAX_BYTES = int(os.environ.get('MICROMIX_TILE_CACHE_MAX_BYTES', 5 * 1024 ** 3)) #0 for no limit
+BUILD_DIR_TIMEOUT = 3600 #Seconds after which the folder of an unfinished build (e.g. of a killed process) is removed
+TILE_SIZE = int(os.environ.get('MICROMIX_TILE_SIZE', 256)) #Blocks per side of a tile
+TILE_MIN_CELLS = int(os.environ.get('MICROMIX_TILE_MIN_CELLS', 50000)) #Smaller dataframes are sent as a whole
+TILE_DECIMALS = 4 #Precision of the values in a tile
+
+KEY_PATTERN = re.compile('^[0-9a-f]{64}$')
+_build_lock = threading.Lock()
+
+
+#---
+#Return the cache key of a stored dataframe: its blob ID, or the sha256 of inline parquet bytes (older sessions)
+#---
+def frame_key(value):
+  if isinstance(value, dict) and 'blob_id' in value:
+    return value['blob_id']
+  return hashlib.sha256(bytes(value)).hexdigest()
+
+
+#---
+#Return the description of the pyramid of a dataframe, building the pyramid first if needed
+#load_df is only called (to read the dataframe) if the pyramid is not in the cache yet.
+#---
+def get_meta(key, load_df):
+  if not KEY_PATTERN.match(key):
+    raise ValueError('Invalid tile key {}.'.format(key))
+  meta = read_meta(key)
+  if meta != None:
+    touch(key)
+    return meta
+  with _build_lock:
+    meta = read_meta(key)
+    if meta == None:
+      meta = build_pyramid(key, load_df())
+      evict(key)
+  return meta
+
+
+#---
+#Mark a pyramid as used, so it is removed last (see evict)
+#---
+def touch(key):
+  try:
+    os.utime(os.path.join(TILE_CACHE_DIR, key, 'meta.json'))
+  except OSError: #Removed by another process in the meantime
+    pass
+
+
+#---
+#Remove the least recently used pyramids until the cache is not larger than TILE_CACHE_MAX_BYTES
+#The pyramid that has just been built (keep) is never removed. A pyramid that is removed while a tile of it is read
+#is built again with the next '/tiles/meta' request.
+#---
+def evict(keep):
+  if TILE_CACHE_MAX_BYTES <= 0:
+    return
+  pyramids = []
+  total = 0
+  for entry in os.scandir(TILE_CACHE_DIR):
+    try:
+      if KEY_PATTERN.match(entry.name):
+        used = os.stat(os.path.join(entry.path, 'meta.json')).st_mtime
+        size = sum(item.stat().st_size for item in os.scandir(entry.path))
+        pyramids.append((used, entry.name, size))
+        total += size
+      elif entry.is_dir() and time.time() - entry.stat().st_mtime > BUILD_DIR_TIMEOUT:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    except FileNotFoundError: #Removed by another process in the meantime
+      pass
+  for used, key, size in sorted(pyramids):
+    if total <= TILE_CACHE_MAX_BYTES:
+      break
+    if key != keep:
+      shutil.rmtree(os.path.join(TILE_CACHE_DIR, key), ignore_errors=True)
+      total -= size
+
+
+#---
+#Read the description of a pyramid from the cache, None if it is not there
+#---
+def read_meta(key):
+  try:
+    with open(os.path.join(TILE_CACHE_DIR, key, 'meta.json')) as meta_file:
+      return json.load(meta_file)
+  except FileNotFoundError:
+    return None
+
+
+#---
+#Aggregate the numeric columns of a dataframe into the levels of the pyramid and store them in the cache
+#The first column holds the row labels (as in '/config'), other text columns are not part of the tiles.
+#---
+def build_pyramid(key, df):
+  labels = [str(label) for label in df.iloc[:, 0].tolist()] if len(df.columns) > 0 else []
+  numeric_columns = [column for column in df.columns[1:] if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])]
+  columns = [str(column) for column in numeric_columns]
+  titles = [column[:column.index(') ') + 1] if column.startswith('(') and ') ' in column else None for column in columns]
+  values = df[numeric_columns].to_numpy(dtype=np.float64) if len(numeric_columns) > 0 else np.zeros((len(df), 0))
+  values[~np.isfinite(values)] = np.nan
+
+  meta = {
+    'key': key,
+    'tiled': values.size >= TILE_MIN_CELLS,
+    'rows': int(values.shape[0]),
+    'columns': columns,
+    'titles': titles,
+    'text_columns': [str(column) for column in df.columns[1:] if column not in numeric_columns],
+    'tile_size': TILE_SIZE,
+    'levels': [],
+    'subtables': subtable_ranges(values, titles),
+  }
+  finite = values[np.isfinite(values)]
+  meta['lowest_value'] = float(min(finite.min(), 0)) if finite.size > 0 else 0
+  meta['highest_value'] = float(max(finite.max(), 0)) if finite.size > 0 else 0
+
+  #Build into a temporary folder, which is renamed at the end, so other processes never see a half-built pyramid
+  os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+  build_dir = tempfile.mkdtemp(prefix=key + '-', dir=TILE_CACHE_DIR)
+  try:
+    if meta['tiled']:
+      sums = np.where(np.isnan(values), 0, values)
+      counts = (~np.isnan(values)).astype(np.int32)
+      maxima = values
+      rows = values.shape[0]
+      column_starts = np.arange(values.shape[1])
+      level = 0
+      while True:
+        with np.errstate(invalid='ignore', divide='ignore'):
+          means = sums / counts
+        np.save(os.path.join(build_dir, 'mean_{}.npy'.format(level)), means.astype(np.float32))
+        if level > 0: #The maximum of a single cell is its value
+          np.save(os.path.join(build_dir, 'max_{}.npy'.format(level)), maxima.astype(np.float32))
+        meta['levels'].append({
+          'level': level,
+          'factor': 2 ** level,
+          'rows': int(rows),
+          'columns': int(len(column_starts)),
+          'column_starts': column_starts.tolist(),
+          'tile_rows': int(-(-rows // TILE_SIZE)),
+          'tile_columns': int(-(-len(column_starts) // TILE_SIZE)),
+        })
+        if rows <= TILE_SIZE and len(column_starts) <= TILE_SIZE:
+          break
+        #Merge pairs of blocks. The blocks of the next level start at every second block of this level (rows), or at
+        #every second block of a subtable (columns). The row blocks of a level all have 'factor' rows (the last one may
+        #have less).
+        factor = 2 ** (level + 1)
+        row_index = np.arange(0, rows, 2)
+        column_index = np.array([index for index, start in enumerate(column_starts)
+                                 if (start - subtable_start(start, meta['subtables'])) % factor == 0], dtype=int)
+        if len(row_index) == rows and len(column_index) == len(column_starts): #e.g. many subtables of a single column
+          break
+        sums, counts, maxima = merge_blocks(sums, counts, maxima, row_index, column_index)
+        rows = len(row_index)
+        column_starts = column_starts[column_index]
+        level += 1
+      #Only level 0 has one row per label, the other levels label their blocks with the first and the last label
+      with open(os.path.join(build_dir, 'labels.json'), 'w') as labels_file:
+        json.dump(labels, labels_file)
+    with open(os.path.join(build_dir, 'meta.json'), 'w') as meta_file:
+      json.dump(meta, meta_file)
+    try:
+      os.rename(build_dir, os.path.join(TILE_CACHE_DIR, key))
+    except OSError: #Built by another process in the meantime
+      shutil.rmtree(build_dir, ignore_errors=True)
+  except Exception:
+    shutil.rmtree(build_dir, ignore_errors=True)
+    raise
+  return meta
+
+
+#---
+#Find the contiguous column ranges of the subtables and the lowest and highest value of each
+#---
+def subtable_ranges(values, titles):
+  subtables = []
+  for index, title in enumerate(titles):
+    if len(subtables) == 0 or subtables[-1]['title'] != title:
+      subtables.append({'title': title, 'start': index, 'stop': index + 1})
+    else:
+      subtables[-1]['stop'] = index + 1
+  for subtable in subtables:
+    block = values[:, subtable['start']:subtable['stop']]
+    finite = block[np.isfinite(block)]
+    subtable['lowest_value'] = float(min(finite.min(), 0)) if finite.size > 0 else 0
+    subtable['highest_value'] = float(max(finite.max(), 0)) if finite.size > 0 else 0
+  return subtables
+
+
+#---
+#Return the first column of the subtable a column belongs to
+#---
+def subtable_start(column, subtables):
+  for subtable in subtables:
+    if subtable['start'] <= column < subtable['stop']:
+      return subtable['start']
+  return 0
+
+
+#---
+#Merge the blocks of a level into the blocks of the next level
+#row_index and column_index are the positions of the first block of each merged block.
+#---
+def merge_blocks(sums, counts, maxima, row_index, column_index):
+  sums = np.add.reduceat(np.add.reduceat(sums, row_index, axis=0), column_index, axis=1)
+  counts = np.add.reduceat(np.add.reduceat(counts, row_index, axis=0), column_index, axis=1)
+  #fmax ignores missing values, a block without any value stays missing
+  maxima = np.fmax.reduceat(np.fmax.reduceat(maxima, row_index, axis=0), column_index, axis=1)
+  return sums, counts, maxima
+
+
+#---
+#Read one tile of a level
+#Returns the mean and maximum of each block (None for blocks without values), the first row and column of each
+#block (in cells of level 0), and a label for each row of blocks.
+#---
+def read_tile(key, level, tile_row, tile_column):
+  meta = read_meta(key) if KEY_PATTERN.match(key) else None
+  if meta == None or not meta['tiled'] or not 0 <= level < len(meta['levels']):
+    return None
+  level_meta = meta['levels'][level]
+  if not (0 <= tile_row < level_meta['tile_rows'] and 0 <= tile_column < level_meta['tile_columns']):
+    return None
+  row_slice = slice(tile_row * TILE_SIZE, min((tile_row + 1) * TILE_SIZE, level_meta['rows']))
+  column_slice = slice(tile_column * TILE_SIZE, min((tile_column + 1) * TILE_SIZE, level_meta['columns']))
+
+  folder = os.path.join(TILE_CACHE_DIR, key)
+  try:
+    means = np.load(os.path.join(folder, 'mean_{}.npy'.format(level)), mmap_mode='r')[row_slice, column_slice]
+    maxima = means if level == 0 else np.load(os.path.join(folder, 'max_{}.npy'.format(level)), mmap_mode='r')[row_slice, column_slice]
+    labels = read_labels(key)
+  except FileNotFoundError: #Removed from the cache (see evict)
+    return None
+
+  factor = level_meta['factor']
+  row_starts = [row * factor for row in range(row_slice.start, row_slice.stop)]
+  if level == 0:
+    row_labels = labels[row_slice]
+  else:
+    row_labels = ['{} - {}'.format(labels[start], labels[min(start + factor, meta['rows']) - 1]) for start in row_starts]
+  return {
+    'level': level,
+    'tile_row': tile_row,
+    'tile_column': tile_column,
+    'row_starts': row_starts,
+    'column_starts': level_meta['column_starts'][column_slice],
+    'row_labels': row_labels,
+    'mean': to_list(means),
+    'max': to_list(maxima),
+  }
+
+
+#---
+#Read the row labels of a pyramid, the last ones are kept in memory
+#---
+@lru_cache(maxsize=8)
+def read_labels(key):
+  with open(os.path.join(TILE_CACHE_DIR, key, 'labels.json')) as labels_file:
+    return json.load(labels_file)
+
+
+#---
+#Convert a block of values to nested lists, with None for missing values (JSON has no NaN)
+#---
+def to_list(values):
+  values = np.round(np.asarray(values, dtype=np.float64), TILE_DECIMALS)
+  return [[None if value != value else value for value in row] for row in values.tolist()]
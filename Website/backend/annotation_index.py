@@ -0,0 +1,76 @@
+#--------------------------------
+#
+# Inverted index of the gene annotations
+#
+#--------------------------------
+
+# static/gene_annotations.json maps every locus to its annotation codes, e.g.
+#   {"BT_0307": {"go_id": ["GO:0003872", ...], "kegg_pathway_id": ["bth00010", ...], ...}, ...}
+#
+# Annotation filters ask the opposite question: which loci belong to a code (e.g. a KEGG pathway)? The file used to be
+# read and parsed for every annotation filter, and every locus was checked against the rows of the dataframe.
+#
+# Here, the file is read once per process and inverted into a dictionary {(code_type, code): frozenset of loci}. A filter
+# is then a single dictionary lookup. The index is rebuilt when the file is changed (its modification time or size).
+
+import os
+import json
+import threading
+
+
+# Configuration
+ANNOTATION_FILE = 'static/gene_annotations.json'
+
+_index = {}
+_signature = None
+_lock = threading.Lock()
+
+
+
+#---
+# FUNCTION: loci_for
+# PURPOSE: Returns the loci that are annotated with a code.
+# PARAMETERS:
+#   code_type: The type of annotation, as used in gene_annotations.json (e.g. 'go_id', 'kegg_pathway_id').
+#   code: The annotation code (e.g. 'GO:0005524').
+# RETURNS: A frozenset of locus tags. Empty if no locus has this code.
+#---
+def loci_for(code_type, code):
+    return get_index().get((code_type, code), frozenset())
+
+
+
+#---
+# FUNCTION: get_index
+# PURPOSE: Returns the inverted index, (re)building it if the annotation file has changed since it was last read.
+#---
+def get_index():
+    global _index, _signature
+    stat = os.stat(ANNOTATION_FILE)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if signature != _signature:
+        with _lock:
+            if signature != _signature: # Another thread may have rebuilt the index in the meantime.
+                _index = build_index(ANNOTATION_FILE)
+                _signature = signature
+    return _index
+
+
+
+#---
+# FUNCTION: build_index
+# PURPOSE: Reads the annotation file and inverts it.
+# RETURNS: A dictionary {(code_type, code): frozenset of loci}.
+# NOTES: Not every organism has every code type. Loci without a code type are simply not part of its entries.
+#---
+def build_index(annotation_file):
+    with open(annotation_file) as json_file:
+        gene_annotations = json.load(json_file)
+
+    index = {}
+    for gene_locus, annotations in gene_annotations.items():
+        for code_type, codes in annotations.items():
+            for code in codes:
+                index.setdefault((code_type, code), set()).add(gene_locus)
+    print('Annotation index: {} codes for {} loci'.format(len(index), len(gene_annotations)))
+    return {key: frozenset(loci) for key, loci in index.items()}
@@ -13,7 +13,7 @@
 # To-Do: Configure CORS to only allow specific requests.
 
 import os
-from flask import Flask, flash, request, redirect, url_for, jsonify, send_from_directory, Response, send_file
+from flask import Flask, Blueprint, current_app, flash, request, redirect, url_for, jsonify, send_from_directory, Response, send_file
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 import uuid
@@ -21,6 +21,15 @@ import json
 from flask import json
 import process_file # Custom module for processing uploaded files
 import visualize # Custom module for handling visualization logic
+import blob_store # Custom module for storing the session dataframes by content hash
+import export_formats # Custom module for streaming dataframes as CSV, Parquet, etc.
+import sessions # Custom module for resolving the version chains of locked sessions
+import jobs # Custom module for running uploads as background jobs
+import mongo # Custom module for the MongoDB client of each process
+import metrics # Custom module for the Prometheus metrics
+import profiling # Custom module for profiling single requests on demand
+import retention # Custom module for removing sessions that are no longer used
+import chunked_uploads # Custom module for uploading large files in chunks
 from pymongo import MongoClient
 from bson.json_util import loads, dumps, ObjectId
 from io import BytesIO
@@ -31,6 +40,9 @@ import pandas as pd
 ALLOWED_EXTENSIONS_MATRIX = {'txt', 'xlsx', 'csv', 'tsv'}
 ALLOWED_EXTENSIONS_ICON = {'svg', 'png', 'jpg', 'jpeg', 'gif'}
 
+# Number of rows per record batch in the Arrow responses of '/config/arrow'.
+ARROW_BATCH_SIZE = int(os.environ.get('MICROMIX_ARROW_BATCH_SIZE', 1000))
+
 # Pre-configured plugins with their MongoDB ObjectIds. These plugins are available by default.
 PRE_CONFIGURED_PLUGINS =  [ObjectId('5f984ac1b478a2c8653ed827'), ObjectId('5f284a560831e4a42a30d698'), ObjectId('5f284bc60831e4a42a30d699'), ObjectId('5fc156db0ccdd1e1e454f116')]
 
@@ -119,6 +131,20 @@ ERROR_MESSAGES = {
             'message': 'An unexpected error has occured while uploading the data. Did you select the target matrix in the preview?'
         }
     },
+    'profiling_error': {
+        'expected': {
+            'type': 'Profiling Error',
+            'message': 'The profile could not be found. It may have been replaced by newer profiles.'
+        },
+        'unexpected': {
+            'type': 'Unexpected Profiling Error',
+            'message': 'An unexpected error has occured while reading the profiles.'
+        },
+        'forbidden': {
+            'type': 'Profiling Forbidden',
+            'message': 'Profiling is not enabled for this request. Send an allowed token in the header X-Micromix-Profile.'
+        }
+    },
 }
 
 
@@ -127,40 +153,18 @@ ERROR_MESSAGES = {
 #---
 
 # configuration
-DEBUG = True
-
-# # instantiate the app
-app = Flask(__name__)
-app.config.from_object(__name__)
-
-# Configure Cross-Origin Resource Sharing (CORS) to allow all origins. This should be restricted in production.
-app.config['CORS_HEADERS'] = 'Content-Type'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # Limit file size to prevent denial-of-service attacks
-app.config['FLASK_DEBUG']=1 
-app.config['DEBUG'] = True
-cors = CORS(app, resources={r"/*":{"origins": "*"}})
-
+DEBUG = os.environ.get('MICROMIX_DEBUG', 'on') != 'off' # Switched off in the production image (see Dockerfile)
 
 UPLOAD_FOLDER = '/static'  # NOTE: Change this to /uploads in production for better organization
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Entry point for the Flask application.
-# Ensure the Flask server runs in debug mode on 0.0.0.0, making it accessible on all network interfaces.
-# The server listens on port specified by the PORT environment variable, defaulting to 8080 if not set.
-if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+# The routes are collected in a blueprint and registered by the application factory create_app (at the end of this file).
+# This allows a server like gunicorn to create the application in each of its worker processes (see gunicorn.conf.py).
+routes = Blueprint('micromix', __name__)
 
 # MongoDB Connection setup
-# If running not in a container environment, you can use the following line to connect to a local MongoDB install
-#client = MongoClient() #this is for testing on a local machine, when not inside a container
-#When using containers, you need to modify 'sudo vim /etc/mongodb.conf' and add in an additional IP under bind_ip
-# '172.17.0.1' is often the Docker default bridge network gateway, allowing containers to connect to the host.
-client = MongoClient('172.17.0.1', 27017)
-# Select the 'micromix' database within MongoDB for storing and retrieving application data.
-db = client.micromix
-# Define collections for storing visualizations and plugins information.
-visualizations = db.visualizations
-plugins = db.plugins
+# The database of this process, set by create_app. The client is created lazily and per process (see mongo.py), the
+# host, connection pool and timeouts are set with environment variables there.
+db = None
 
 
 
@@ -180,15 +184,15 @@ def allowed_file(filename, extension_whitelist):
 # ROUTE 'export/'
 #=============
 
-# Route for exporting data in various formats (Excel or CSV) based on user's choice.
+# Route for exporting data in various formats (Excel, CSV, gzip-compressed TSV, Parquet or Feather) based on user's choice.
 # Fetches the specific visualization data from MongoDB, prepares it, and sends the file to the user.
-@app.route('/export', methods=['POST'])
+@routes.route('/export', methods=['POST'])
 
 #---
 # FUNCTION: export_df
-# PURPOSE: This function is designed to export data from a database as either a CSV or Excel file based on user input.
+# PURPOSE: This function is designed to export data from a database as an Excel file, or as a CSV, gzip-compressed TSV, Parquet or Feather file based on user input.
 #          It handles both "filtered" and "unfiltered" datasets, retrieving them from a database, and prepares them
-#          according to the specified format (CSV or Excel) as chosen by the user. The function dynamically handles
+#          according to the specified format as chosen by the user. The function dynamically handles
 #          errors related to missing data or incorrect format specifications. 
 #---
 
@@ -198,7 +202,12 @@ def export_df():
         #  Parse the export form and URL from the request form data to get the user's export preferences and the ID of the data to export.
         export_form = json.loads(request.form['export_form'])
         url = json.loads(request.form['url'])
-        db_entry = db.visualizations.find_one({"_id": ObjectId(url)}, {'_id': False})
+        db_entry = sessions.find_session(db, ObjectId(url), {'_id': False})
+
+        # The single-table formats are streamed from the stored parquet file, see export_formats.py.
+        # Only the dataframe that is exported is loaded.
+        if export_form["file_type"] in export_formats.EXPORT_FORMATS:
+            return df_to_stream(db_entry, export_form["file_type"], export_form.get('csv_seperator', ','))
 
         # Prepare dictionaries to hold filtered and unfiltered data for export.
         # Find the visualization entry in the database using its unique ID but exclude the entry's own ID from the results.
@@ -208,22 +217,20 @@ def export_df():
         
         
         # Attempt to load the filtered dataframe if available and add it to the dataframe dictionary.
-        try:
-            df_filtered = pd.read_parquet(BytesIO(db_entry['filtered_dataframe']))
+        # If filtered data is not available, skip without failing.
+        df_filtered = blob_store.read_df(db, db_entry.get('filtered_dataframe'))
+        if df_filtered is not None:
             dataframe_dict["filtered"] = {"df": df_filtered, "name": "Filtered Data"}
-        except (KeyError, TypeError):
-            # If filtered data is not available or there's an error, skip without failing.
-            pass  # Skip if no filtered data is available.
 
         # Always attempt to add the unfiltered data to the export.
         dataframe_dict["unfiltered"] = {}
         try:
             # Attempt to load the transformed dataframe as the unfiltered data.
-            dataframe_dict["unfiltered"]["df"] = pd.read_parquet(BytesIO(db_entry['transformed_dataframe']))
+            dataframe_dict["unfiltered"]["df"] = blob_store.read_df(db, db_entry['transformed_dataframe'])
         except KeyError:
             # Fallback to the original dataframe if the transformed version isn't available.
             print("NOTE: 'transformed_dataframe' not found, using 'dataframe' instead.")
-            dataframe_dict["unfiltered"]["df"] = pd.read_parquet(BytesIO(db_entry['dataframe']))
+            dataframe_dict["unfiltered"]["df"] = blob_store.read_df(db, db_entry['dataframe'])
         
         # Assign a name to the unfiltered data for clarity in the export.
         dataframe_dict["unfiltered"]["name"] = "Source Data"
@@ -231,8 +238,8 @@ def export_df():
         # Determine the file type requested for the export and call the respective function to prepare the file.
         if export_form["file_type"] == 'excel':
             res = df_to_excel(dataframe_dict)
-        elif export_form["file_type"] == 'csv':
-            res = df_to_csv(dataframe_dict, export_form['csv_seperator'])
+        else:
+            raise ValueError("Unknown file type '{}'.".format(export_form["file_type"]))
 
         # Return the prepared file for download.
         return res
@@ -263,18 +270,22 @@ def df_to_excel(dataframe_dict):
 
 
 #---
-# FUNCTION: df_to_csv
-# PURPOSE:  Helper function to convert a dataframe into a CSV file and return it as a Flask response.
+# FUNCTION: df_to_stream
+# PURPOSE:  Helper function to stream a single dataframe as CSV, gzip-compressed TSV, Parquet or Feather.
 #---
 
-# Only supports exporting a single dataframe due to the nature of CSV format.
-def df_to_csv(dataframe_dict, seperator):
-    # CSV doesn't support multi-sheets, so only one dataframe can be exported.
-    if len(dataframe_dict["filtered"]["df"].index) == 0: # If the dataframe is not filtered, export the unfiltered one.
-        df = dataframe_dict["unfiltered"]["df"]
+# These formats only hold a single dataframe. If the session is filtered, the filtered dataframe is exported, otherwise
+# the unfiltered one.
+def df_to_stream(db_entry, file_type, seperator):
+    if blob_store.has_blob(db_entry.get('filtered_dataframe')) and blob_store.count_rows(db, db_entry['filtered_dataframe']) > 0:
+        value = db_entry['filtered_dataframe']
+    elif 'transformed_dataframe' in db_entry:
+        value = db_entry['transformed_dataframe']
     else:
-        df = dataframe_dict["filtered"]["df"]
-    return Response(df.to_csv(sep=seperator, index=False, encoding='utf-8'), mimetype="text/csv", headers={"Content-disposition": "attachment; filename=dataframe.csv"})
+        value = db_entry['dataframe']
+    mimetype, filename = export_formats.EXPORT_FORMATS[file_type]
+    chunks = export_formats.stream_export(blob_store.get_blob(db, value), file_type, seperator)
+    return Response(chunks, mimetype=mimetype, headers={"Content-disposition": "attachment; filename=" + filename})
 
 
 #---
@@ -284,11 +295,12 @@ def df_to_csv(dataframe_dict, seperator):
 
 # It checks if the current db_entry is locked and creates a new entry if it is,
 # otherwise, it updates the existing entry with new information.
+# The new entry is a child of the locked one (see sessions.py). It stores the '$set' fields of the update and
+# inherits everything else.
 def upload_db_entry(db_entry, mongo_update, url):
     # If the entry is locked, indicate a need for creating a new entry to avoid overwriting.
     if 'locked' in db_entry and db_entry['locked'] == True:
-        db_entry['locked'] = False  # Unlock the db_entry for the new entry.
-        db_entry_id = db.visualizations.insert_one(db_entry).inserted_id  # Insert the new db_entry and get its ID.
+        db_entry_id = sessions.insert_child(db, url, mongo_update.get('$set', {}))  # Insert the new child entry and get its ID.
         #print('new entry!')
     else:
         db_entry_id = ObjectId(url)  # Use the existing db_entry's ID.
@@ -305,7 +317,7 @@ def upload_db_entry(db_entry, mongo_update, url):
 
 # Route to handle queries from the frontend. 
 # It filters the database based on the query provided.
-@app.route('/query', methods=['POST'])
+@routes.route('/query', methods=['POST'])
 
 
 #---
@@ -321,6 +333,7 @@ def search_query():
         # Dynamically import a custom module designed for applying filters to dataframes.
         # This module contains and applies query logic to the dataframe to produce a subset of the data based on the specified criteria.
         import filter_dataframe  # Load custom module.
+        import query_cache  # Results of previous queries, keyed by the dataframe and the query.
 
         # Extract the query and the unique identifier from the POST request data.
         query = json.loads(request.form['query'])
@@ -328,24 +341,38 @@ def search_query():
         
         # Retrieve the database entry for the visualization configuration using the provided unique identifier.
         # This entry includes the 'transformed_dataframe', which is the dataset to be filtered.
-        db_entry = db.visualizations.find_one({"_id": ObjectId(url)}, {'_id': False})
-
-        # Load the dataframe from its Parquet representation stored in MongoDB.
-        # Parquet is a columnar storage file format that supports efficient compression and encoding schemes.
-        df = pd.read_parquet(BytesIO(db_entry['transformed_dataframe']))  # Load the dataframe.
-        # print('query: ', query)
-
-        # Apply the user-defined query to filter the dataframe. The `filter_dataframe.main` function
-        # is assumed to take the query and the original dataframe as inputs and return a new dataframe
-        # that only contains the rows that match the query criteria.
-        filtered_df = filter_dataframe.main(query, df)  # Filter the dataframe based on the query.
+        db_entry = sessions.find_session(db, ObjectId(url), {'_id': False})
+
+        # If the same query already ran on the same dataframe, re-use its filtered dataframe from the blob store.
+        # The key has to be built before filter_dataframe.main, because it modifies the query.
+        cache_key = query_cache.make_key(blob_store.blob_id_of(db_entry['transformed_dataframe']), query)
+        cached = query_cache.get(cache_key)
+        if cached != None and not blob_store.blob_exists(db, cached[0]):
+            query_cache.discard(cache_key) # The filtered dataframe has been removed from the blob store in the meantime.
+            cached = None
+
+        metrics.QUERY_CACHE_REQUESTS.labels(result='hit' if cached != None else 'miss').inc()
+        if cached != None:
+            filtered_dataframe, query = cached
+        else:
+            # Load the dataframe from its Parquet representation in the blob store.
+            # Parquet is a columnar storage file format that supports efficient compression and encoding schemes.
+            df = blob_store.read_df(db, db_entry['transformed_dataframe'])  # Load the dataframe.
+            # print('query: ', query)
+
+            # Apply the user-defined query to filter the dataframe. The `filter_dataframe.main` function
+            # is assumed to take the query and the original dataframe as inputs and return a new dataframe
+            # that only contains the rows that match the query criteria.
+            filtered_df = filter_dataframe.main(query, df)  # Filter the dataframe based on the query.
+            filtered_dataframe = blob_store.store_df(db, filtered_df)
+            query_cache.put(cache_key, filtered_dataframe, query)
         
         # Prepare an update operation for the MongoDB document. This operation sets the new 'filtered_dataframe'
-        # (after converting it to Parquet and then to binary for storage), resets 'vis_links' to an empty list
+        # (after converting it to Parquet and storing it in the blob store), resets 'vis_links' to an empty list
         # (as the existing visualizations may no longer be relevant to the filtered data), and stores the query itself.
         mongo_update = {
             '$set': {
-                'filtered_dataframe': df_to_parquet(filtered_df),
+                'filtered_dataframe': filtered_dataframe,
                 'vis_links': [],
                 'query': query
             }
@@ -374,7 +401,7 @@ def search_query():
 #=============
     
 # Route to lock the session, preventing further modifications to the db_entry.
-@app.route('/locked', methods=['POST'])
+@routes.route('/locked', methods=['POST'])
 
 #---
 #FUNCTION: lock_session
@@ -419,7 +446,7 @@ def lock_session():
 #=============
     
 # Route to set the active plugin based on user selection.
-@app.route('/active_plugin', methods=['POST'])
+@routes.route('/active_plugin', methods=['POST'])
 
 
 #---
@@ -444,7 +471,7 @@ def set_active_plugin():
 
         # Retrieve the specific database entry for the visualization session using its unique identifier.
         # This entry contains current configuration data, including which plugin is currently active.
-        db_entry = db.visualizations.find_one({"_id": ObjectId(url)}, {'_id': False})
+        db_entry = sessions.find_session(db, ObjectId(url), {'_id': False})
 
         # Prepare the update operation to change the 'active_plugin_id' field to the new plugin's ID.
         # This operation specifies exactly how the document should be updated in the database.
@@ -474,7 +501,7 @@ def set_active_plugin():
 # This route handles the generation and retrieval of visualization links based on the dataset
 # and the plugin selected by the user. It serves as an endpoint for the front-end to request
 # visualization of data through specific visualization plugins.
-@app.route('/visualization', methods=['POST'])
+@routes.route('/visualization', methods=['POST'])
 
 #---
 # FUNCTION: make_vis_link
@@ -502,30 +529,39 @@ def make_vis_link():
         # This entry contains all necessary data and metadata for visualization, such as the dataset itself,
         # any applied filters, and visualization configurations.
         # POTENTIAL CHANGE: Right now every new visualization creates a new MongoDB entry
-        db_entry = db.visualizations.find_one({"_id": ObjectId(url)}, {'_id': False})
+        db_entry = sessions.find_session(db, ObjectId(url), {'_id': False})
 
         # Check if there is a filtered version of the dataset available. If so, use it for visualization.
         # This allows the visualization to reflect any filtering or data manipulation performed by the user.
         # If not, fallback to using the original (unfiltered) dataset.
-        if len(db_entry['filtered_dataframe']) > 0:
-            vis_link = visualize.route(db.plugins, pd.read_parquet(
-            BytesIO(db_entry['filtered_dataframe'])), plugin, ObjectId(url))
+        if blob_store.has_blob(db_entry['filtered_dataframe']):
+            frame = db_entry['filtered_dataframe']
         else:
-            vis_link = visualize.route(db.plugins, pd.read_parquet(
-            BytesIO(db_entry['transformed_dataframe'])), plugin, ObjectId(url))
+            frame = db_entry['transformed_dataframe']
 
         # Once the visualization link is generated, update the corresponding MongoDB document
-        # to include this new visualization link. This uses the '$push' operation to add the link
+        # to include this new visualization link. This uses the '$addToSet' operation to add the link
         # to an array of visualization links ('vis_links'), ensuring that multiple visualizations
-        # can be associated with a single dataset.
-        db.visualizations.update_one({'_id': ObjectId(url)}, {
-            '$push': {'vis_links': vis_link}})
-
-        #print(vis_link)
-
-        # Return the visualization link as a JSON response to the frontend, allowing the user to
-        # access the generated visualization.
-        return Response(dumps({'vis_link': vis_link}, allow_nan=True), mimetype="application/json")
+        # can be associated with a single dataset, but the same link is only stored once. A locked session must never
+        # change, so the link is not stored in it (the frontend receives the link anyway).
+        # The link is also remembered for the data it shows (see visualize.py).
+        key = visualize.memo_key(plugin, blob_store.blob_id_of(frame), url)
+        def store_vis_link(vis_link):
+            db.visualizations.update_one({'_id': ObjectId(url), 'locked': {'$ne': True}}, {
+                '$addToSet': {'vis_links': vis_link}})
+            visualize.remember_link(db.visualization_links, key, vis_link)
+
+        # The same data has already been visualized with this plugin, reuse the link instead of creating it again.
+        vis_link = visualize.find_link(db.visualization_links, key)
+        if vis_link != None:
+            store_vis_link(vis_link)
+            return Response(dumps({'vis_link': vis_link}, allow_nan=True), mimetype="application/json")
+
+        # The plugin runs in the background (see visualize.py), as it may wait for an external server.
+        # The frontend polls '/visualization/<visualization_id>' for the visualization link.
+        df = blob_store.read_df(db, frame)
+        visualization_id = visualize.submit(db.jobs, df, plugin, ObjectId(url), finish=store_vis_link, memo_key=key)
+        return Response(dumps({'visualization_id': visualization_id, 'status': 'queued'}, allow_nan=True), status=202, mimetype="application/json")
 
     # Handle any exceptions that might occur during the process, such as issues with data retrieval,
     # problems during the visualization generation process, or database update failures. Log the error
@@ -537,6 +573,34 @@ def make_vis_link():
 
 
 
+#=============
+# ROUTE '/visualization/<visualization_id>'
+#=============
+@routes.route('/visualization/<visualization_id>', methods=['GET'])
+
+#---
+# FUNCTION: visualization_status
+# PURPOSE: Returns the state of a visualization that is being created (queued, running, done or failed).
+#          A finished visualization holds the plugin name, the plugin ID and the link in 'vis_link', a failed one
+#          (including one that exceeded the timeout of its plugin) holds the error message.
+#---
+
+def visualization_status(visualization_id):
+    jobs.remove_expired(db.jobs)
+    job = visualize.status(db.jobs, visualization_id)
+    if job == None:
+        return Response(dumps({'error_type': ERROR_MESSAGES['visualization_error']['expected']['type'], 'error_message': 'The visualization {} does not exist or has expired.'.format(visualization_id)}), status=404, mimetype='application/json')
+    response_object = {'visualization_id': visualization_id, 'status': job['status']}
+    if job['status'] == 'done':
+        response_object['vis_link'] = job['result']
+    elif job['status'] == 'failed':
+        response_object['error_type'] = ERROR_MESSAGES['visualization_error']['expected']['type']
+        response_object['error_message'] = job['error']
+    return Response(dumps(response_object, allow_nan=True), mimetype='application/json')
+
+
+
+
 #=============
 # ROUTE '/plugins'
 #=============
@@ -544,7 +608,7 @@ def make_vis_link():
 # This route is dedicated to adding new visualization plugins into the system.
 # It handles the POST request containing plugin metadata and potentially an icon file,
 # saves the plugin data into MongoDB, and associates it with a specific visualization if provided.
-@app.route('/plugins', methods=['POST'])
+@routes.route('/plugins', methods=['POST'])
 
 
 #---
@@ -602,7 +666,7 @@ def add_plugin():
         #print('db_entry_id empty url:', db_entry_id)
     else:
         # If 'db_entry_id' is provided, fetch the existing visualization configuration from the database.
-        db_entry = db.visualizations.find_one({"_id": ObjectId(metadata['db_entry_id'])}, {'_id': False})
+        db_entry = sessions.find_session(db, ObjectId(metadata['db_entry_id']), {'_id': False})
 
         # Append the newly added plugin's ID to the existing visualization's list of plugins.
         plugins_id = db_entry['plugins_id']
@@ -626,7 +690,7 @@ def add_plugin():
 # ROUTE '/config'
 #=============
 
-@app.route('/config', methods=['GET', 'POST'])
+@routes.route('/config', methods=['GET', 'POST'])
 
 #---
 # FUNCTION: respond_config
@@ -648,7 +712,11 @@ def respond_config():
         #print('Object_ID: ', db_entry_id)  # Log the ObjectId for debugging purposes.
 
         # Retrieve the visualization configuration document from the MongoDB 'visualizations' collection.
-        db_entry = db.visualizations.find_one({"_id": db_entry_id})
+        db_entry = sessions.find_session(db, db_entry_id)
+
+        # Record that the session is still in use, so the retention keeps it. The date is not sent to the frontend.
+        retention.touch(db, db_entry_id)
+        db_entry.pop('last_used', None)
         
         # Convert the ObjectId to a string for JSON serialization compatibility.
         # print(len(bson.BSON.encode(db_entry)))
@@ -662,19 +730,17 @@ def respond_config():
         #     {'_id': {'$in': db_entry['plugins_id']}})]
         
         
-        # Check if the 'transformed_dataframe' field is stored as binary data (bytes).
+        # Check if the 'transformed_dataframe' field holds a dataframe (a blob reference or legacy binary data).
         # If so, convert it from its Parquet format to JSON for client-side use.
         # The conversion process replaces any NaN values with None to ensure JSON serialization compatibility.
-        if type(db_entry['transformed_dataframe']) == bytes: # The mockup db_entry stores the empty transformed_dataframe as a list, so don't convert that one.
+        if blob_store.has_blob(db_entry['transformed_dataframe']): # The mockup db_entry stores the empty transformed_dataframe as a list, so don't convert that one.
             # PERFORMANCE: We have to replace NaN cells with None for JSON.
-            db_entry['transformed_dataframe'] = pd.read_parquet(BytesIO(db_entry['transformed_dataframe'])).to_json(orient='records')
+            db_entry['transformed_dataframe'] = blob_store.read_df(db, db_entry['transformed_dataframe']).to_json(orient='records')
         # Attempt to convert the 'filtered_dataframe' in the same manner as 'transformed_dataframe',
         # if it exists. This field represents any user-applied filters on the dataset.
-        try:
+        if blob_store.has_blob(db_entry.get('filtered_dataframe')):
             # PERFORMANCE: We have to replace NaN cells with None for JSON.
-            db_entry['filtered_dataframe'] = pd.read_parquet(BytesIO(db_entry['filtered_dataframe'])).to_json(orient='records')
-        except:
-            pass  # If the 'filtered_dataframe' doesn't exist or an error occurs, ignore it.
+            db_entry['filtered_dataframe'] = blob_store.read_df(db, db_entry['filtered_dataframe']).to_json(orient='records')
         
         # Testing - For size benchmarks
         # import bson
@@ -698,6 +764,68 @@ def respond_config():
         return Response(dumps({'db_entry': db_entry}, allow_nan=True), mimetype="application/json")
 
 
+#=============
+# ROUTE '/config/arrow'
+#=============
+
+@routes.route('/config/arrow', methods=['GET', 'POST'])
+
+#---
+# FUNCTION: respond_config_arrow
+# PURPOSE: Binary variant of '/config' for the dataframes of a session. Instead of JSON records, the dataframe is
+#          returned as an Arrow IPC stream, which is much smaller and can be read by the client without parsing.
+# PARAMETERS (form or query string):
+#   url: The unique identifier of the visualization session, as for '/config'.
+#   frame: 'transformed' (default) or 'filtered'.
+#   columns: Optional JSON list of the columns to return. Only these columns are read from the blob store.
+#   start, stop: Optional row range [start, stop) to return.
+#   batch_size: Optional number of rows per record batch (ARROW_BATCH_SIZE by default).
+# RETURNS: The Arrow IPC stream (application/vnd.apache.arrow.stream). The record batches are sent as soon as they are
+#          encoded. The header 'X-Total-Rows' holds the number of rows of the whole dataframe, for paging.
+#---
+
+def respond_config_arrow():
+    try:
+        db_entry_id = ObjectId(loads(request.values['url']))
+        frame = request.values.get('frame', 'transformed')
+        if frame not in ('transformed', 'filtered'):
+            raise ValueError("Unknown frame '{}'. Use 'transformed' or 'filtered'.".format(frame))
+        # Only load the requested dataframe field of the session.
+        db_entry = sessions.find_session(db, db_entry_id, {frame + '_dataframe': True})
+        if db_entry == None:
+            raise ValueError('The session {} does not exist.'.format(db_entry_id))
+
+        columns = json.loads(request.values['columns']) if request.values.get('columns') else None
+        table = blob_store.read_table(db, db_entry.get(frame + '_dataframe'), columns=columns)
+        if table is None:
+            raise ValueError('The session has no {} dataframe.'.format(frame))
+
+        # Select the row range. Slicing a Table does not copy any data.
+        total_rows = table.num_rows
+        start = max(0, int(request.values.get('start', 0)))
+        stop = min(total_rows, int(request.values.get('stop', total_rows)))
+        table = table.slice(start, max(0, stop - start))
+
+        batch_size = int(request.values.get('batch_size', ARROW_BATCH_SIZE))
+        response = Response(arrow_stream(table, batch_size), mimetype='application/vnd.apache.arrow.stream')
+        response.headers['X-Total-Rows'] = str(total_rows)
+        return response
+    except Exception as e:
+        print(str(e))
+        return respond_error(ERROR_MESSAGES['config_error']['expected']['type'], str(e))
+
+
+#---
+# FUNCTION: arrow_stream
+# PURPOSE: Encodes a pyarrow Table as an Arrow IPC stream, yielding the schema and then each record batch.
+#---
+
+def arrow_stream(table, batch_size):
+    import pyarrow as pa
+    import export_formats
+    return export_formats.writer_chunks(lambda sink: pa.ipc.new_stream(sink, table.schema), table.to_batches(max_chunksize=max(1, batch_size)))
+
+
 #---
 # FUNCTION: respond_error
 # PURPOSE: Error handling 
@@ -710,7 +838,7 @@ def respond_error(error_type, error_message):
 #=============
 # ROUTE '/upload'
 #=============
-@app.route('/upload', methods=['GET', 'POST'])
+@routes.route('/upload', methods=['GET', 'POST'])
 
 #---
 # FUNCTION: add_matrix
@@ -735,17 +863,201 @@ def add_matrix():
         # Call the helper function `upload_file` to process the data file upload or text input based on the provided metadata.
         source, extension = upload_file(request, ALLOWED_EXTENSIONS_MATRIX, metadata)
 
-        # Integrate the uploaded matrix into the system by adding it to the appropriate visualization configuration.
-        db_entry_id = process_file.add_matrix(source, metadata, extension, db, PRE_CONFIGURED_PLUGINS)
+        # The uploaded file is only available during the request, so it is saved to a temporary file for the job.
+        source, temporary_file = spool_upload(source, extension)
 
-        # Return the ID of the updated or newly created database entry as a JSON response.
-        return Response(dumps({'db_entry_id': db_entry_id}, allow_nan=True), mimetype='application/json')
+        # Integrate the uploaded matrix into the system by adding it to the appropriate visualization configuration.
+        # This runs as a background job (see jobs.py), the frontend polls '/jobs/<job_id>' for the ID of the database entry.
+        def add_matrix_job(source, metadata, extension):
+            return {'db_entry_id': process_file.add_matrix(source, metadata, extension, db, PRE_CONFIGURED_PLUGINS)}
+        cleanup = (lambda: os.remove(temporary_file)) if temporary_file != None else None
+        # If this request is profiled, the job is profiled as well (see profiling.py).
+        if profiling.current_profile_id() != None:
+            add_matrix_job = profiling.profiled(db, add_matrix_job, '/upload', metadata['db_entry_id'] or None, profiling.current_profile_id())
+        try:
+            job_id = jobs.submit(db.jobs, 'upload', add_matrix_job, source, metadata, extension, cleanup=cleanup)
+        except Exception:
+            if cleanup != None:
+                cleanup()
+            raise
+
+        # Return the ID of the job as a JSON response.
+        return Response(dumps({'job_id': job_id, 'status': 'queued'}, allow_nan=True), status=202, mimetype='application/json')
     except Exception as e:
         # Handle any exceptions that occur during the upload process and return an error message.
         print(str(e))
         return respond_error(ERROR_MESSAGES['upload_error']['expected']['type'], str(e))
 
 
+
+#---
+# FUNCTION: spool_upload
+# PURPOSE: Saves an uploaded file to a temporary file, so it can be read after the request has ended.
+# RETURNS: A tuple of the source to pass to process_file.add_matrix and the path of the temporary file
+#          (None for pasted text and bundled database files, which don't need one).
+#---
+
+def spool_upload(source, extension):
+    if not hasattr(source, 'save'):
+        return source, None
+    import tempfile
+    descriptor, temporary_file = tempfile.mkstemp(suffix=extension, prefix='micromix-upload-')
+    os.close(descriptor)
+    source.save(temporary_file)
+    return temporary_file, temporary_file
+
+
+
+#=============
+# ROUTE '/chunked_upload'
+#=============
+@routes.route('/chunked_upload', methods=['POST'])
+
+#---
+# FUNCTION: start_chunked_upload
+# PURPOSE: Starts the upload of a file that is sent in chunks (see chunked_uploads.py), for files above the size limit
+#          of a single request. The form holds the 'filename' and the 'size' of the file in bytes.
+# RETURNS: The upload ID, the chunk size and the number of chunks the frontend has to send.
+#---
+
+def start_chunked_upload():
+    chunked_uploads.remove_expired(db.chunked_uploads)
+    try:
+        upload = chunked_uploads.start(db.chunked_uploads, request.form['filename'], int(request.form['size']), ALLOWED_EXTENSIONS_MATRIX)
+    except (KeyError, ValueError) as e:
+        return respond_upload_error(str(e), 400)
+    return Response(dumps(upload), status=201, mimetype='application/json')
+
+
+
+#=============
+# ROUTE '/chunked_upload/<upload_id>'
+#=============
+@routes.route('/chunked_upload/<upload_id>', methods=['GET', 'DELETE'])
+
+#---
+# FUNCTION: chunked_upload_status
+# PURPOSE: Returns how many chunks of an upload have been received, so an interrupted upload can be resumed with the
+#          next chunk. DELETE cancels the upload and removes what has been received.
+#---
+
+def chunked_upload_status(upload_id):
+    upload = chunked_uploads.find(db.chunked_uploads, upload_id)
+    if upload == None:
+        return respond_upload_error('The upload {} does not exist or has expired.'.format(upload_id), 404)
+    if request.method == 'DELETE':
+        if upload['status'] == 'committed':
+            return respond_upload_error('The upload {} is already being processed.'.format(upload_id), 409)
+        chunked_uploads.remove(db.chunked_uploads, upload_id)
+        return Response(dumps({'upload_id': upload_id, 'status': 'removed'}), mimetype='application/json')
+    return Response(dumps(chunked_uploads.describe(upload)), mimetype='application/json')
+
+
+
+#=============
+# ROUTE '/chunked_upload/<upload_id>/<int:index>'
+#=============
+@routes.route('/chunked_upload/<upload_id>/<int:index>', methods=['PUT'])
+
+#---
+# FUNCTION: receive_chunk
+# PURPOSE: Receives one chunk of an upload. The body of the request holds the bytes of the chunk.
+# RETURNS: The state of the upload. A chunk that is not the next one is rejected with 409 and the state of the upload,
+#          so the frontend can continue with the chunk the backend expects.
+#---
+
+def receive_chunk(upload_id, index):
+    try:
+        upload = chunked_uploads.write_chunk(db.chunked_uploads, upload_id, index, request.stream)
+    except KeyError as e:
+        return respond_upload_error(e.args[0], 404)
+    except ValueError as e:
+        upload = chunked_uploads.describe(chunked_uploads.find(db.chunked_uploads, upload_id))
+        return Response(dumps(dict(upload, error_type=ERROR_MESSAGES['upload_error']['expected']['type'], error_message=str(e))),
+                        status=409, mimetype='application/json')
+    return Response(dumps(upload), mimetype='application/json')
+
+
+
+#=============
+# ROUTE '/chunked_upload/<upload_id>/commit'
+#=============
+@routes.route('/chunked_upload/<upload_id>/commit', methods=['POST'])
+
+#---
+# FUNCTION: commit_chunked_upload
+# PURPOSE: Processes a complete chunked upload like '/upload' does with a file: the form holds the same metadata, and
+#          the matrix is added by a background job, whose ID is returned.
+# NOTES: CSV and TSV files are converted to parquet block by block first (see chunked_uploads.prepare_source), so the
+#        text of a large file is never parsed at once.
+#---
+
+def commit_chunked_upload(upload_id):
+    try:
+        metadata = json.loads(request.form['form'])
+    except (KeyError, ValueError):
+        return respond_upload_error('The form of the upload is missing.', 400)
+    try:
+        upload = chunked_uploads.commit(db.chunked_uploads, upload_id)
+    except KeyError as e:
+        return respond_upload_error(e.args[0], 404)
+    except ValueError as e:
+        return respond_upload_error(str(e), 409)
+
+    def add_matrix_job(upload, metadata):
+        source, extension = chunked_uploads.prepare_source(upload, metadata)
+        return {'db_entry_id': process_file.add_matrix(source, metadata, extension, db, PRE_CONFIGURED_PLUGINS)}
+    cleanup = lambda: chunked_uploads.remove(db.chunked_uploads, upload_id)
+    heartbeat = lambda: chunked_uploads.touch(db.chunked_uploads, upload_id)
+    # If this request is profiled, the job is profiled as well (see profiling.py).
+    if profiling.current_profile_id() != None:
+        add_matrix_job = profiling.profiled(db, add_matrix_job, '/chunked_upload', metadata['db_entry_id'] or None, profiling.current_profile_id())
+    try:
+        job_id = jobs.submit(db.jobs, 'upload', add_matrix_job, upload, metadata, cleanup=cleanup, heartbeat=heartbeat)
+    except Exception as e:
+        # The upload is kept, so the commit can be repeated when the queue has space again
+        db.chunked_uploads.update_one({'_id': upload_id}, {'$set': {'status': 'receiving'}})
+        return respond_upload_error(str(e), 503)
+    return Response(dumps({'job_id': job_id, 'status': 'queued'}, allow_nan=True), status=202, mimetype='application/json')
+
+
+
+#---
+# FUNCTION: respond_upload_error
+# PURPOSE: Returns an upload error with an HTTP status, for the routes of the chunked uploads.
+#---
+
+def respond_upload_error(error_message, status):
+    return Response(dumps({'error_type': ERROR_MESSAGES['upload_error']['expected']['type'], 'error_message': error_message}),
+                    status=status, mimetype='application/json')
+
+
+
+#=============
+# ROUTE '/jobs/<job_id>'
+#=============
+@routes.route('/jobs/<job_id>', methods=['GET'])
+
+#---
+# FUNCTION: job_status
+# PURPOSE: Returns the state of a background job (queued, running, done or failed).
+#          A finished upload job holds the ID of the database entry in 'result', a failed job holds the error message.
+#---
+
+def job_status(job_id):
+    jobs.remove_expired(db.jobs)
+    job = jobs.status(db.jobs, job_id)
+    if job == None:
+        return Response(dumps({'error_type': ERROR_MESSAGES['upload_error']['expected']['type'], 'error_message': 'The job {} does not exist or has expired.'.format(job_id)}), status=404, mimetype='application/json')
+    response_object = {'job_id': job_id, 'status': job['status']}
+    if job['status'] == 'done':
+        response_object['result'] = job['result']
+    elif job['status'] == 'failed':
+        response_object['error_type'] = ERROR_MESSAGES['upload_error']['expected']['type']
+        response_object['error_message'] = job['error']
+    return Response(dumps(response_object, allow_nan=True), mimetype='application/json')
+
+
 #---
 # FUNCTION: respond_data
 # PURPOSE: Helper function to return a standardized success response with additional payload data. 
@@ -809,7 +1121,7 @@ def upload_file(request, extension_whitelist, metadata):
 #=============
 # ROUTE '/uploads/<filename>'
 #=============
-@app.route('/uploads/<filename>')
+@routes.route('/uploads/<filename>')
 
 #---
 # FUNCTION: uploaded_file
@@ -830,7 +1142,7 @@ def uploaded_file(filename):
     # mitigating potential security risks associated with file serving.
     # The `app.config['UPLOAD_FOLDER']` variable contains the path to the directory from which files are served,
     # which should be configured securely within the application settings.
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
 
 
 
@@ -838,7 +1150,7 @@ def uploaded_file(filename):
 #=============
 # ROUTE '/matrix/<matrix_id>'
 #=============
-@app.route('/matrix/<matrix_id>', methods=['GET', 'POST'])
+@routes.route('/matrix/<matrix_id>', methods=['GET', 'POST'])
 
 #---
 # FUNCTION: remove_matrix
@@ -879,45 +1191,140 @@ def remove_matrix(matrix_id):
 
 
 
+#=============
+# ROUTE '/ready'
+#=============
+@routes.route('/ready', methods=['GET'])
+
 #---
-# FUNCTION: df_to_parquet
-# PURPOSE:  This function converts a given pandas DataFrame to a Parquet file format and then encapsulates
-#           the Parquet data into a binary format. The binary format is suitable for storage in MongoDB,
-#           which allows for efficient serialization and deserialization of structured data like Parquet files.
-#           Parquet is a columnar storage file format optimized for fast retrieval of columns of data,
-#           not only saving storage space but also improving I/O efficiency compared to row-based formats like CSV.
+# FUNCTION: ready
+# PURPOSE: Readiness check for load balancers and container orchestration. The backend is ready if MongoDB can be
+#          reached. Returns status 503 otherwise, so no requests are sent to this instance.
 #---
 
-def df_to_parquet(df):
-    # Import the necessary module to handle binary data in Python.
-    # The Binary class specifically caters to binary data storage in MongoDB.
-    from bson.binary import Binary
+def ready():
+    try:
+        mongo.ping()
+        return Response(dumps({'status': 'ready'}), mimetype="application/json")
+    except Exception as e:
+        print('Not ready: ', str(e))
+        return Response(dumps({'status': 'unavailable', 'error_message': str(e)}), status=503, mimetype="application/json")
 
-    # Create a BytesIO object, which is essentially an in-memory binary stream.
-    # This object serves as a temporary storage for the Parquet data, allowing us
-    # to perform operations on the data before it's finalized for storage.
-    output = BytesIO()
 
-    # Convert the pandas DataFrame to Parquet format and write the data to our BytesIO stream.
-    # The 'to_parquet' function serializes the DataFrame as a Parquet, directly into the binary stream.
-    df.to_parquet(output)
 
-    # Reset the stream position to the beginning after writing.
-    # This step is crucial for ensuring that subsequent read operations on the stream
-    # start from the beginning of the data.
-    output.seek(0)
 
-    # The commented-out line appears to be a leftover from testing the function's correctness
-    # by demonstrating how to read a Parquet file from a BytesIO stream back into a DataFrame.
-    # This step isn't necessary for the purpose of converting and storing the DataFrame
-    # but serves as a good reference for how to reverse the operation.
-    # df = pd.read_parquet(BytesIO(test))
+#=============
+# ROUTE '/metrics'
+#=============
+@routes.route('/metrics', methods=['GET'])
 
+#---
+# FUNCTION: respond_metrics
+# PURPOSE: Returns the Prometheus metrics of the backend (request latency, parquet timings, filter stages, document and
+#          blob sizes, plugin dispatch). See metrics.py.
+#---
 
-    # Convert the binary stream into a BSON binary object, which is the format expected by MongoDB
-    # for storing binary data. This encapsulation makes the Parquet data ready for storage
-    # in a MongoDB collection.
-    return Binary(output.getvalue())
+def respond_metrics():
+    data, content_type = metrics.latest()
+    return Response(data, content_type=content_type)
 
 
-#client.close()
+
+
+#=============
+# ROUTE '/profiles'
+#=============
+@routes.route('/profiles', methods=['GET'])
+
+#---
+# FUNCTION: list_profiles
+# PURPOSE: Lists the stored profiles of single requests (see profiling.py), the newest first. The profiles can be filtered
+#          by 'route' and 'session_id', 'limit' sets their maximum number. Needs an allowed profiling token.
+#---
+
+def list_profiles():
+    if not profiling.request_is_allowed():
+        return respond_profiling_forbidden()
+    profiles = profiling.list_profiles(db, request.args.get('route'), request.args.get('session_id'), int(request.args.get('limit', 100)))
+    return Response(dumps({'profiles': profiles}, allow_nan=True), mimetype="application/json")
+
+
+
+
+#=============
+# ROUTE '/profiles/<profile_id>'
+#=============
+@routes.route('/profiles/<profile_id>', methods=['GET'])
+
+#---
+# FUNCTION: download_profile
+# PURPOSE: Downloads a stored profile as a .prof file (pstats format), or as a text summary with '?format=text'.
+#          Needs an allowed profiling token.
+#---
+
+def download_profile(profile_id):
+    if not profiling.request_is_allowed():
+        return respond_profiling_forbidden()
+    profile = profiling.get_profile(db, profile_id)
+    if profile == None:
+        return Response(dumps({'error_type': ERROR_MESSAGES['profiling_error']['expected']['type'], 'error_message': ERROR_MESSAGES['profiling_error']['expected']['message']}), status=404, mimetype='application/json')
+    if request.args.get('format') == 'text' or 'stats' not in profile:
+        return Response(profile['summary'], mimetype='text/plain')
+    response = Response(bytes(profile['stats']), mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename={}.prof'.format(profile_id)
+    return response
+
+
+#---
+# FUNCTION: respond_profiling_forbidden
+# PURPOSE: Helper function to reject a request to the profiles without an allowed token.
+#---
+
+def respond_profiling_forbidden():
+    return Response(dumps({'error_type': ERROR_MESSAGES['profiling_error']['forbidden']['type'], 'error_message': ERROR_MESSAGES['profiling_error']['forbidden']['message']}), status=403, mimetype='application/json')
+
+
+
+
+#---
+# FUNCTION: create_app
+# PURPOSE: Application factory. Creates and configures the Flask application and connects it to MongoDB.
+# NOTES: 'flask run' finds this function by itself. gunicorn calls it once per worker process ('app:create_app()').
+#---
+
+def create_app():
+    global db
+    # # instantiate the app
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+
+    # Configure Cross-Origin Resource Sharing (CORS) to allow all origins. This should be restricted in production.
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # Limit file size to prevent denial-of-service attacks
+    app.config['FLASK_DEBUG'] = 1 if DEBUG else 0
+    app.config['DEBUG'] = DEBUG
+    CORS(app, resources={r"/*":{"origins": "*"}}, expose_headers=['X-Total-Rows'])
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+    # Measure the latency of every request (see metrics.py).
+    metrics.init_app(app)
+
+    # Select the 'micromix' database within MongoDB for storing and retrieving application data.
+    if db == None:
+        db = mongo.get_db()
+
+    # Profile the requests that ask for it with an allowed token (see profiling.py).
+    profiling.init_app(app, db)
+
+    # Import the visualization plugins once, instead of with every visualization (see visualize.py).
+    visualize.load_plugins()
+    app.register_blueprint(routes)
+    return app
+
+
+
+# Entry point for the Flask application.
+# Ensure the Flask server runs in debug mode on 0.0.0.0, making it accessible on all network interfaces.
+# The server listens on port specified by the PORT environment variable, defaulting to 8080 if not set.
+if __name__ == '__main__':
+    create_app().run(debug=DEBUG, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+#--------------------------------
+#
+# Check that the incremental merge gives the same DataFrame as the full rebuild
+#
+#--------------------------------
+
+# In the 'incremental' MERGE_MODE, process_file.update_merged_entry joins an added matrix into the current
+# merged DataFrame instead of rebuilding it from every matrix (merge_db_entry). Both have to give the same DataFrame.
+# This script checks the cases in which the two differ unless update_merged_entry falls back to the rebuild:
+#   - A matrix is added in a slot before other matrices (e.g. C in slot 1 of [A, B]).
+#   - A removed matrix shares a column with some of the other matrices (e.g. B of [A, B, C], B and C share 'Name').
+# Afterwards, random sequences of additions (in any slot) and removals are checked (see --sequences). The DataFrames have to
+# be equal, including the order of the rows and columns and the dtypes.
+#
+# Like run_benchmarks.py, it needs no MongoDB server (pip install mongomock), the blobs are stored in a temporary folder.
+#   python benchmarks/check_merge_modes.py --sequences 200
+
+import os
+import sys
+import shutil
+import random
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+
+
+# Configuration
+KEY_COLUMN = 'Locus Tag' # Shared by every matrix, like the locus tag column of the bundled files
+SHARED_COLUMNS = ('Name', 'gene', 'product') # Text columns that only some of the matrices have
+MAX_MATRICES = 5
+
+
+
+#---
+# FUNCTION: main
+# PURPOSE: Runs the named cases and the random sequences, exits with 1 if any result differs from the rebuild.
+#---
+def main():
+    parser = argparse.ArgumentParser(description='Compares the incremental merge with the full rebuild.')
+    parser.add_argument('--sequences', type=int, default=100, help='Random sequences of changes (default: 100).')
+    parser.add_argument('--steps', type=int, default=8, help='Changes per random sequence (default: 8).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random sequences (default: 0).')
+    args = parser.parse_args()
+    os.chdir(BACKEND_FOLDER)
+    work_folder = tempfile.mkdtemp(prefix='micromix-merge-check-')
+    # The backend modules read their settings when they are imported, so they are only imported after this.
+    os.environ['MICROMIX_BLOB_STORE'] = 'filesystem'
+    os.environ['MICROMIX_BLOB_STORE_PATH'] = os.path.join(work_folder, 'blobs')
+    os.environ['MICROMIX_MERGE_MODE'] = 'incremental'
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit('mongomock is not installed. Install it (pip install mongomock).')
+    global process_file, experimental_features
+    import process_file
+    import experimental_features
+    db = mongomock.MongoClient()['micromix_merge_check']
+    failures = 0
+    try:
+        rng = np.random.default_rng(args.seed)
+        a = make_matrix(db, 'A', rng, [KEY_COLUMN, 'Name'])
+        b = make_matrix(db, 'B', rng, [KEY_COLUMN])
+        c = make_matrix(db, 'C', rng, [KEY_COLUMN, 'gene'])
+        failures += check('Adding C in slot 1 of [A, B]', db, [a, b], [a, c, b], [], c)
+        a = make_matrix(db, 'A', rng, [KEY_COLUMN])
+        b = make_matrix(db, 'B', rng, [KEY_COLUMN, 'Name'])
+        c = make_matrix(db, 'C', rng, [KEY_COLUMN, 'Name'])
+        failures += check("Removing B from [A, B, C], B and C share 'Name'", db, [a, b, c], [a, c], [b], None)
+        a = make_matrix(db, 'A', rng, [KEY_COLUMN, 'Name'])
+        b = make_matrix(db, 'B', rng, [KEY_COLUMN, 'Name'])
+        c = make_matrix(db, 'C', rng, [KEY_COLUMN])
+        failures += check('Adding C in the last slot of [A, B]', db, [a, b], [a, b, c], [], c)
+        failures += check('Removing C from [A, B, C]', db, [a, b, c], [a, b], [c], None)
+
+        random.seed(args.seed)
+        for sequence in range(args.sequences):
+            failures += check_sequence(db, rng, sequence, args.steps)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    print('{} differences'.format(failures))
+    if failures > 0:
+        sys.exit(1)
+
+
+
+#---
+# FUNCTION: make_matrix
+# PURPOSE: Stores a small random matrix and returns it in the form of the matrices in active_matrices.
+# PARAMETERS:
+#   db: The database, used to store the DataFrame.
+#   title: The title of the matrix, prefixed to its numeric columns (see process_file.rename_df_columns).
+#   rng: The random number generator.
+#   text_columns: The text columns of the matrix.
+# NOTES: The keys overlap between the matrices and some are duplicated, so the merge adds and multiplies rows.
+#---
+def make_matrix(db, title, rng, text_columns):
+    rows = int(rng.integers(3, 12))
+    df = pd.DataFrame({column: rng.choice(['{}{}'.format(column[0], i) for i in range(8)], rows) for column in text_columns})
+    for i in range(int(rng.integers(1, 3))):
+        df['({}) sample_{}'.format(title, i)] = rng.integers(0, 100, rows).astype(float)
+    # Like in convert_to_df, the dtypes are reduced (e.g. uint8, category). The merge changes them if values are missing.
+    df = experimental_features.adjust_numeric_dtype(df)
+    return {'id': '{}-{}'.format(title, rng.integers(1 << 30)), 'dataframe': process_file.blob_store.store_df(db, df)}
+
+
+
+#---
+# FUNCTION: check
+# PURPOSE: Applies a change incrementally and compares the result with the rebuild. Returns 1 if they differ, else 0.
+# PARAMETERS:
+#   name: The name of the case, printed with the result.
+#   db: The database.
+#   before: The matrices before the change, in slot order.
+#   after: The matrices after the change, in slot order.
+#   removed: The matrices that are removed (or replaced).
+#   added: The matrix that is added, or None.
+#---
+def check(name, db, before, after, removed, added):
+    db_entry = process_file.merge_db_entry({'active_matrices': [[matrix] for matrix in before]}, before, db)
+    db_entry['active_matrices'] = [[matrix] for matrix in after]
+    added_df = None if added == None else process_file.blob_store.read_df(db, added['dataframe'])
+    incremental = process_file.blob_store.read_df(db, process_file.update_merged_entry(db_entry, removed, added_df, db)['transformed_dataframe'])
+    rebuild = process_file.blob_store.read_df(db, process_file.merge_db_entry({}, after, db)['transformed_dataframe'])
+    try:
+        pd.testing.assert_frame_equal(incremental, rebuild)
+    except AssertionError as error:
+        print('FAIL {}\n{}'.format(name, error))
+        return 1
+    if name != None:
+        print('ok   {}'.format(name))
+    return 0
+
+
+
+#---
+# FUNCTION: check_sequence
+# PURPOSE: Checks a random sequence of additions (in a random slot) and removals. Returns the number of differences.
+#---
+def check_sequence(db, rng, sequence, steps):
+    matrices = []
+    failures = 0
+    for step in range(steps):
+        if len(matrices) > 1 and (len(matrices) == MAX_MATRICES or random.random() < 0.4):
+            removed = random.choice(matrices)
+            after = [matrix for matrix in matrices if matrix is not removed]
+            failures += check(None, db, matrices, after, [removed], None)
+        else:
+            text_columns = [KEY_COLUMN] + random.sample(SHARED_COLUMNS, random.randint(0, len(SHARED_COLUMNS)))
+            added = make_matrix(db, chr(ord('A') + step), rng, text_columns)
+            after = list(matrices)
+            after.insert(random.randint(0, len(matrices)), added)
+            if len(matrices) > 0:
+                failures += check(None, db, matrices, after, [], added)
+        matrices = after
+    if failures > 0:
+        print('FAIL sequence {}'.format(sequence))
+    return failures
+
+
+
+if __name__ == '__main__':
+    main()
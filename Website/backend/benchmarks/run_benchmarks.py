@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+#--------------------------------
+#
+# Benchmarks of the backend with synthetic expression matrices
+#
+#--------------------------------
+
+# Times the expensive steps of a session on matrices from 5,000 to 200,000 rows and 10 to 2,000 columns
+# (see synthetic_matrices.py):
+#   add_matrix (new session)        process_file.add_matrix with a new session (parse, optimize dtypes, store).
+#   add_matrix (existing session)   process_file.add_matrix of a second matrix into the session (merge).
+#   merge_db_entry                  The full rebuild of the merged dataframe of the session.
+#   filter: <name>                  filter_dataframe.main with each of the QUERIES on the merged dataframe.
+#   /config, /config/arrow          The serialization of the session for the frontend.
+#   /export <format>                The export of the merged dataframe in each streamed format.
+#
+# The benchmarks need no MongoDB server. By default, they use mongomock (pip install mongomock), a MongoDB stand-in in
+# memory. With '--mongo mongod', a temporary mongod is started (the 'mongod' binary has to be installed), and with
+# '--mongo-uri', an existing server is used (a database 'micromix_benchmark' is created and removed again).
+# The blobs are stored in a temporary folder (MICROMIX_BLOB_STORE=filesystem), unless MICROMIX_BLOB_STORE is set.
+#
+# The results are saved as JSON (see --output), together with the versions and settings of the run. Comparing them with
+# the results of an earlier run lists every benchmark that became slower:
+#   python benchmarks/run_benchmarks.py --sizes 5000x10,50000x200 --output new.json --compare old.json
+#
+# The script can be started from any folder, relative paths are resolved against the current folder.
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+import synthetic_matrices
+
+
+# Configuration
+DEFAULT_SIZES = '5000x10,5000x2000,50000x200,200000x10,200000x200' # Add 200000x2000 on a machine with > 32 GB of memory
+BENCHMARK_DATABASE = 'micromix_benchmark'
+MONGOD_START_TIMEOUT = 30 # Seconds
+TITLES = ('bench', 'second') # The titles of the two matrices of a session
+
+# Representative queries, as sent by the frontend. '{ids}' is replaced with identifiers of the first text column.
+QUERIES = {
+    'gene list': [[{'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '{ids}', 'logical_operator': '= equal to', 'filter_area': ['any column']}}]],
+    'expression > 100 in any column': [[{'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '100', 'logical_operator': '> more than', 'filter_area': ['any column']}}]],
+    'expression > 10 in all columns': [[{'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '10', 'logical_operator': '> more than', 'filter_area': ['all columns']}}]],
+    'range with and': [[{'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '5', 'logical_operator': '> more than', 'filter_area': ['any column']}},
+                        {'name': 'logic', 'properties': {'type': 'logic'}, 'forms': {'operator': 'and'}},
+                        {'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '1000', 'logical_operator': '< less than', 'filter_area': ['all columns']}}]],
+    'values < 5': [[{'name': 'Filter values', 'properties': {'type': 'row_filter', 'query': 'expression'}, 'forms': {'filter_value': '5', 'logical_operator': '< less than', 'filter_area': ['any column']}}]],
+    'log2 and filter': [[{'name': 'Convert to log', 'properties': {'type': 'logarithmic', 'query': 'log_value'}, 'forms': {'target_table': TITLES[0], 'log_value': '2'}},
+                         {'name': 'Filter genes', 'properties': {'type': 'filter', 'query': 'expression'}, 'forms': {'filter_value': '3', 'logical_operator': '> more than', 'filter_area': ['all columns']}}]],
+}
+QUERY_GENE_COUNT = 30 # Identifiers in the 'gene list' query
+
+
+
+#---
+# FUNCTION: main
+# PURPOSE: Runs the benchmarks for every size and saves the results.
+#---
+def main():
+    args = parse_arguments()
+    os.chdir(BACKEND_FOLDER)
+    work_folder = tempfile.mkdtemp(prefix='micromix-benchmark-')
+    # The backend modules read their settings when they are imported, so they are only imported after this.
+    os.environ.setdefault('MICROMIX_BLOB_STORE', 'filesystem')
+    os.environ.setdefault('MICROMIX_BLOB_STORE_PATH', os.path.join(work_folder, 'blobs'))
+    mongod = None
+    db = None
+    try:
+        if args.mongo == 'mongod' and args.mongo_uri == None:
+            mongod, args.mongo_uri = start_mongod(work_folder)
+        db = connect(args)
+        schema = synthetic_matrices.read_schema(args.schema)
+        run = {
+            'created': datetime.utcnow().isoformat() + 'Z',
+            'environment': describe_environment(args),
+            'schema': schema,
+            'results': [],
+        }
+        for rows, columns in parse_sizes(args.sizes):
+            print('{} rows x {} columns'.format(rows, columns))
+            run['results'] += benchmark_size(db, schema, rows, columns, args, work_folder)
+            clear_database(db)
+            save_results(run, args.output)
+        print('Saved the results to {}'.format(args.output))
+        if args.compare != None:
+            regressions = compare_results(load_results(args.compare), run, args.threshold)
+            if len(regressions) > 0:
+                sys.exit(1)
+    finally:
+        if db != None and args.mongo_uri != None:
+            clear_database(db)
+            db.client.drop_database(BENCHMARK_DATABASE)
+        if mongod != None:
+            mongod.terminate()
+            mongod.wait()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+
+#---
+# FUNCTION: parse_arguments
+# PURPOSE: Parses the command line.
+#---
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks of the Micromix backend with synthetic expression matrices.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Comma-separated list of ROWSxCOLUMNS (default: '{}').".format(DEFAULT_SIZES))
+    parser.add_argument('--repeat', type=int, default=3, help='How often each benchmark is run (default: 3).')
+    parser.add_argument('--schema', default=None, help='The bundled file the matrices are modelled on (default: {}).'.format(synthetic_matrices.SCHEMA_FILE))
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic values (default: 0).')
+    parser.add_argument('--mongo', choices=('mongomock', 'mongod'), default='mongomock', help='The MongoDB stand-in (default: mongomock).')
+    parser.add_argument('--mongo-uri', default=None, help='Use an existing MongoDB server instead, e.g. mongodb://localhost:27017.')
+    parser.add_argument('--output', default=None, help='The JSON file of the results (default: benchmarks/results/<date>.json).')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run. Exits with 1 if a benchmark became slower.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Ratio of the median times that counts as slower (default: 1.25).')
+    args = parser.parse_args()
+    # Paths are given relative to the folder the script is started from.
+    if args.schema == None:
+        args.schema = os.path.join(BACKEND_FOLDER, synthetic_matrices.SCHEMA_FILE)
+    if args.output == None:
+        args.output = os.path.join(BACKEND_FOLDER, 'benchmarks', 'results', datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.json')
+    args.schema = os.path.abspath(args.schema)
+    args.output = os.path.abspath(args.output)
+    if args.compare != None:
+        args.compare = os.path.abspath(args.compare)
+    return args
+
+
+
+#---
+# FUNCTION: parse_sizes
+# PURPOSE: Parses the sizes of the matrices, e.g. '5000x10,50000x200' -> [(5000, 10), (50000, 200)].
+#---
+def parse_sizes(sizes):
+    parsed = []
+    for size in sizes.split(','):
+        rows, columns = size.strip().lower().split('x')
+        parsed.append((int(rows), int(columns)))
+    return parsed
+
+
+
+#---
+# FUNCTION: start_mongod
+# PURPOSE: Starts a temporary mongod on a free port, with its data in the work folder.
+# RETURNS: A tuple of the process and its URI.
+#---
+def start_mongod(work_folder):
+    import pymongo
+    binary = shutil.which('mongod')
+    if binary == None:
+        sys.exit("'mongod' was not found. Install MongoDB, or use '--mongo mongomock' or '--mongo-uri'.")
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    data_folder = os.path.join(work_folder, 'mongod')
+    os.makedirs(data_folder)
+    process = subprocess.Popen([binary, '--dbpath', data_folder, '--port', str(port), '--bind_ip', '127.0.0.1'],
+                               stdout=open(os.path.join(work_folder, 'mongod.log'), 'w'), stderr=subprocess.STDOUT)
+    uri = 'mongodb://127.0.0.1:{}'.format(port)
+    deadline = time.time() + MONGOD_START_TIMEOUT
+    while True:
+        try:
+            pymongo.MongoClient(uri, serverSelectionTimeoutMS=500).admin.command('ping')
+            return process, uri
+        except pymongo.errors.ServerSelectionTimeoutError:
+            if time.time() > deadline or process.poll() != None:
+                process.terminate()
+                sys.exit('The temporary mongod did not start, see {}.'.format(os.path.join(work_folder, 'mongod.log')))
+
+
+
+#---
+# FUNCTION: connect
+# PURPOSE: Returns the benchmark database, either of a MongoDB server or of mongomock.
+#---
+def connect(args):
+    if args.mongo_uri != None:
+        import pymongo
+        db = pymongo.MongoClient(args.mongo_uri)[BENCHMARK_DATABASE]
+        clear_database(db)
+        return db
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed. Install it (pip install mongomock), or use '--mongo mongod' or '--mongo-uri'.")
+    if os.environ['MICROMIX_BLOB_STORE'] == 'gridfs':
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+    return mongomock.MongoClient()[BENCHMARK_DATABASE]
+
+
+
+#---
+# FUNCTION: clear_database
+# PURPOSE: Removes the sessions and blobs of the previous size.
+#---
+def clear_database(db):
+    import blob_store
+    blob_store.delete_blobs(db, blob_store.list_blob_ids(db))
+    db.visualizations.delete_many({})
+
+
+
+#---
+# FUNCTION: benchmark_size
+# PURPOSE: Runs all benchmarks on matrices of one size.
+# RETURNS: A list of results (see measure).
+#---
+def benchmark_size(db, schema, rows, columns, args, work_folder):
+    import process_file
+    import blob_store
+    import filter_dataframe
+    import export_formats
+    results = []
+
+    # The second matrix shares 90 % of its genes with the first one, so the merge adds and misses rows.
+    files = []
+    for position, title in enumerate(TITLES):
+        path = os.path.join(work_folder, '{}_{}x{}.tsv'.format(title, rows, columns))
+        synthetic_matrices.write_matrix(path, schema, rows, columns, seed=args.seed + position, gene_offset=position * (rows // 10))
+        files.append(path)
+    file_size = os.path.getsize(files[0])
+
+    # Every repetition starts with an empty blob store, so the blobs are written each time.
+    new_seconds = []
+    existing_seconds = []
+    for repetition in range(args.repeat):
+        clear_database(db)
+        start = time.perf_counter()
+        db_entry_id = process_file.add_matrix(files[0], upload_metadata(TITLES[0], 2, ''), '.tsv', db, [])
+        new_seconds.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        db_entry_id = process_file.add_matrix(files[1], upload_metadata(TITLES[1], 3, str(db_entry_id)), '.tsv', db, [])
+        existing_seconds.append(time.perf_counter() - start)
+    results.append(result('add_matrix (new session)', rows, columns, new_seconds, file_size))
+    results.append(result('add_matrix (existing session)', rows, columns, existing_seconds, file_size))
+
+    import sessions
+    db_entry = sessions.find_session(db, db_entry_id, {'_id': False})
+    results.append(measure('merge_db_entry', rows, columns, args.repeat,
+                           lambda: process_file.merge_db_entry(copy.deepcopy(db_entry), sum(db_entry['active_matrices'], []), db)))
+
+    df = blob_store.read_df(db, db_entry['transformed_dataframe'])
+    ids = ';'.join(df[schema['text_columns'][0]].iloc[::max(1, len(df) // QUERY_GENE_COUNT)].head(QUERY_GENE_COUNT).astype(str))
+    for name, query in QUERIES.items():
+        query = json.loads(json.dumps(query).replace('{ids}', ids))
+        # filter_dataframe.main may change the dataframe and the query, so each repetition gets copies (which are not timed).
+        results.append(measure('filter: ' + name, rows, columns, args.repeat,
+                               lambda copies: filter_dataframe.main(*copies), setup=lambda: (copy.deepcopy(query), df.copy())))
+    del df
+
+    # The routes are requested through the Flask test client, including the serialization of the response.
+    import app as backend
+    backend.db = db
+    client = backend.create_app().test_client()
+    url = json.dumps(str(db_entry_id))
+    results.append(measure('/config', rows, columns, args.repeat, lambda: response_size(client.post('/config', data={'url': url}))))
+    results.append(measure('/config/arrow', rows, columns, args.repeat, lambda: response_size(client.post('/config/arrow', data={'url': url}))))
+    for file_type in export_formats.EXPORT_FORMATS:
+        export_form = json.dumps({'file_type': file_type, 'csv_seperator': ','})
+        results.append(measure('/export ' + file_type, rows, columns, args.repeat,
+                               lambda: response_size(client.post('/export', data={'export_form': export_form, 'url': url}))))
+    return results
+
+
+
+#---
+# FUNCTION: upload_metadata
+# PURPOSE: Returns the metadata of an uploaded TSV file, as sent by the frontend.
+#---
+def upload_metadata(title, x, db_entry_id):
+    return {
+        'db_entry_id': db_entry_id,
+        'matrix_id': '',
+        'title': title,
+        'x': x,
+        'y': 2,
+        'transformation': '',
+        'source': {'database': None, 'text': None},
+        'formatting': {'file': {'csv_seperator': '\t', 'decimal_character': '.'}, 'text': {'decimal_character': '.'}},
+        'database_columns': [],
+        'local_active_organism_id': 'benchmark',
+    }
+
+
+
+#---
+# FUNCTION: response_size
+# PURPOSE: Reads a (streamed) response completely and returns its size in bytes.
+#---
+def response_size(response):
+    if response.status_code != 200:
+        raise RuntimeError('The request failed with status {}: {}'.format(response.status_code, response.get_data(as_text=True)[:500]))
+    return len(response.get_data())
+
+
+
+#---
+# FUNCTION: measure
+# PURPOSE: Runs a function repeat times and returns the result of the benchmark.
+# PARAMETERS:
+#   name, rows, columns: Identify the benchmark in the results.
+#   repeat: How often the function is run.
+#   function: The function to time. If it returns a number, it is stored as the size in bytes (e.g. of a response).
+#   setup: Optional function that is called (untimed) before each run. Its return value is passed to the function.
+#---
+def measure(name, rows, columns, repeat, function, setup=None):
+    seconds = []
+    size = None
+    for repetition in range(repeat):
+        if setup != None:
+            argument = setup()
+            start = time.perf_counter()
+            value = function(argument)
+        else:
+            start = time.perf_counter()
+            value = function()
+        seconds.append(time.perf_counter() - start)
+        if isinstance(value, int):
+            size = value
+    return result(name, rows, columns, seconds, size)
+
+
+
+#---
+# FUNCTION: result
+# PURPOSE: Summarizes the times of one benchmark.
+#---
+def result(name, rows, columns, seconds, size=None):
+    print('  {:<40} median {:8.3f} s'.format(name, statistics.median(seconds)))
+    return {
+        'benchmark': name,
+        'rows': rows,
+        'columns': columns,
+        'seconds': seconds,
+        'min': min(seconds),
+        'median': statistics.median(seconds),
+        'bytes': size,
+    }
+
+
+
+#---
+# FUNCTION: describe_environment
+# PURPOSE: Returns the versions and settings of this run, so results of different machines can be told apart.
+#---
+def describe_environment(args):
+    import numpy
+    import pandas
+    import pyarrow
+    import pymongo
+    import process_file
+    import filter_dataframe
+    import parallel_rows
+    import blob_store
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=BACKEND_FOLDER).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'packages': {'numpy': numpy.__version__, 'pandas': pandas.__version__, 'pyarrow': pyarrow.__version__, 'pymongo': pymongo.__version__},
+        'mongo': 'uri' if args.mongo_uri != None and args.mongo != 'mongod' else args.mongo,
+        'settings': {
+            'MICROMIX_MERGE_MODE': process_file.MERGE_MODE,
+            'MICROMIX_QUERY_ENGINE': filter_dataframe.QUERY_ENGINE,
+            'MICROMIX_PARALLEL_ROW_THRESHOLD': parallel_rows.PARALLEL_ROW_THRESHOLD,
+            'MICROMIX_PARALLEL_WORKERS': parallel_rows.PARALLEL_WORKERS,
+            'MICROMIX_BLOB_STORE': blob_store.BLOB_STORE,
+        },
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+
+
+
+#---
+# FUNCTION: save_results
+# PURPOSE: Writes the results of the run as JSON. Called after every size, so a run that is stopped keeps its results.
+#---
+def save_results(run, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as results_file:
+        json.dump(run, results_file, indent=2)
+
+
+
+#---
+# FUNCTION: load_results
+# PURPOSE: Reads the results of an earlier run.
+#---
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+
+#---
+# FUNCTION: compare_results
+# PURPOSE: Compares the median times of two runs and prints the benchmarks that both runs contain.
+# RETURNS: The benchmarks that became slower by more than the threshold (a ratio, e.g. 1.25).
+#---
+def compare_results(baseline, run, threshold):
+    baseline_results = {(entry['benchmark'], entry['rows'], entry['columns']): entry for entry in baseline['results']}
+    regressions = []
+    print('Compared with the run of {} (commit {}):'.format(baseline['created'], baseline['environment'].get('commit')))
+    for entry in run['results']:
+        key = (entry['benchmark'], entry['rows'], entry['columns'])
+        if key not in baseline_results:
+            continue
+        ratio = entry['median'] / max(baseline_results[key]['median'], 1e-9)
+        slower = ratio > threshold
+        if slower:
+            regressions.append(key)
+        print('  {:<40} {:>7} x {:<5} {:8.3f} s -> {:8.3f} s  x{:.2f}{}'.format(key[0], key[1], key[2], baseline_results[key]['median'], entry['median'], ratio, '  SLOWER' if slower else ''))
+    return regressions
+
+
+
+if __name__ == '__main__':
+    main()
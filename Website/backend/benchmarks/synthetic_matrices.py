@@ -0,0 +1,117 @@
+#--------------------------------
+#
+# Synthetic expression matrices for the benchmarks
+#
+#--------------------------------
+
+# The bundled datasets are too small to show how the backend scales. Here, matrices of any size are generated from the
+# schema of a bundled file (see SCHEMA_FILE):
+#   - The text columns (e.g. 'Locus Tag', 'gene') are kept, with unique identifiers in the style of the bundled file.
+#   - The numeric columns (e.g. '0hr_r1', ...) are repeated until the requested number of columns is reached.
+#   - The values follow the bundled file: every gene gets a base expression, every sample adds noise on the log scale,
+#     and a share of the values is zero. The values have the same number of decimals as the bundled file.
+# The same seed always gives the same matrix, so the results of two benchmark runs can be compared.
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# Configuration
+SCHEMA_FILE = 'static/salmonella_sl1344_dual_rna-seq_complete.tsv'
+WRITE_CHUNK_ROWS = 20000 # Rows generated and written at once, limits the memory used for large matrices
+
+
+
+#---
+# FUNCTION: read_schema
+# PURPOSE: Reads the columns and the value distribution of a bundled file.
+# PARAMETERS:
+#   path: The bundled file (.csv, .tsv or .txt).
+# RETURNS: A dictionary with the text columns, the numeric columns, and the statistics of the values.
+#---
+def read_schema(path):
+    df = pd.read_csv(path, sep=',' if path.endswith('.csv') else '\t')
+    numeric_columns = list(df.select_dtypes(np.number).columns)
+    text_columns = [column for column in df.columns if column not in numeric_columns]
+    values = df[numeric_columns].to_numpy(dtype=np.float64)
+    values = values[np.isfinite(values).all(axis=1)]
+    log_values = np.log1p(np.clip(values, 0, None))
+    gene_means = log_values.mean(axis=1)
+
+    # The identifiers of the first text column, e.g. 'SL1344' of 'SL1344_0001'.
+    first_id = str(df[text_columns[0]].dropna().iloc[0]) if len(text_columns) > 0 else 'gene'
+    decimals = [len(str(value).split('.')[1]) for value in df[numeric_columns].stack().head(1000) if '.' in str(value)]
+    return {
+        'file': os.path.basename(path),
+        'text_columns': text_columns,
+        'numeric_columns': numeric_columns,
+        'id_prefix': first_id.rsplit('_', 1)[0] if '_' in first_id else first_id.rstrip('0123456789'),
+        'gene_mean': float(gene_means.mean()),
+        'gene_std': float(gene_means.std()),
+        'sample_std': float((log_values - gene_means[:, None]).std()),
+        'zero_fraction': float((values == 0).mean()),
+        'decimals': max(decimals) if len(decimals) > 0 else 0,
+    }
+
+
+
+#---
+# FUNCTION: column_names
+# PURPOSE: Returns the names of the numeric columns of a synthetic matrix.
+# NOTES: The names of the schema are repeated, with a suffix from the second repetition on ('0hr_r1', ..., '0hr_r1_2', ...).
+#---
+def column_names(schema, columns):
+    names = []
+    repetition = 0
+    while len(names) < columns:
+        suffix = '' if repetition == 0 else '_{}'.format(repetition + 1)
+        names += [name + suffix for name in schema['numeric_columns']]
+        repetition += 1
+    return names[:columns]
+
+
+
+#---
+# FUNCTION: make_matrix
+# PURPOSE: Generates a part of a synthetic matrix.
+# PARAMETERS:
+#   schema: The schema of a bundled file (see read_schema).
+#   rows: The rows of the whole matrix (as a range), e.g. range(0, 20000).
+#   columns: The number of numeric columns.
+#   seed: The seed of the random values. Together with the first row, it fixes the values of the part.
+#   gene_offset: Added to the row numbers of the identifiers, so two matrices can share only a part of their genes.
+# RETURNS: A pandas DataFrame.
+#---
+def make_matrix(schema, rows, columns, seed=0, gene_offset=0):
+    rng = np.random.default_rng([seed, rows.start])
+    numbers = np.arange(rows.start, rows.stop) + gene_offset
+    df = pd.DataFrame()
+    for position, column in enumerate(schema['text_columns']):
+        if position == 0:
+            df[column] = ['{}_{:06d}'.format(schema['id_prefix'], number) for number in numbers]
+        else:
+            df[column] = ['{}{}'.format(column.lower().replace(' ', '_')[:4], number) for number in numbers]
+
+    gene_means = rng.normal(schema['gene_mean'], schema['gene_std'], size=(len(numbers), 1))
+    log_values = gene_means + rng.normal(0, schema['sample_std'], size=(len(numbers), columns))
+    values = np.round(np.expm1(np.clip(log_values, 0, None)), schema['decimals'])
+    values[rng.random(values.shape) < schema['zero_fraction']] = 0
+    return pd.concat([df, pd.DataFrame(values, columns=column_names(schema, columns))], axis=1)
+
+
+
+#---
+# FUNCTION: write_matrix
+# PURPOSE: Writes a synthetic matrix as a TSV file, as it would be uploaded.
+# PARAMETERS:
+#   path: The TSV file to write.
+#   schema, rows, columns, seed, gene_offset: See make_matrix. Here, rows is the number of rows.
+# RETURNS: The size of the file in bytes.
+#---
+def write_matrix(path, schema, rows, columns, seed=0, gene_offset=0):
+    with open(path, 'w') as tsv_file:
+        for start in range(0, rows, WRITE_CHUNK_ROWS):
+            df = make_matrix(schema, range(start, min(rows, start + WRITE_CHUNK_ROWS)), columns, seed, gene_offset)
+            df.to_csv(tsv_file, sep='\t', index=False, header=start == 0)
+    return os.path.getsize(path)
@@ -0,0 +1,298 @@
+#--------------------------------
+#
+# Content-addressed blob store for session dataframes
+#
+#--------------------------------
+
+# Session documents in db.visualizations used to embed every dataframe (transformed_dataframe, filtered_dataframe and
+# one dataframe per active matrix) as an inline BSON Binary. This pushed larger sessions towards the 16 MB BSON limit
+# and every find_one had to pull all of that data, even when an endpoint only needed a single field.
+#
+# Here, the parquet bytes of a dataframe are stored once, keyed by their sha256 hash, and the session document only keeps
+# a small reference: {'blob_id': <sha256>, 'size': <bytes>}. Identical frames (a locked session and its unlocked copy,
+# or two sessions built from the same bundled dataset) therefore share a single blob.
+#
+# Two backends are available:
+#   'gridfs'     - Blobs are stored in MongoDB (GridFS bucket 'blobs'), next to the sessions. This is the default.
+#   'filesystem' - Blobs are stored as files below BLOB_STORE_PATH. Useful for local testing or a shared volume.
+#
+# Sessions written before the blob store existed still contain inline Binary values. All read functions accept both.
+
+import os
+import time
+import hashlib
+import tempfile
+from datetime import datetime
+from io import BytesIO
+import pandas as pd
+import metrics
+
+
+# Configuration
+BLOB_STORE = os.environ.get('MICROMIX_BLOB_STORE', 'gridfs')
+BLOB_STORE_PATH = os.environ.get('MICROMIX_BLOB_STORE_PATH', 'blobs')
+GRIDFS_COLLECTION = 'blobs'
+
+
+
+#---
+# FUNCTION: df_to_parquet
+# PURPOSE: Converts a pandas DataFrame into parquet bytes.
+# PARAMETERS:
+#   df: The pandas DataFrame to be converted.
+# RETURNS: The parquet representation of the DataFrame as bytes.
+#---
+def df_to_parquet(df):
+    output = BytesIO()
+    with metrics.timed(metrics.PARQUET_SECONDS, operation='write'):
+        df.to_parquet(output)
+    return output.getvalue()
+
+
+
+#---
+# FUNCTION: store_df
+# PURPOSE: Converts a DataFrame to parquet and stores it in the blob store.
+# PARAMETERS:
+#   db: The MongoDB database holding the session documents.
+#   df: The pandas DataFrame to be stored.
+# RETURNS: A blob reference that can be saved in the session document in place of the dataframe.
+#---
+def store_df(db, df):
+    return put_blob(db, df_to_parquet(df))
+
+
+
+#---
+# FUNCTION: read_df
+# PURPOSE: Loads a DataFrame from a value stored in a session document.
+# PARAMETERS:
+#   db: The MongoDB database holding the session documents.
+#   value: A blob reference, a legacy inline Binary, or an empty placeholder ([] / '' / None).
+#   columns: Optional list of columns to read. Parquet is columnar, so only these columns are decoded.
+# RETURNS: The DataFrame, or None if the value does not hold a dataframe.
+#---
+def read_df(db, value, columns=None):
+    if not has_blob(value):
+        return None
+    data = get_blob(db, value)
+    with metrics.timed(metrics.PARQUET_SECONDS, operation='read'):
+        return pd.read_parquet(BytesIO(data), columns=columns)
+
+
+
+#---
+# FUNCTION: read_table
+# PURPOSE: Loads a stored dataframe as a pyarrow Table, without converting it to pandas.
+# PARAMETERS:
+#   db: The MongoDB database holding the session documents.
+#   value: A blob reference or a legacy inline Binary.
+#   columns: Optional list of columns to read.
+# RETURNS: The Table, or None if the value does not hold a dataframe. A stored pandas index is not part of the Table.
+#---
+def read_table(db, value, columns=None):
+    import pyarrow.parquet as pq
+    if not has_blob(value):
+        return None
+    parquet_file = pq.ParquetFile(BytesIO(get_blob(db, value)))
+    if columns is not None:
+        missing = [column for column in columns if column not in parquet_file.schema_arrow.names]
+        if len(missing) > 0:
+            raise ValueError('Unknown columns: {}'.format(', '.join(map(str, missing))))
+    table = parquet_file.read(columns=columns)
+    # pandas stores a non-default index as extra columns (e.g. '__index_level_0__') in the parquet file.
+    index_columns = [column for column in table.column_names if column.startswith('__index_level_')]
+    if len(index_columns) > 0:
+        table = table.drop(index_columns)
+    return table.replace_schema_metadata(None)
+
+
+
+#---
+# FUNCTION: count_rows
+# PURPOSE: Returns the number of rows of a stored dataframe. Only the parquet metadata is read, not the data.
+#---
+def count_rows(db, value):
+    import pyarrow.parquet as pq
+    if not has_blob(value):
+        return 0
+    return pq.ParquetFile(BytesIO(get_blob(db, value))).metadata.num_rows
+
+
+
+#---
+# FUNCTION: has_blob
+# PURPOSE: Checks if a session document value holds a dataframe (either as reference or as legacy inline Binary).
+#          The session mockup and cleared filters store an empty list instead.
+#---
+def has_blob(value):
+    if is_reference(value):
+        return True
+    return isinstance(value, bytes) and len(value) > 0
+
+
+
+#---
+# FUNCTION: is_reference
+# PURPOSE: Checks if a session document value is a blob reference created by put_blob.
+#---
+def is_reference(value):
+    return isinstance(value, dict) and 'blob_id' in value
+
+
+
+#---
+# FUNCTION: blob_id_of
+# PURPOSE: Returns the content hash of a stored dataframe. For legacy inline Binary values the hash is computed on the fly,
+#          so the result can be used as a fingerprint of the data in both cases.
+#---
+def blob_id_of(value):
+    if is_reference(value):
+        return value['blob_id']
+    return hashlib.sha256(bytes(value)).hexdigest()
+
+
+
+#---
+# FUNCTION: put_blob
+# PURPOSE: Stores bytes under their sha256 hash. If a blob with the same content already exists, nothing is written.
+#          Only its date is renewed, so the retention (see retention.py) treats it as a new blob.
+# PARAMETERS:
+#   db: The MongoDB database holding the session documents.
+#   data: The bytes to be stored.
+# RETURNS: The blob reference {'blob_id': <sha256>, 'size': <bytes>}.
+#---
+def put_blob(db, data):
+    data = bytes(data)
+    blob_id = hashlib.sha256(data).hexdigest()
+    metrics.BLOB_BYTES.labels(operation='write').observe(len(data))
+    if BLOB_STORE == 'filesystem':
+        path = _blob_path(blob_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, so concurrent readers never see a partially written blob. The name is
+            # unique, as several threads or processes may store the same content at once.
+            handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(handle, 'wb') as blob_file:
+                    blob_file.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        else:
+            os.utime(path)
+    else:
+        import gridfs
+        fs = _gridfs(db)
+        if not fs.exists(blob_id):
+            try:
+                fs.put(data, _id=blob_id)
+            except gridfs.errors.FileExists:
+                pass  # Another request stored the same content in the meantime.
+        else:
+            db[GRIDFS_COLLECTION + '.files'].update_one({'_id': blob_id}, {'$set': {'uploadDate': datetime.utcnow()}})
+    return {'blob_id': blob_id, 'size': len(data)}
+
+
+
+#---
+# FUNCTION: get_blob
+# PURPOSE: Returns the bytes behind a blob reference. Legacy inline Binary values are returned unchanged.
+#---
+def get_blob(db, value):
+    if not is_reference(value):
+        return bytes(value)
+    blob_id = value['blob_id']
+    if BLOB_STORE == 'filesystem':
+        with open(_blob_path(blob_id), 'rb') as blob_file:
+            data = blob_file.read()
+    else:
+        data = _gridfs(db).get(blob_id).read()
+    metrics.BLOB_BYTES.labels(operation='read').observe(len(data))
+    return data
+
+
+
+#---
+# FUNCTION: blob_exists
+# PURPOSE: Checks if the blob behind a reference is still available (e.g. before re-using a cached reference).
+#---
+def blob_exists(db, value):
+    if not is_reference(value):
+        return has_blob(value)
+    if BLOB_STORE == 'filesystem':
+        return os.path.exists(_blob_path(value['blob_id']))
+    return _gridfs(db).exists(value['blob_id'])
+
+
+
+#---
+# FUNCTION: delete_blobs
+# PURPOSE: Removes blobs by their ids. Only call this for blobs that are no longer referenced by any session.
+# PARAMETERS:
+#   older_than: If set, a blob is only removed if it was still stored more than this many seconds ago. The date is checked
+#               right before the blob is removed, so a blob that was stored again in the meantime (see put_blob) is kept.
+# RETURNS: The number of removed blobs.
+#---
+def delete_blobs(db, blob_ids, older_than=None):
+    deleted = 0
+    for blob_id in blob_ids:
+        cutoff = None if older_than == None else time.time() - older_than
+        if BLOB_STORE == 'filesystem':
+            try:
+                if cutoff != None and os.path.getmtime(_blob_path(blob_id)) >= cutoff:
+                    continue
+                os.remove(_blob_path(blob_id))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        else:
+            fs = _gridfs(db)
+            query = {'_id': blob_id} if cutoff == None else {'_id': blob_id, 'uploadDate': {'$lt': datetime.utcfromtimestamp(cutoff)}}
+            if db[GRIDFS_COLLECTION + '.files'].count_documents(query, limit=1) > 0:
+                fs.delete(blob_id)
+                deleted += 1
+    return deleted
+
+
+
+#---
+# FUNCTION: list_blob_ids
+# PURPOSE: Returns the ids of all stored blobs.
+# PARAMETERS:
+#   older_than: If set, only the blobs stored more than this many seconds ago.
+#---
+def list_blob_ids(db, older_than=None):
+    cutoff = None if older_than == None else time.time() - older_than
+    if BLOB_STORE == 'filesystem':
+        blob_ids = []
+        for folder, _, filenames in os.walk(BLOB_STORE_PATH):
+            blob_ids += [os.path.splitext(name)[0] for name in filenames if name.endswith('.parquet')
+                         and (cutoff == None or os.path.getmtime(os.path.join(folder, name)) < cutoff)]
+        return blob_ids
+    query = {} if cutoff == None else {'uploadDate': {'$lt': datetime.utcfromtimestamp(cutoff)}}
+    return [entry['_id'] for entry in db[GRIDFS_COLLECTION + '.files'].find(query, {'_id': True})]
+
+
+
+#---
+# FUNCTION: session_blob_ids
+# PURPOSE: Collects the ids of all blobs referenced by a session document.
+#---
+def session_blob_ids(db_entry):
+    values = [db_entry.get('transformed_dataframe'), db_entry.get('filtered_dataframe')]
+    for matrix in sum(db_entry.get('active_matrices') or [], []):
+        values.append(matrix.get('dataframe'))
+    return {value['blob_id'] for value in values if is_reference(value)}
+
+
+
+def _blob_path(blob_id):
+    # Spread the files over sub-folders to keep directory listings short.
+    return os.path.join(BLOB_STORE_PATH, blob_id[:2], blob_id + '.parquet')
+
+
+def _gridfs(db):
+    import gridfs
+    return gridfs.GridFS(db, collection=GRIDFS_COLLECTION)
@@ -0,0 +1,314 @@
+#--------------------------------
+#
+# Chunked, resumable uploads
+#
+#--------------------------------
+
+# '/upload' receives the whole file in one request, which is limited to MAX_CONTENT_LENGTH (16 MB), and the file was
+# parsed from memory. Count tables of larger genomes are bigger than that.
+#
+# Here, a file is uploaded in chunks of UPLOAD_CHUNK_SIZE bytes, each in its own request:
+#   POST   '/chunked_upload'                     Starts an upload (file name and size), returns its upload ID.
+#   PUT    '/chunked_upload/<upload_id>/<index>' Sends chunk <index> (0, 1, 2, ...) as the request body.
+#   GET    '/chunked_upload/<upload_id>'         Returns how many chunks have been received, to resume an upload.
+#   POST   '/chunked_upload/<upload_id>/commit'  Processes the complete file like '/upload' (as a background job).
+#   DELETE '/chunked_upload/<upload_id>'         Cancels an upload.
+# The chunks have to be sent in order. A chunk that has already been received is acknowledged again without writing it
+# (e.g. if the connection was lost before the response arrived), a chunk after a missing one is rejected. The chunks
+# are appended to a file in UPLOAD_DIR, so the file is never held in memory. The state of the uploads is kept in the
+# MongoDB collection 'chunked_uploads', so every backend process can receive the next chunk, as long as UPLOAD_DIR is
+# shared by them. Uploads that receive no chunk for UPLOAD_TTL seconds are removed. A committed upload is removed by its
+# job when it has finished. While the job waits or runs, its heartbeat (see jobs.py) extends the upload (see touch), so
+# only the upload of a job whose process has stopped expires.
+#
+# On commit, CSV and TSV files are parsed as a stream by pyarrow, one block after another, and written as row groups of a
+# parquet file. The dataframe is then read from the parquet file, which needs much less memory than parsing the text at
+# once. Excel files, and files pyarrow cannot parse like pandas does (e.g. a column with numbers in its first rows and
+# text further down), are read by pandas from the assembled file (see process_file.convert_to_df).
+
+import os
+import re
+import uuid
+import fcntl
+import tempfile
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+
+# Configuration
+UPLOAD_DIR = os.environ.get('MICROMIX_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'micromix-uploads'))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('MICROMIX_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)) # Bytes per chunk, below MAX_CONTENT_LENGTH
+UPLOAD_MAX_BYTES = int(os.environ.get('MICROMIX_UPLOAD_MAX_BYTES', 2 * 1024 ** 3)) # Largest file that can be uploaded
+UPLOAD_TTL = int(os.environ.get('MICROMIX_UPLOAD_TTL', 24 * 3600)) # Seconds an upload is kept without a chunk or a heartbeat of its job
+PARSE_BLOCK_BYTES = 16 * 1024 * 1024 # Bytes of text pyarrow parses at once, each block becomes a row group
+COPY_BUFFER_BYTES = 1024 * 1024
+
+UPLOAD_ID_PATTERN = re.compile('^[0-9a-f]{32}$')
+
+
+
+#---
+# FUNCTION: start
+# PURPOSE: Starts a chunked upload.
+# PARAMETERS:
+#   collection: The MongoDB collection of the uploads (db.chunked_uploads).
+#   filename: The name of the uploaded file, its extension decides how it is parsed.
+#   size: The size of the file in bytes.
+#   extensions: The allowed extensions, without dot.
+# RETURNS: The state of the upload (see describe).
+# NOTES: Raises a ValueError for a file that is empty, too large or of a type that cannot be uploaded.
+#---
+def start(collection, filename, size, extensions):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension[1:] not in extensions:
+        raise ValueError('Files of type {} cannot be uploaded. Please upload .xlsx (Excel), .csv, or .txt (TSV).'.format(extension or 'without extension'))
+    if size <= 0 or size > UPLOAD_MAX_BYTES:
+        raise ValueError('The file has to contain between 1 byte and {} MB.'.format(UPLOAD_MAX_BYTES // (1024 * 1024)))
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    now = datetime.utcnow()
+    upload = {
+        '_id': uuid.uuid4().hex,
+        'filename': filename,
+        'extension': extension,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'chunks': -(-size // UPLOAD_CHUNK_SIZE),
+        'received': 0,
+        'status': 'receiving',
+        'created': now,
+        'expires': now + timedelta(seconds=UPLOAD_TTL),
+    }
+    open(file_path(upload['_id']), 'wb').close()
+    collection.insert_one(upload)
+    return describe(upload)
+
+
+
+#---
+# FUNCTION: find
+# PURPOSE: Returns the state of an upload, or None if it does not exist or has expired.
+#---
+def find(collection, upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    upload = collection.find_one({'_id': upload_id})
+    if upload == None or upload['expires'] < datetime.utcnow():
+        return None
+    return upload
+
+
+
+#---
+# FUNCTION: write_chunk
+# PURPOSE: Appends a chunk to the file of an upload.
+# PARAMETERS:
+#   collection: The MongoDB collection of the uploads.
+#   upload_id: The ID of the upload.
+#   index: The position of the chunk, starting with 0.
+#   stream: A file-like object with the bytes of the chunk (the body of the request).
+# RETURNS: The state of the upload after the chunk.
+# NOTES: Raises a KeyError for an unknown upload, and a ValueError for a chunk that is not the next one or that has the
+#        wrong size. The file is locked while a chunk is written, so a chunk that is sent twice at the same time is only
+#        written once.
+#---
+def write_chunk(collection, upload_id, index, stream):
+    path = file_path(upload_id)
+    if find(collection, upload_id) == None or not os.path.exists(path):
+        raise KeyError('The upload {} does not exist or has expired.'.format(upload_id))
+    with open(path, 'r+b') as upload_file:
+        fcntl.flock(upload_file, fcntl.LOCK_EX)
+        upload = find(collection, upload_id)
+        if upload == None or upload['status'] != 'receiving':
+            raise KeyError('The upload {} does not exist or has already been committed.'.format(upload_id))
+        if index < upload['received']: # Already received, e.g. the response to the chunk was lost
+            return describe(upload)
+        if index > upload['received'] or index >= upload['chunks']:
+            raise ValueError('Chunk {} was sent, but chunk {} is expected next.'.format(index, upload['received']))
+
+        # A chunk that failed halfway may have left bytes behind, they are overwritten
+        start = index * upload['chunk_size']
+        expected = min(upload['chunk_size'], upload['size'] - start)
+        upload_file.seek(start)
+        upload_file.truncate()
+        written = 0
+        while written <= expected:
+            data = stream.read(min(COPY_BUFFER_BYTES, expected + 1 - written))
+            if not data:
+                break
+            upload_file.write(data)
+            written += len(data)
+        if written != expected:
+            upload_file.truncate(start)
+            raise ValueError('Chunk {} has {} bytes, {} bytes were expected.'.format(index, written if written <= expected else 'more than {}'.format(expected), expected))
+        upload_file.flush()
+        os.fsync(upload_file.fileno())
+
+        upload = collection.find_one_and_update(
+            {'_id': upload_id, 'received': index},
+            {'$set': {'received': index + 1, 'expires': datetime.utcnow() + timedelta(seconds=UPLOAD_TTL)}},
+            return_document=ReturnDocument.AFTER)
+    return describe(upload)
+
+
+
+#---
+# FUNCTION: commit
+# PURPOSE: Marks a complete upload as committed, so it is processed only once.
+# RETURNS: The upload, with the path of its file in 'path'.
+# NOTES: Raises a KeyError for an unknown upload, and a ValueError if chunks are missing or the upload has already been
+#        committed.
+#---
+def commit(collection, upload_id):
+    upload = find(collection, upload_id)
+    if upload == None:
+        raise KeyError('The upload {} does not exist or has expired.'.format(upload_id))
+    if upload['status'] != 'receiving':
+        raise ValueError('The upload {} has already been committed.'.format(upload_id))
+    if upload['received'] != upload['chunks'] or os.path.getsize(file_path(upload_id)) != upload['size']:
+        raise ValueError('The upload is incomplete, {} of {} chunks have been received.'.format(upload['received'], upload['chunks']))
+    upload = collection.find_one_and_update({'_id': upload_id, 'status': 'receiving'},
+                                            {'$set': {'status': 'committed', 'expires': datetime.utcnow() + timedelta(seconds=UPLOAD_TTL)}},
+                                            return_document=ReturnDocument.AFTER)
+    if upload == None:
+        raise ValueError('The upload {} has already been committed.'.format(upload_id))
+    upload['path'] = file_path(upload_id)
+    return upload
+
+
+
+#---
+# FUNCTION: remove
+# PURPOSE: Removes an upload and its files, e.g. after its job has finished or when it is cancelled.
+#---
+def remove(collection, upload_id):
+    for path in (file_path(upload_id), parquet_path(upload_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    collection.delete_one({'_id': upload_id})
+
+
+
+#---
+# FUNCTION: touch
+# PURPOSE: Keeps a committed upload for another UPLOAD_TTL seconds, called with the heartbeats of its job.
+#---
+def touch(collection, upload_id):
+    collection.update_one({'_id': upload_id, 'status': 'committed'}, {'$set': {'expires': datetime.utcnow() + timedelta(seconds=UPLOAD_TTL)}})
+
+
+
+#---
+# FUNCTION: remove_expired
+# PURPOSE: Removes the uploads that have received no chunk, or whose job has sent no heartbeat, for UPLOAD_TTL seconds.
+# NOTES: Called regularly by the routes.
+#---
+def remove_expired(collection):
+    for upload in collection.find({'expires': {'$lt': datetime.utcnow()}}, {'_id': True}):
+        remove(collection, upload['_id'])
+
+
+
+#---
+# FUNCTION: describe
+# PURPOSE: Returns the state of an upload as it is sent to the frontend.
+#---
+def describe(upload):
+    return {
+        'upload_id': upload['_id'],
+        'status': upload['status'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'chunks': upload['chunks'],
+        'received': upload['received'],
+        'received_bytes': min(upload['received'] * upload['chunk_size'], upload['size']),
+    }
+
+
+
+#---
+# FUNCTION: prepare_source
+# PURPOSE: Converts a committed upload into the source that process_file.add_matrix reads.
+# PARAMETERS:
+#   upload: The committed upload.
+#   metadata: The form of the upload (separator and decimal character, selected columns).
+# RETURNS: A tuple of the file to read and its extension: the parquet file of a CSV or TSV file, otherwise the uploaded
+#          file itself.
+#---
+def prepare_source(upload, metadata):
+    if upload['extension'] in ('.csv', '.txt', '.tsv'):
+        output = parquet_path(upload['_id'])
+        if csv_to_parquet(upload['path'], output, upload['extension'], metadata):
+            return output, '.parquet'
+    return upload['path'], upload['extension']
+
+
+
+#---
+# FUNCTION: csv_to_parquet
+# PURPOSE: Parses a CSV or TSV file block by block and writes each block as a row group of a parquet file.
+# PARAMETERS:
+#   input_file: The CSV or TSV file.
+#   output_file: The parquet file to write.
+#   extension: '.csv' (separator from the form) or '.txt'/'.tsv' (tab separated).
+#   metadata: The form of the upload.
+# RETURNS: True if the file was converted, False if it has to be parsed by pandas instead.
+# NOTES: The options follow pandas.read_csv as used in process_file.convert_to_df, e.g. malformed rows are skipped and
+#        only 'true'/'false' are booleans. pyarrow infers the types from the first block, so the conversion gives up if a
+#        later block does not fit them.
+#---
+def csv_to_parquet(input_file, output_file, extension, metadata):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    separator = metadata['formatting']['file']['csv_seperator'] if extension == '.csv' else '\t'
+    if len(separator) != 1:
+        return False
+    skipped = []
+    read_options = pa_csv.ReadOptions(block_size=PARSE_BLOCK_BYTES)
+    parse_options = pa_csv.ParseOptions(delimiter=separator, invalid_row_handler=lambda row: skipped.append(row.number) or 'skip')
+    convert_options = pa_csv.ConvertOptions(decimal_point=metadata['formatting']['file']['decimal_character'],
+                                            strings_can_be_null=True,
+                                            true_values=['True', 'TRUE', 'true'], false_values=['False', 'FALSE', 'false'])
+    rows = 0
+    try:
+        with pa_csv.open_csv(input_file, read_options=read_options, parse_options=parse_options, convert_options=convert_options) as reader:
+            schema = pandas_schema(reader.schema)
+            if schema == None:
+                return False
+            with pq.ParquetWriter(output_file, schema) as writer:
+                for batch in reader:
+                    writer.write_table(pa.Table.from_batches([batch]).rename_columns(schema.names))
+                    rows += batch.num_rows
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        print('The upload is parsed by pandas instead of pyarrow:', str(e))
+        return False
+    # A header with one field less than the rows means that pandas takes the first column as index
+    if rows == 0 and len(skipped) > 0:
+        return False
+    return True
+
+
+
+#---
+# FUNCTION: pandas_schema
+# PURPOSE: Names the columns of a parsed CSV file like pandas does, or returns None if that is not possible.
+# NOTES: Empty column names become 'Unnamed: <position>'. Files with duplicate column names (which pandas renames to
+#        '<name>.1', ...) are left to pandas.
+#---
+def pandas_schema(schema):
+    names = [name if name != '' else 'Unnamed: {}'.format(position) for position, name in enumerate(schema.names)]
+    if len(set(names)) != len(names):
+        return None
+    import pyarrow as pa
+    return pa.schema([field.with_name(name) for field, name in zip(schema, names)])
+
+
+
+def file_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id + '.part')
+
+
+def parquet_path(upload_id):
+    return os.path.join(UPLOAD_DIR, upload_id + '.parquet')
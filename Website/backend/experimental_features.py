@@ -1,77 +1,98 @@
 # Experimental features
 
+# String columns are dictionary-encoded if at most this share of their values is distinct.
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
 
 #---
 # FUNCTION: adjust_numeric_dtype
-# PURPOSE: Optimizes the data types of numeric columns in a pandas DataFrame to minimize memory usage. It converts numeric columns to the most memory-efficient types possible without losing information.
+# PURPOSE: Optimizes the data types of a pandas DataFrame to minimize memory usage, without losing information.
 # PARAMETERS:
-#   props: The pandas DataFrame whose numeric columns are to be optimized in terms of data type for memory efficiency.
-# RETURNS: The DataFrame with optimized numeric data types.
-# NOTES: This function is particularly useful in data processing pipelines where DataFrame memory footprint is a concern, such as with large datasets. It checks each numeric column to see if it can be safely converted to a smaller integer or float type and performs the conversion if so. Missing values are handled by temporarily filling them to ensure type conversions do not introduce errors.
+#   props: The pandas DataFrame whose data types are to be optimized.
+# RETURNS: The DataFrame with optimized data types.
+# NOTES: The statistics that decide the new types are computed for all numeric columns at once (one reduction per block of
+#        columns), instead of column by column. The rules are:
+#        - Integer columns, and float columns that only hold whole numbers, become the smallest (unsigned) integer type.
+#        - Float columns with missing values keep them as NaN. They become float32 if every value is exactly representable
+#          as float32 (e.g. whole numbers up to 2^24), otherwise they stay float64. The same applies to other float columns.
+#        - String columns with many repeated values (e.g. 'Sequence name' or 'Strand') become categorical columns, which store
+#          every distinct string only once.
+#        - Boolean and other columns are not changed.
 #---
 def adjust_numeric_dtype(props):
     # This function reduces memory usage by up to 75%.
-    # It iterates over columns and adjusts their data types to the integer-format
-    # with the lowest memory consumption.
     import pandas as pd
     import numpy as np
-    # start_mem_usg = props.memory_usage().sum() / 1024**2 
-    # print("Memory usage of properties dataframe is :",start_mem_usg," MB")
-    NAlist = [] # Keeps track of columns that have missing values filled in. 
-    for col in props.columns:
-        if props[col].dtype != object:  # Exclude string columns to focus on numeric data.
-            
-            # Print current column type
-            # print("******************************")
-            # print("Column: ",col)
-            # print("dtype before: ",props[col].dtype)
-            # make variables for Int, max and min
-            IsInt = False
-            mx = props[col].max()
-            mn = props[col].min()
-            # Integer does not support NA, therefore, NA needs to be filled
-            if not np.isfinite(props[col]).all(): 
-                NAlist.append(col)
-                props[col].fillna(mn-1,inplace=True)  
-            
-            # Test if column can be converted to an integer without loss of information
-            asint = props[col].fillna(0).astype(np.int64)
-            result = (props[col] - asint)
-            result = result.sum()
-            if result > -0.01 and result < 0.01:
-                IsInt = True
-            
-            # Make Integer/unsigned Integer datatypes
-            # Convert to the most memory-efficient integer type.
-            if IsInt:
-                if mn >= 0:   # Use unsigned integers if all values are non-negative.
-                    if mx < 255:
-                        props[col] = props[col].astype(np.uint8)
-                    elif mx < 65535:
-                        props[col] = props[col].astype(np.uint16)
-                    elif mx < 4294967295:
-                        props[col] = props[col].astype(np.uint32)
-                    else:
-                        props[col] = props[col].astype(np.uint64)
-                else:
-                    if mn > np.iinfo(np.int8).min and mx < np.iinfo(np.int8).max:
-                        props[col] = props[col].astype(np.int8)
-                    elif mn > np.iinfo(np.int16).min and mx < np.iinfo(np.int16).max:
-                        props[col] = props[col].astype(np.int16)
-                    elif mn > np.iinfo(np.int32).min and mx < np.iinfo(np.int32).max:
-                        props[col] = props[col].astype(np.int32)
-                    elif mn > np.iinfo(np.int64).min and mx < np.iinfo(np.int64).max:
-                        props[col] = props[col].astype(np.int64)    
-            # Make float datatypes 32 bit
-            # else:
-            #     props[col] = props[col].astype(np.float32)
-            # Print new column type
-            # print("dtype after: ",props[col].dtype)
-            # print("******************************")
-    # Print final result
-    # print("___MEMORY USAGE AFTER COMPLETION:___")
-    # mem_usg = props.memory_usage().sum() / 1024**2 
-    # print("Memory usage is: ",mem_usg," MB")
-    # print("This is ",100*mem_usg/start_mem_usg,"% of the initial size")
-    # print("NAlist: ", NAlist)
-    return props
\ No newline at end of file
+    if len(props) == 0:
+        return props
+
+    new_dtypes = {} # The new type of every column that is converted
+    plain_dtypes = {col: dtype for col, dtype in props.dtypes.items() if isinstance(dtype, np.dtype)}
+
+    # Integer columns: Minimum and maximum of all columns in one reduction.
+    int_cols = [col for col, dtype in plain_dtypes.items() if dtype.kind in 'iu']
+    if len(int_cols) > 0:
+        mins = props[int_cols].min()
+        maxs = props[int_cols].max()
+        for col in int_cols:
+            new_dtypes[col] = smallest_int_dtype(mins[col], maxs[col])
+
+    # Float columns: All statistics are computed on one 2D block.
+    float_cols = [col for col, dtype in plain_dtypes.items() if dtype.kind == 'f']
+    if len(float_cols) > 0:
+        block = props[float_cols].to_numpy(dtype=np.float64)
+        is_nan = np.isnan(block)
+        has_nan = is_nan.any(axis=0)
+        # Whole numbers only (missing values are checked separately, infinite values are not whole numbers).
+        is_whole = (is_nan | (np.isfinite(block) & (np.floor(block) == block))).all(axis=0)
+        # float32 is lossless if converting the values there and back gives the same values.
+        fits_float32 = (is_nan | (block.astype(np.float32).astype(np.float64) == block)).all(axis=0)
+        mins = np.where(is_nan, np.inf, block).min(axis=0)
+        maxs = np.where(is_nan, -np.inf, block).max(axis=0)
+        for i, col in enumerate(float_cols):
+            if is_whole[i] and not has_nan[i] and mins[i] >= np.iinfo(np.int64).min and maxs[i] <= np.iinfo(np.uint64).max:
+                new_dtypes[col] = smallest_int_dtype(mins[i], maxs[i])
+            elif fits_float32[i] and plain_dtypes[col] != np.float32:
+                new_dtypes[col] = np.float32
+
+    # String columns: Dictionary-encode columns with repeated values.
+    for col, dtype in plain_dtypes.items():
+        if dtype.kind == 'O' and pd.api.types.infer_dtype(props[col], skipna=True) == 'string':
+            if props[col].nunique() <= len(props) * CATEGORY_MAX_UNIQUE_RATIO:
+                new_dtypes[col] = 'category'
+
+    new_dtypes = {col: dtype for col, dtype in new_dtypes.items() if dtype != plain_dtypes[col]}
+    if len(new_dtypes) > 0:
+        props = props.astype(new_dtypes)
+    return props
+
+
+
+#---
+# FUNCTION: smallest_int_dtype
+# PURPOSE: Returns the integer type with the lowest memory consumption that can hold all values between mn and mx.
+#          Unsigned integers are used if all values are non-negative.
+#---
+def smallest_int_dtype(mn, mx):
+    import numpy as np
+    candidates = [np.uint8, np.uint16, np.uint32, np.uint64] if mn >= 0 else [np.int8, np.int16, np.int32, np.int64]
+    for candidate in candidates:
+        if np.iinfo(candidate).min <= mn and mx <= np.iinfo(candidate).max:
+            return np.dtype(candidate)
+    return np.dtype(np.int64)
+
+
+
+#---
+# FUNCTION: missing_text_to_nan
+# PURPOSE: Replaces the missing values of text columns read from parquet (None in Arrow) with NaN, as when pandas parses a file.
+# PARAMETERS:
+#   df: The pandas DataFrame read from a parquet file.
+# RETURNS: The DataFrame with NaN for every missing text value.
+# NOTES: Otherwise, e.g. astype(str) gives 'None' instead of 'nan' for these values.
+#---
+def missing_text_to_nan(df):
+    import numpy as np
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
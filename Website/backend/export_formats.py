@@ -0,0 +1,127 @@
+#--------------------------------
+#
+# Streamed export formats
+#
+#--------------------------------
+
+# The dataframes of a session are stored as parquet (see blob_store.py). For an export, the parquet file is read in
+# record batches of EXPORT_CHUNK_ROWS rows, and every batch is encoded and handed to the client before the next one is
+# read. Only one batch is decoded at a time, and the first bytes are sent right away instead of after the whole file
+# has been built in memory.
+#
+# Every function here is a generator of bytes that can be passed to a Flask Response.
+
+import os
+import zlib
+from io import BytesIO
+
+
+# Configuration
+EXPORT_CHUNK_ROWS = int(os.environ.get('MICROMIX_EXPORT_CHUNK_ROWS', 5000))
+
+# file_type: (mimetype, file name) of the streamed export formats.
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'dataframe.csv'),
+    'tsv_gz': ('application/gzip', 'dataframe.tsv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'dataframe.parquet'),
+    'feather': ('application/vnd.apache.arrow.file', 'dataframe.feather'),
+}
+
+
+
+#---
+# FUNCTION: stream_export
+# PURPOSE: Streams a stored dataframe in one of the EXPORT_FORMATS.
+# PARAMETERS:
+#   data: The parquet bytes of the dataframe (see blob_store.get_blob).
+#   file_type: One of the keys of EXPORT_FORMATS.
+#   seperator: The column separator for 'csv'.
+# RETURNS: A generator of bytes.
+#---
+def stream_export(data, file_type, seperator=','):
+    schema, batches = read_batches(data)
+    if file_type == 'csv':
+        return csv_chunks(schema, batches, seperator)
+    elif file_type == 'tsv_gz':
+        return gzip_chunks(csv_chunks(schema, batches, '\t'))
+    elif file_type == 'parquet':
+        import pyarrow.parquet as pq
+        return writer_chunks(lambda sink: pq.ParquetWriter(sink, schema), batches)
+    elif file_type == 'feather':
+        import pyarrow as pa
+        # Feather (version 2) is the Arrow IPC file format.
+        return writer_chunks(lambda sink: pa.ipc.new_file(sink, schema), batches)
+    raise ValueError("Unknown file type '{}'.".format(file_type))
+
+
+
+#---
+# FUNCTION: read_batches
+# PURPOSE: Opens parquet bytes for reading in record batches.
+# RETURNS: A tuple of the schema and a generator of record batches.
+# NOTES: A non-default pandas index is stored as extra columns in the parquet file. It is not exported, like before.
+#---
+def read_batches(data):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(BytesIO(data))
+    columns = [name for name in parquet_file.schema_arrow.names if not name.startswith('__index_level_')]
+    schema = parquet_file.schema_arrow.remove_metadata()
+    for index_column in [name for name in schema.names if name not in columns]:
+        schema = schema.remove(schema.get_field_index(index_column))
+    batches = (batch.replace_schema_metadata(None) for batch in parquet_file.iter_batches(batch_size=EXPORT_CHUNK_ROWS, columns=columns))
+    return schema, batches
+
+
+
+#---
+# FUNCTION: csv_chunks
+# PURPOSE: Encodes record batches as CSV, in the same format as DataFrame.to_csv(index=False).
+#---
+def csv_chunks(schema, batches, seperator):
+    header_written = False
+    for batch in batches:
+        yield batch.to_pandas().to_csv(sep=seperator, index=False, header=not header_written).encode('utf-8')
+        header_written = True
+    if not header_written: # No rows, only send the header.
+        yield schema.empty_table().to_pandas().to_csv(sep=seperator, index=False).encode('utf-8')
+
+
+
+#---
+# FUNCTION: gzip_chunks
+# PURPOSE: Compresses a stream of bytes to the gzip format, chunk by chunk.
+#---
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 writes a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+
+#---
+# FUNCTION: writer_chunks
+# PURPOSE: Writes record batches with a pyarrow writer (parquet or Arrow IPC) and hands out the written bytes after
+#          every batch.
+# PARAMETERS:
+#   open_writer: Function that creates the writer for a file-like sink.
+#   batches: The record batches to write.
+#---
+def writer_chunks(open_writer, batches):
+    sink = BytesIO()
+    writer = open_writer(sink)
+
+    # Hand out what has been written to the sink so far.
+    def flush():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    for batch in batches:
+        writer.write_batch(batch)
+        yield flush()
+    writer.close()
+    yield flush()
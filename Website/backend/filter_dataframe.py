@@ -5,6 +5,13 @@ import initial_transformation
 import filter_genelists
 import row_filters
 import pprint
+import os
+import metrics
+
+#How queries are evaluated:
+#   'compiled' - The query is compiled into a single plan and evaluated on 2D NumPy blocks (see query_compiler.py)
+#   'legacy'   - The three steps below are run one after the other
+QUERY_ENGINE = os.environ.get('MICROMIX_QUERY_ENGINE', 'compiled')
 
 #-------
 #Filtering Summary
@@ -24,6 +31,11 @@ import pprint
 # PURPOSE:  Applies filtering based upon user selection
 #---
 def main(query, df):
+
+    #The compiled plan gives the same result as the steps below, but evaluates the filters per column block
+    if QUERY_ENGINE == 'compiled':
+        import query_compiler
+        return query_compiler.run(query, df)
     
     #Debugging: The initial user filter (query) - pprint displays the dictionary in a readable format
     #print("The user query:")
@@ -74,7 +86,8 @@ def main(query, df):
         #If transformations_to_apply is created, then a transformation block was added by the user  
         if transformations_to_apply:
             #A transformation was included - perform transformation and return transformed df
-            transformed_df = initial_transformation.transform_df(query, df)
+            with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='transform'):
+                transformed_df = initial_transformation.transform_df(query, df)
             df2 = transformed_df
         else:
             #No transformation was selected - return the initial df
@@ -103,7 +116,8 @@ def main(query, df):
         #This script is automatically run, as most users filter for gene lists
         #Within filter_genelists.py, only genelist-based blocks are processed, which is found in properties["query"] 
         #These include hard coded genelists (PULs, SPI1 etc), and also annotation-based genelists (KEGG, GO etc)
-        filtered_df = filter_genelists.filter_genelists(query, df2)
+        with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='filter'):
+            filtered_df = filter_genelists.filter_genelists(query, df2)
         
         
         #check if filtered_df was created - which will only happen if a genelist filter is user selected
@@ -144,7 +158,8 @@ def main(query, df):
         #print("all filters:: ")
         #pprint.pprint(all_filters)
 
-        row_filtered_df = row_filters.row_filters(query, filtered_df, all_filters)
+        with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='row_filter'):
+            row_filtered_df = row_filters.row_filters(query, filtered_df, all_filters)
 
 
         #check if row_filtered_df was created - which will only happen if a row filter is user selected
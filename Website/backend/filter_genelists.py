@@ -330,18 +330,12 @@ def filter_for(forms, properties, df2, comparison_operator, filter_area):
     #Anything that requires looking within the json annotation file - KEGG, GO etc
     elif properties["query"] == "annotation_code":
 
-        import json
-        #open annotation file
-        with open('static/gene_annotations.json') as json_file:
-            gene_annotations = json.load(json_file)
-        df_genes = df2[filter_area].tolist()
-        filter_value = []
-        # print(properties["code_type"])
-        for gene_locus in gene_annotations:
-            if gene_locus in df_genes and forms["filter_annotation"] in list(gene_annotations[gene_locus][properties["code_type"]]):
-                filter_value.append(gene_locus)
+        # Look up the loci annotated with the selected code in the process-wide index (see annotation_index.py),
+        # instead of reading gene_annotations.json for every filter.
+        import annotation_index
+        filter_value = annotation_index.loci_for(properties["code_type"], forms["filter_annotation"])
         #create mask
-        df_mask = df2[filter_area].isin(filter_value) #filter_value = user entered 
+        df_mask = df2[filter_area].isin(filter_value) #filter_value = loci annotated with the user entered code
 
 
     
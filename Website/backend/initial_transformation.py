@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 import operator
 import pprint
+import parallel_rows
 
 
 
@@ -131,6 +132,10 @@ def transform_df(query, df):
                     # ensuring the mask is applied correctly row-wise.
                     specific_mask_series = pd.Series(specific_mask, index=df.index, dtype=bool)
 
+                    # Categorical columns (repeated strings) can only hold their existing values, so convert them back to plain strings first.
+                    if isinstance(df[column].dtype, pd.CategoricalDtype):
+                        df[column] = df[column].astype(object)
+
                     # Apply the mask to the specific column in the DataFrame. The '.mask' method replaces values where the condition is True.
                     # Here, 'specific_mask_series' contains True for rows that should be replaced with 'other=target_value'.
                     # Rows corresponding to False in 'specific_mask_series' remain unchanged.
@@ -208,7 +213,7 @@ def transform_df(query, df):
 
             # df[filter_area] = np.log(df[filter_area].values) / np.log(float(block["forms"]["log_value"]))
             log_base = float(details["log_value"])
-            df[filter_area] = np.log(df[filter_area].values) / np.log(log_base)
+            df[filter_area] = parallel_rows.log_values(df[filter_area].values, log_base) # Row partitions on several cores for large dataframes
 
             # Replace any infinite values resulting from the log transformation with NaN, to avoid data errors.
             df.replace([np.inf, -np.inf], np.nan, inplace=True)
@@ -242,7 +247,7 @@ def transform_df(query, df):
                 # df[filter_area] = np.round(np.log(df[filter_area].values) / np.log(float(block["forms"]["log_value"])), 3) 
                 # NOTE: PERFORMANCE: Be careful with rounding when it comes to precision and performance. Maybe use pandas rounding function.
                 log_base = float(details["log_value"])
-                df[filter_area] = np.log(df[filter_area].values) / np.log(log_base)
+                df[filter_area] = parallel_rows.log_values(df[filter_area].values, log_base)
             except:
                 # If the log transformation fails (e.g., log of negative numbers), skip this step.
                 pass
@@ -475,16 +480,12 @@ def filter_for(forms, properties, df, comparison_operator, filter_area):
     # Search for locus tag's that include the entered annotation id (GO, KEGG, COG, etc.)
     elif properties["query"] == "annotation_code":
         
-        import json
-        with open('static/gene_annotations.json') as json_file:
-            gene_annotations = json.load(json_file)
-        df_genes = df[filter_area].tolist()
-        filter_value = []
-        # print(properties["code_type"])
-        for gene_locus in gene_annotations:
-            if gene_locus in df_genes and forms["filter_annotation"] in list(gene_annotations[gene_locus][properties["code_type"]]):
-                filter_value.append(gene_locus)
-        df_mask = df[filter_area].isin(filter_value)
+        # Look up the loci annotated with the selected code in the process-wide index (see annotation_index.py),
+        # instead of reading gene_annotations.json for every filter.
+        import annotation_index
+        filter_value = annotation_index.loci_for(properties["code_type"], forms["filter_annotation"])
+        #create mask
+        df_mask = df[filter_area].isin(filter_value) #filter_value = loci annotated with the user entered code
     
     
 
@@ -0,0 +1,165 @@
+#--------------------------------
+#
+# Background jobs for long-running requests
+#
+#--------------------------------
+
+# '/upload' used to parse, transform and merge the uploaded matrix and write the session inside the request. A large
+# Excel file blocked a request worker for the whole time, and the browser waited for the response without feedback.
+#
+# Here, such work is run as a job on a small pool of worker threads (JOB_WORKERS). submit() returns a job ID at once,
+# and the state of the job can be polled (see the route '/jobs/<job_id>'):
+#   queued -> running -> done (with a result) or failed (with an error message)
+# The number of jobs that are waiting or running in a process is limited (JOB_WORKERS + JOB_QUEUE_SIZE). If the queue
+# is full, submit() raises a RuntimeError, so the client can retry later instead of the backend running out of memory.
+#
+# The state of the jobs is kept in the MongoDB collection 'jobs', so every backend process can answer a status request,
+# no matter which process runs the job. Finished jobs are removed after JOB_TTL seconds.
+#
+# A process that is stopped (e.g. restarted or killed) can't finish its jobs anymore. Every process therefore updates
+# 'heartbeat' of its waiting and running jobs every JOB_HEARTBEAT seconds. A job without a heartbeat for JOB_TIMEOUT
+# seconds is marked as failed by remove_expired, and is removed with the other finished jobs after JOB_TTL seconds.
+
+import os
+import time
+import uuid
+import threading
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Configuration
+JOB_WORKERS = int(os.environ.get('MICROMIX_JOB_WORKERS', 2)) # Jobs that run at the same time
+JOB_QUEUE_SIZE = int(os.environ.get('MICROMIX_JOB_QUEUE_SIZE', 16)) # Jobs that may wait for a worker
+JOB_TTL = int(os.environ.get('MICROMIX_JOB_TTL', 3600)) # Seconds a finished job can be polled
+JOB_HEARTBEAT = int(os.environ.get('MICROMIX_JOB_HEARTBEAT', 30)) # Seconds between the heartbeats of a waiting or running job
+JOB_TIMEOUT = int(os.environ.get('MICROMIX_JOB_TIMEOUT', 300)) # Seconds without a heartbeat after which a job is failed
+
+_executor = None
+_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_SIZE)
+_lock = threading.Lock()
+_active_jobs = {} # The waiting and running jobs of this process, from job ID to (collection, heartbeat)
+
+
+
+#---
+# FUNCTION: submit
+# PURPOSE: Queues a function to be run by a worker.
+# PARAMETERS:
+#   collection: The MongoDB collection that holds the job states (db.jobs).
+#   kind: A short name of the job, e.g. 'upload'.
+#   function: The function to run. Its return value is stored as the result of the job and must be BSON-encodable.
+#   *args: The arguments of the function.
+#   cleanup: Optional function that is called after the job has finished, e.g. to remove temporary files.
+#   heartbeat: Optional function that is called with every heartbeat of the job, e.g. to keep its input from expiring.
+# RETURNS: The ID of the job.
+# NOTES: Raises a RuntimeError if JOB_WORKERS + JOB_QUEUE_SIZE jobs are already waiting or running in this process.
+#---
+def submit(collection, kind, function, *args, cleanup=None, heartbeat=None):
+    if not _slots.acquire(blocking=False):
+        raise RuntimeError('Too many jobs are waiting to be processed. Please try again in a moment.')
+    job_id = uuid.uuid4().hex
+    try:
+        now = datetime.utcnow()
+        collection.insert_one({'_id': job_id, 'kind': kind, 'status': 'queued', 'submitted': now, 'heartbeat': now, 'expires': now + timedelta(seconds=JOB_TTL)})
+        with _lock:
+            _active_jobs[job_id] = (collection, heartbeat)
+        get_executor().submit(run_job, collection, job_id, function, args, cleanup)
+    except Exception:
+        with _lock:
+            _active_jobs.pop(job_id, None)
+        _slots.release()
+        raise
+    return job_id
+
+
+
+#---
+# FUNCTION: run_job
+# PURPOSE: Runs a job in a worker thread and records its state.
+#---
+def run_job(collection, job_id, function, args, cleanup):
+    try:
+        collection.update_one({'_id': job_id}, {'$set': {'status': 'running', 'started': datetime.utcnow()}})
+        try:
+            result = function(*args)
+            update = {'status': 'done', 'result': result}
+        except Exception as e:
+            print('Job {} failed: {}'.format(job_id, e))
+            traceback.print_exc()
+            update = {'status': 'failed', 'error': str(e)}
+        now = datetime.utcnow()
+        update.update({'finished': now, 'expires': now + timedelta(seconds=JOB_TTL)})
+        collection.update_one({'_id': job_id}, {'$set': update})
+    finally:
+        with _lock:
+            _active_jobs.pop(job_id, None)
+        _slots.release()
+        if cleanup != None:
+            cleanup()
+
+
+
+#---
+# FUNCTION: status
+# PURPOSE: Returns the state of a job.
+# RETURNS: The job document (status, result or error, timestamps), or None if the job is unknown or expired.
+# NOTES: Only finished jobs expire. A waiting or running job is kept alive by its heartbeat, or failed by remove_expired.
+#---
+def status(collection, job_id):
+    job = collection.find_one({'_id': job_id})
+    if job == None or (job['status'] in ('done', 'failed') and job['expires'] < datetime.utcnow()):
+        return None
+    return job
+
+
+
+#---
+# FUNCTION: remove_expired
+# PURPOSE: Marks the jobs of stopped processes as failed and deletes the finished jobs that can no longer be polled.
+# NOTES: Called regularly by the status route. Waiting and running jobs are only removed after they were marked as failed.
+#        Visualizations (see visualize.py) have no heartbeat, they are removed once their deadline and 'expires' have passed.
+#---
+def remove_expired(collection):
+    now = datetime.utcnow()
+    collection.update_many({'status': {'$in': ['queued', 'running']}, 'heartbeat': {'$lt': now - timedelta(seconds=JOB_TIMEOUT)}},
+                           {'$set': {'status': 'failed', 'error': 'The job was interrupted because the server stopped. Please try again.',
+                                     'finished': now, 'expires': now + timedelta(seconds=JOB_TTL)}})
+    collection.delete_many({'expires': {'$lt': now}, '$or': [{'status': {'$in': ['done', 'failed']}}, {'deadline': {'$lt': now}}]})
+
+
+
+#---
+# FUNCTION: get_executor
+# PURPOSE: Returns the worker pool of this process, creating it with the first job.
+# NOTES: The pool is created lazily, so forked server processes don't inherit the threads of their parent.
+#---
+def get_executor():
+    global _executor
+    if _executor == None:
+        with _lock:
+            if _executor == None:
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='micromix-job')
+                threading.Thread(target=send_heartbeats, name='micromix-job-heartbeat', daemon=True).start()
+    return _executor
+
+
+
+#---
+# FUNCTION: send_heartbeats
+# PURPOSE: Updates the heartbeat of the waiting and running jobs of this process every JOB_HEARTBEAT seconds.
+# NOTES: Runs in a daemon thread of the process, which is started with its worker pool (see get_executor).
+#---
+def send_heartbeats():
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        with _lock:
+            active_jobs = list(_active_jobs.items())
+        for job_id, (collection, heartbeat) in active_jobs:
+            try:
+                collection.update_one({'_id': job_id, 'status': {'$in': ['queued', 'running']}}, {'$set': {'heartbeat': datetime.utcnow()}})
+                if heartbeat != None:
+                    heartbeat()
+            except Exception as e:
+                print('The heartbeat of job {} could not be sent: {}'.format(job_id, e))
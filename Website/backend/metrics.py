@@ -0,0 +1,110 @@
+#--------------------------------
+#
+# Prometheus metrics of the backend
+#
+#--------------------------------
+
+# The metrics are served in the Prometheus text format at '/metrics':
+#   micromix_request_duration_seconds      Latency per route (the route template, e.g. '/jobs/<job_id>'), method and status.
+#                                          Streamed responses (exports, '/config/arrow') are measured until the response
+#                                          is created, not until the last byte has been sent.
+#   micromix_parquet_seconds               Time spent encoding ('write') and decoding ('read') dataframes as parquet.
+#   micromix_filter_stage_seconds          Time spent in each stage of filter_dataframe.main ('transform', 'filter',
+#                                          'row_filter').
+#   micromix_session_document_bytes        BSON size of the session documents that are written.
+#   micromix_blob_bytes                    Size of the blobs that are written to and read from the blob store.
+#   micromix_plugin_dispatch_seconds       Time spent in visualize.route, per plugin.
+#   micromix_query_cache_requests_total    Lookups in the query cache, per result ('hit', 'miss').
+#
+# gunicorn runs several worker processes. If the environment variable PROMETHEUS_MULTIPROC_DIR is set (see Dockerfile),
+# every process writes its metrics to this folder and '/metrics' returns the metrics of all processes (see
+# gunicorn.conf.py). Without it, '/metrics' only returns the metrics of the process answering the request.
+
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import Histogram, Counter, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+
+
+# Configuration
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Buckets of the size histograms, from 1 kB to 256 MB.
+SIZE_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(10))
+
+
+REQUEST_SECONDS = Histogram('micromix_request_duration_seconds', 'Latency of the HTTP requests.', ['method', 'endpoint', 'status'])
+PARQUET_SECONDS = Histogram('micromix_parquet_seconds', 'Time spent encoding and decoding parquet.', ['operation'])
+FILTER_STAGE_SECONDS = Histogram('micromix_filter_stage_seconds', 'Time spent in each stage of a query.', ['stage'])
+SESSION_DOCUMENT_BYTES = Histogram('micromix_session_document_bytes', 'BSON size of the written session documents.', ['operation'], buckets=SIZE_BUCKETS)
+BLOB_BYTES = Histogram('micromix_blob_bytes', 'Size of the blobs written to and read from the blob store.', ['operation'], buckets=SIZE_BUCKETS)
+PLUGIN_DISPATCH_SECONDS = Histogram('micromix_plugin_dispatch_seconds', 'Time spent creating a visualization with a plugin.', ['plugin'])
+QUERY_CACHE_REQUESTS = Counter('micromix_query_cache_requests', 'Lookups in the query cache.', ['result'])
+
+
+
+#---
+# FUNCTION: timed
+# PURPOSE: Context manager that observes the time spent in its block in a histogram.
+# PARAMETERS:
+#   histogram: One of the histograms above.
+#   **labels: The labels of the histogram, e.g. stage='filter'.
+#---
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+
+#---
+# FUNCTION: observe_document
+# PURPOSE: Observes the BSON size of a session document that is written to MongoDB.
+# PARAMETERS:
+#   db_entry: The session document of an insert, or the update document (e.g. {'$set': changes}) that is sent.
+#   operation: 'insert' or 'update'.
+#---
+def observe_document(db_entry, operation):
+    import bson
+    SESSION_DOCUMENT_BYTES.labels(operation=operation).observe(len(bson.BSON.encode(db_entry)))
+
+
+
+#---
+# FUNCTION: init_app
+# PURPOSE: Measures the latency of every request of a Flask application.
+#---
+def init_app(app):
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if 'metrics_start' in g:
+            # The route template keeps the number of label values small (no session or job IDs).
+            endpoint = request.url_rule.rule if request.url_rule != None else 'unmatched'
+            REQUEST_SECONDS.labels(method=request.method, endpoint=endpoint, status=response.status_code).observe(time.perf_counter() - g.metrics_start)
+        return response
+
+
+
+#---
+# FUNCTION: latest
+# PURPOSE: Returns the current metrics in the Prometheus text format.
+# RETURNS: A tuple of the encoded metrics and their content type.
+#---
+def latest():
+    if MULTIPROCESS_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
@@ -0,0 +1,79 @@
+#--------------------------------
+#
+# MongoDB connection of the backend processes
+#
+#--------------------------------
+
+# The backend used to create one MongoClient when app.py was imported. A MongoClient starts background threads and
+# opens connections right away, which must not be shared with forked worker processes (e.g. of gunicorn).
+#
+# Here, the client is created lazily by the process that uses it, and re-created if the process has been forked since.
+# Its connection pool and timeouts are configured with environment variables, per worker process:
+#   MICROMIX_MONGO_HOST, MICROMIX_MONGO_PORT: The MongoDB server. '172.17.0.1' is often the Docker default bridge
+#       network gateway, allowing containers to connect to the host. For a local MongoDB install, use 'localhost'.
+#   MICROMIX_MONGO_MAX_POOL_SIZE, MICROMIX_MONGO_MIN_POOL_SIZE: The number of connections per process.
+#   MICROMIX_MONGO_CONNECT_TIMEOUT_MS, MICROMIX_MONGO_SERVER_SELECTION_TIMEOUT_MS, MICROMIX_MONGO_SOCKET_TIMEOUT_MS,
+#   MICROMIX_MONGO_WAIT_QUEUE_TIMEOUT_MS: The timeouts in milliseconds (0 waits without a limit).
+
+import os
+import threading
+from pymongo import MongoClient
+
+
+# Configuration
+MONGO_HOST = os.environ.get('MICROMIX_MONGO_HOST', '172.17.0.1')
+MONGO_PORT = int(os.environ.get('MICROMIX_MONGO_PORT', 27017))
+MONGO_DATABASE = os.environ.get('MICROMIX_MONGO_DATABASE', 'micromix')
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MICROMIX_MONGO_MAX_POOL_SIZE', 50))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MICROMIX_MONGO_MIN_POOL_SIZE', 0))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_SOCKET_TIMEOUT_MS', 0))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MICROMIX_MONGO_WAIT_QUEUE_TIMEOUT_MS', 0))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+
+#---
+# FUNCTION: get_client
+# PURPOSE: Returns the MongoClient of this process, creating it on first use.
+# NOTES: connect=False delays the first connection until the first operation, so a client that is created before a
+#        fork has no threads or sockets yet. A forked process still gets a new client, because the pid has changed.
+#---
+def get_client():
+    global _client, _client_pid
+    if _client == None or _client_pid != os.getpid():
+        with _lock:
+            if _client == None or _client_pid != os.getpid():
+                _client = MongoClient(MONGO_HOST, MONGO_PORT,
+                                      connect=False,
+                                      maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                      minPoolSize=MONGO_MIN_POOL_SIZE,
+                                      connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                                      serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                                      socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS or None,
+                                      waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS or None)
+                _client_pid = os.getpid()
+    return _client
+
+
+
+#---
+# FUNCTION: get_db
+# PURPOSE: Returns the micromix database of this process.
+#---
+def get_db():
+    return get_client()[MONGO_DATABASE]
+
+
+
+#---
+# FUNCTION: ping
+# PURPOSE: Checks that the MongoDB server can be reached. Raises an exception (after the server selection timeout)
+#          otherwise.
+#---
+def ping():
+    get_client().admin.command('ping')
@@ -0,0 +1,192 @@
+#--------------------------------
+#
+# Row-partitioned evaluation on several cores
+#
+#--------------------------------
+
+# The masks of the filters and the element-wise transformations of a query are computed with NumPy, which only uses one
+# core. For large dataframes, the rows are split into partitions here, and every partition is evaluated by a process of
+# a process pool:
+#   1. The values (a 2D NumPy block, rows x columns) are copied once into a shared memory buffer.
+#   2. Each process attaches to the buffer, evaluates its rows and writes the result into a second shared buffer.
+#   3. The result is copied out of the shared buffer, so it is in the original row order.
+# No values are pickled and sent to the processes, only the names of the buffers and the row ranges.
+#
+# The parallel path is only used for blocks with at least PARALLEL_ROW_THRESHOLD rows. Smaller blocks (and blocks of
+# strings or other Python objects, which can't be shared) are evaluated in the request thread, as before. Both paths run
+# the same NumPy operations on the same values, so the results are identical.
+
+import os
+import math
+import threading
+import numpy as np
+from functools import partial
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Configuration
+PARALLEL_ROW_THRESHOLD = int(os.environ.get('MICROMIX_PARALLEL_ROW_THRESHOLD', 100000)) # 0 disables the parallel path
+PARALLEL_WORKERS = int(os.environ.get('MICROMIX_PARALLEL_WORKERS', os.cpu_count() or 1))
+PARTITION_MIN_ROWS = 20000 # Smaller partitions cost more in overhead than they save
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+
+#---
+# FUNCTION: block_mask
+# PURPOSE: Compares a 2D block with a filter and reduces the result per row.
+# PARAMETERS:
+#   block: The 2D NumPy array (rows x columns).
+#   compare: Function that compares a 2D array with the filter value. Must be picklable (e.g. a functools.partial of
+#            a module-level function) to be used in the parallel path.
+#   reduce_all: True if all columns of a row have to match, False if any column has to match.
+# RETURNS: A 1D boolean array with one entry per row.
+#---
+def block_mask(block, compare, reduce_all):
+    partitions = row_partitions(block)
+    if partitions == None:
+        return reduce_rows(np.asarray(compare(block), dtype=bool), reduce_all)
+    return run_partitions(block, np.dtype(bool), (block.shape[0],), partial(mask_partition, compare=compare, reduce_all=reduce_all), partitions)
+
+
+
+#---
+# FUNCTION: log_values
+# PURPOSE: Computes the logarithm of a 2D block to the given base, i.e. np.log(values) / np.log(log_base).
+#---
+def log_values(values, log_base):
+    partitions = row_partitions(values)
+    if partitions == None:
+        return np.log(values) / np.log(log_base)
+    out_dtype = (np.log(np.ones(1, dtype=values.dtype)) / np.log(log_base)).dtype
+    return run_partitions(values, out_dtype, values.shape, partial(log_partition, log_base=log_base), partitions)
+
+
+
+#---
+# FUNCTION: reduce_rows
+# PURPOSE: Reduces a 2D boolean mask to one entry per row.
+#---
+def reduce_rows(mask, reduce_all):
+    return mask.all(axis=1) if reduce_all else mask.any(axis=1)
+
+
+
+#---
+# FUNCTION: row_partitions
+# PURPOSE: Splits the rows of a block into the partitions of the parallel path.
+# RETURNS: A list of (start, stop) row ranges, or None if the block is evaluated in the calling thread.
+#---
+def row_partitions(values):
+    rows = values.shape[0]
+    if PARALLEL_ROW_THRESHOLD <= 0 or PARALLEL_WORKERS <= 1 or rows < PARALLEL_ROW_THRESHOLD:
+        return None
+    if values.ndim != 2 or values.dtype.kind not in 'biuf':
+        return None
+    partition_count = min(PARALLEL_WORKERS, math.ceil(rows / PARTITION_MIN_ROWS))
+    if partition_count <= 1:
+        return None
+    bounds = np.linspace(0, rows, partition_count + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+
+#---
+# FUNCTION: run_partitions
+# PURPOSE: Evaluates a function on row partitions of a block in the process pool.
+# PARAMETERS:
+#   values: The 2D NumPy input block.
+#   out_dtype, out_shape: The dtype and shape of the result. Its first dimension are the rows of the block.
+#   function: The function evaluated per partition, e.g. mask_partition. It is called with (values, out, start, stop).
+#   partitions: The (start, stop) row ranges.
+# RETURNS: The result as a NumPy array, with the rows in the original order.
+#---
+def run_partitions(values, out_dtype, out_shape, function, partitions):
+    values = np.ascontiguousarray(values)
+    in_buffer = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    out_buffer = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * out_dtype.itemsize, 1))
+    try:
+        shared_values = np.ndarray(values.shape, dtype=values.dtype, buffer=in_buffer.buf)
+        shared_values[...] = values
+        del shared_values
+        in_spec = (in_buffer.name, values.shape, values.dtype.str)
+        out_spec = (out_buffer.name, out_shape, out_dtype.str)
+        futures = [get_executor().submit(run_partition, function, in_spec, out_spec, start, stop) for start, stop in partitions]
+        for future in futures:
+            future.result()
+        result = np.ndarray(out_shape, dtype=out_dtype, buffer=out_buffer.buf).copy()
+    finally:
+        in_buffer.close()
+        in_buffer.unlink()
+        out_buffer.close()
+        out_buffer.unlink()
+    return result
+
+
+
+#---
+# FUNCTION: run_partition
+# PURPOSE: Runs in a pool process. Attaches to the shared input and output buffers and evaluates one partition.
+#---
+def run_partition(function, in_spec, out_spec, start, stop):
+    in_buffer = attach(in_spec[0])
+    out_buffer = attach(out_spec[0])
+    try:
+        values = np.ndarray(in_spec[1], dtype=np.dtype(in_spec[2]), buffer=in_buffer.buf)
+        out = np.ndarray(out_spec[1], dtype=np.dtype(out_spec[2]), buffer=out_buffer.buf)
+        function(values, out, start, stop)
+        del values, out # The buffers can only be closed once no array uses them.
+    finally:
+        in_buffer.close()
+        out_buffer.close()
+
+
+
+#---
+# FUNCTION: mask_partition
+# PURPOSE: The partition function of block_mask.
+#---
+def mask_partition(values, out, start, stop, compare, reduce_all):
+    out[start:stop] = reduce_rows(np.asarray(compare(values[start:stop]), dtype=bool), reduce_all)
+
+
+
+#---
+# FUNCTION: log_partition
+# PURPOSE: The partition function of log_values.
+#---
+def log_partition(values, out, start, stop, log_base):
+    with np.errstate(divide='ignore', invalid='ignore'): # -inf and NaN are handled by the caller, as before.
+        out[start:stop] = np.log(values[start:stop]) / np.log(log_base)
+
+
+
+#---
+# FUNCTION: attach
+# PURPOSE: Attaches to a shared memory buffer that is owned (and removed) by the calling process.
+# NOTES: The pool processes share the resource tracker of the server process, which removes the buffers if the server
+#        process dies. Attaching registers them there a second time, which has no effect.
+#---
+def attach(name):
+    return shared_memory.SharedMemory(name=name)
+
+
+
+#---
+# FUNCTION: get_executor
+# PURPOSE: Returns the process pool, creating it with the first parallel evaluation.
+# NOTES: The processes are started with 'spawn', so they don't inherit the threads and connections of the server
+#        process. A forked server process creates its own pool.
+#---
+def get_executor():
+    global _executor, _executor_pid
+    if _executor == None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor == None or _executor_pid != os.getpid():
+                _executor = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS, mp_context=get_context('spawn'))
+                _executor_pid = os.getpid()
+    return _executor
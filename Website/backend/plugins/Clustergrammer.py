@@ -1,42 +1,75 @@
+import os
+
+# The visualizing server endpoint. Point it to a local server (e.g. a stub for testing) with MICROMIX_CLUSTERGRAMMER_URL.
+UPLOAD_URL = os.environ.get('MICROMIX_CLUSTERGRAMMER_URL', 'https://amp.pharm.mssm.edu/clustergrammer/matrix_upload/')
+UPLOAD_TIMEOUT = 60 # Seconds, if the plugin is not given a timeout (see visualize.py)
+CHUNK_ROWS = 5000 # Rows of the matrix that are written and sent at once
+
 def main(parameters):
     import requests
-    import pandas as pd
-    from io import StringIO
+    import uuid
     df = parameters["df"]
-    dataframe = prepare_df(df) # Define the path to the file you want to visualize.
-    output = StringIO()
-    dataframe.to_csv(output, sep='\t', index=False)
-    output.name = "output.txt"
-    output.seek(0)  
-    upload_url = "https://amp.pharm.mssm.edu/clustergrammer/matrix_upload/" # Define the path to the visualizing server endpoint.
-    response = requests.post(upload_url, files={'file': output})
+    dataframe, header = prepare_df(df) # The matrix you want to visualize, and the first line of its file.
+    # The file is sent as a multipart form, built piece by piece while it is uploaded, so the whole TSV file is never
+    # held in memory.
+    boundary = uuid.uuid4().hex
+    # The request may not take longer than the time left for the plugin, a slow server fails the visualization instead
+    # of blocking a worker.
+    response = requests.post(UPLOAD_URL, data=multipart_body(dataframe, header, boundary),
+                             headers={'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)},
+                             timeout=parameters.get("timeout") or UPLOAD_TIMEOUT)
+    response.raise_for_status()
     print(response.text)
     vis_link = response.text.replace("http://","https://")
     return vis_link
 
+def multipart_body(dataframe, header, boundary):
+    # Yield the form with the single field 'file' (as 'output.txt'), the TSV file in chunks of CHUNK_ROWS rows.
+    yield ('--{}\r\nContent-Disposition: form-data; name="file"; filename="output.txt"\r\n'
+           'Content-Type: text/plain\r\n\r\n'.format(boundary)).encode()
+    yield (header + '\n').encode()
+    for start in range(0, len(dataframe), CHUNK_ROWS):
+        yield write_tsv(dataframe.iloc[start:start + CHUNK_ROWS])
+    yield '\r\n--{}--\r\n'.format(boundary).encode()
+
+def write_tsv(dataframe):
+    # Write rows as TSV without header. The Arrow CSV writer is several times faster than pandas. It writes whole
+    # numbers without '.0', which Clustergrammer reads the same way. Labels that contain tabs, quotes or line breaks
+    # can't be written without quoting, those chunks are written by pandas.
+    import io
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    output = io.BytesIO()
+    try:
+        table = pa.Table.from_pandas(dataframe.rename(columns=str), preserve_index=False)
+        pa_csv.write_csv(table, output, pa_csv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none'))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return dataframe.to_csv(sep='\t', index=False, header=False).encode()
+    return output.getvalue()
+
 def prepare_df(df):
     import pandas as pd
-    import copy
-    import numpy as np
-    dataframe = copy.deepcopy(df)
 
     # Append category title string before values for all cat columns.
-    # dataframe[dataframe.columns[0:cat_amount]] = dataframe.columns[0:cat_amount] + \
-    #     ': ' + dataframe[dataframe.columns[0:cat_amount]].astype(str)
     # Remove the category titles from first row.
-    # categories = list(df.select_dtypes(exclude=[np.number]).columns) # Get all columns that are non numerics
-    # value_columns = [x for x in list(df.columns) if x not in categories] # Get all columns that are not category columns
     value_columns = [name for name in list(df.columns) if name.startswith('(') and ") " in name]
     categories = [x for x in list(df.columns) if x not in value_columns] # Get all columns that are not value columns
-    dataframe_reordered_columns = categories + value_columns
-    dataframe = dataframe[dataframe_reordered_columns] # Put all categories column to the beginning of the dataframe.
-    if len(categories) > 0:
-        for category in categories:
-            dataframe[category] = dataframe[category].name + ': ' + dataframe[category].astype(str)
-            dataframe = dataframe.rename(columns={category: ''})
-    else:
-        dataframe.columns[0] = dataframe.columns[0].name + ': ' + dataframe.columns[0].astype(str)
-        dataframe = dataframe.rename(columns={dataframe.columns[0]: ''})
-    # Export the data frame as tab-seperated .txt.
-    print('Output file has been generated and saved.')
-    return dataframe
\ No newline at end of file
+    if len(categories) == 0:
+        # Without category columns, the first column labels the rows.
+        categories = value_columns[:1]
+        value_columns = value_columns[1:]
+    # Put all categories column to the beginning of the dataframe. Only the label columns are new, the value columns are
+    # shared with df instead of copying the whole frame.
+    columns = {}
+    for position, category in enumerate(categories):
+        # Each distinct value is labelled once ('name: value'), then the labels are spread to the rows by their codes.
+        codes, uniques = pd.factorize(df[category].astype(str))
+        labels = pd.Index([str(category) + ': ' + value for value in uniques], dtype=object)
+        columns[position] = labels.take(codes)
+    for position, name in enumerate(value_columns):
+        columns[len(categories) + position] = df[name].to_numpy(copy=False)
+    dataframe = pd.DataFrame(columns, index=df.index, copy=False)
+    # The category columns have no title in the first row of the file.
+    header = '\t'.join([''] * len(categories) + [str(name) for name in value_columns])
+    print('Output file has been generated.')
+    return dataframe, header
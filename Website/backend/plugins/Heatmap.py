@@ -1,3 +1,7 @@
+# The link opens the heatmap with the session itself ('?config=<db_entry_id>'), so it is remembered per session (see
+# visualize.py).
+LINK_PER_SESSION = True
+
 def main(parameters):
     upload_url = "http://127.0.0.1:8081/"
     print("heatmap.py")
@@ -1,8 +1,11 @@
+import os
 import uuid
 import pandas as pd
 from bson.json_util import ObjectId, dumps
 import numpy as np
-from io import BytesIO
+import blob_store
+import sessions
+import metrics
 
 # Constants for controlling the display limits of the matrices and preview elements.
 max_preview_rows = 12
@@ -10,6 +13,11 @@ max_preview_columns = 8
 max_y = 1
 active_matrices = [[]]
 
+# How the transformed_dataframe is updated when matrices are added or removed.
+#   'incremental' - The current merged dataframe is kept. A matrix added in the last slot is joined once, other changes rebuild it.
+#   'full'        - The merged dataframe is rebuilt from every active matrix on each change.
+MERGE_MODE = os.environ.get('MICROMIX_MERGE_MODE', 'incremental')
+
 
 #---
 # FUNCTION: convert_to_df
@@ -18,11 +26,19 @@ active_matrices = [[]]
 #   input_file: The file to be converted.
 #   extension: The file extension to determine the appropriate pandas reader function.
 #   metadata: A dictionary containing formatting details like column separators, decimal characters, and specific columns to use.
+#   use_cache: If True, bundled database files are read from the pre-parsed cache (see static_cache.py).
 # RETURNS: A pandas DataFrame after applying specified formatting and transformations.
 #---
 
-def convert_to_df(input_file, extension, metadata):
+def convert_to_df(input_file, extension, metadata, use_cache=True):
     import experimental_features
+    # Bundled database files never change, so they are parsed only once and then read from the cache.
+    if use_cache and metadata.get('source', {}).get('database') != None and extension in ('.csv', '.txt', '.tsv'):
+        import static_cache
+        parse_all_columns = lambda: convert_to_df(input_file, extension, dict(metadata, database_columns=[]), use_cache=False)
+        df = static_cache.read_static_df(input_file, extension, metadata, parse_all_columns)
+        if df is not None:
+            return df
     # Conditional logic to handle different file types using pandas reader functions.
     if extension == ".xlsx":
         df = pd.read_excel(input_file)
@@ -35,6 +51,11 @@ def convert_to_df(input_file, extension, metadata):
     # Handling for text files with tab separation (TSV).
     elif extension == ".txt" or extension == ".tsv":
         df = pd.read_csv(input_file, sep='\t', decimal=metadata["formatting"]["file"]["decimal_character"], on_bad_lines='skip')
+    # Files of chunked uploads that were already parsed into parquet (see chunked_uploads.py).
+    elif extension == ".parquet":
+        df = experimental_features.missing_text_to_nan(pd.read_parquet(input_file))
+        if len(metadata["database_columns"]) > 0:
+            df = df[[column for column in df.columns if column in metadata["database_columns"]]]
     # Special case for handling strings directly as CSV data.
     elif extension == "string":
         from io import StringIO
@@ -64,12 +85,17 @@ def insert_update_entry(entry, collection, metadata):
     # NOTE: WARNING: This function aims to prevent any updates on locked sessions. 
     # Be very careful when touching this!
     # More secure methods to avoid unwanted updates are welcome.
+    # Only the fields that differ from the stored session are written. A locked session gets a child session that
+    # inherits all other fields from it (see sessions.py).
     if entry['locked'] == True: # Insert new entry if visualization is locked or new
-        entry['locked'] = False
-        db_entry_id = collection.insert_one(entry).inserted_id
+        db_entry_id = sessions.insert_child(collection.database, metadata['db_entry_id'], sessions.changed_fields(collection.database, metadata['db_entry_id'], entry))
         return_msg = db_entry_id
     elif entry['locked'] == False: # Update existing entry if existing visualization is modified and not locked
-        collection.update_one({'_id': ObjectId(metadata['db_entry_id'])}, {'$set': entry})
+        changes = sessions.changed_fields(collection.database, metadata['db_entry_id'], entry)
+        if len(changes) > 0:
+            update = {'$set': changes}
+            metrics.observe_document(update, 'update')
+            collection.update_one({'_id': ObjectId(metadata['db_entry_id'])}, update)
         db_entry_id = ObjectId(metadata['db_entry_id'])
         return_msg = db_entry_id
     else:
@@ -97,7 +123,8 @@ def remove_matrix(mockup_db_entry, metadata, db, remove_id):
     from pymongo import MongoClient
 
     # Retrieve the current database entry based on ID from metadata.
-    db_entry = db.visualizations.find_one({"_id": ObjectId(metadata['db_entry_id'])}, {'_id': False})
+    db_entry = sessions.find_session(db, ObjectId(metadata['db_entry_id']), {'_id': False})
+    removed_matrices = [matrix for matrix in sum(db_entry['active_matrices'], []) if matrix['id'] == remove_id]
     
      # Remove the specified matrix and clean up empty subarrays
     db_entry['active_matrices'] = [[i for i in nested if i['id'] != remove_id] for nested in db_entry['active_matrices']] # remove entries matching the remove_id
@@ -112,7 +139,7 @@ def remove_matrix(mockup_db_entry, metadata, db, remove_id):
     # Insert or update the database entry based on the presence of active matrices.
     if len(sum(db_entry['active_matrices'], []))>0:
         print('sum long enough')
-        db_entry = merge_db_entry(db_entry, sum(db_entry['active_matrices'], []))
+        db_entry = update_merged_entry(db_entry, removed_matrices, None, db)
         db_entry['preview_matrices'] = make_preview_matrices(db_entry['active_matrices'])
 
         # db_entry['vis_links'] = visualize.route(db.plugins, pd.DataFrame.from_dict(db_entry['transformed_dataframe']), metadata['categories'], db_entry['plugins_id']) # CHANGE: Right now every new visualization creates a new MongoDB entry
@@ -173,15 +200,15 @@ def remove_df_title(title):
 #        updating the active_matrices list, and either creating a new database entry or updating an existing one.
 #---
 
-# NOTE: This is a giant pile of 'mess'. Currently there only exists one dataframe and any kind of 
-# addition or subtractions means completely rebuilding this df from every source df in active_matrices.
+# NOTE: This is a giant pile of 'mess'. Currently there only exists one dataframe. In the 'incremental' MERGE_MODE, a matrix
+# added in the last slot is joined into this df directly, otherwise it is completely rebuilt from every source df in active_matrices.
 
 def add_matrix(input_file, metadata, extension, db, pre_configured_plugins):
     from pymongo import MongoClient
     # Check if this operation is for an existing visualization based on the presence of a database entry ID in the metadata.
     if metadata['db_entry_id'] != '': # If you edit an existing visualization
         # Retrieve the existing visualization entry from the database.
-        db_entry = db.visualizations.find_one({"_id": ObjectId(metadata['db_entry_id'])}, {'_id': False})
+        db_entry = sessions.find_session(db, ObjectId(metadata['db_entry_id']), {'_id': False})
         df = convert_to_df(input_file, extension, metadata)
         # Apply a data transformation if specified in the metadata.
         if metadata['transformation'] != '':
@@ -189,7 +216,7 @@ def add_matrix(input_file, metadata, extension, db, pre_configured_plugins):
             import transform_dataframe
             for matrix in sum(db_entry['active_matrices'], []):
                 if matrix['id'] == metadata['matrix_id']:
-                    df_old = pd.read_parquet(BytesIO(matrix['dataframe']))
+                    df_old = blob_store.read_df(db, matrix['dataframe'])
                     try:
                         # Attempt to strip titles from the columns of the old DataFrame before transformation.
                         df_old.rename(columns=lambda title: remove_df_title(title), inplace=True) # Remove the title from the old base df.
@@ -201,15 +228,19 @@ def add_matrix(input_file, metadata, extension, db, pre_configured_plugins):
         # Rename DataFrame columns to include the visualization title.
         df = rename_df_columns(df, metadata["title"])
         # Update the active matrices with the new or transformed DataFrame.
-        db_entry['active_matrices'], added_axis = make_active_matrix(metadata, df, db_entry['active_matrices'], df_to_parquet(df))
-        # Merge all active matrices into a single DataFrame for the visualization.
-        db_entry = merge_db_entry(db_entry, sum(db_entry['active_matrices'], []))
+        previous_matrices = sum(db_entry['active_matrices'], [])
+        db_entry['active_matrices'], added_axis = make_active_matrix(metadata, df, db_entry['active_matrices'], blob_store.store_df(db, df))
+        # A matrix that is uploaded into an occupied slot replaces the matrix in this slot.
+        current_ids = [matrix['id'] for matrix in sum(db_entry['active_matrices'], [])]
+        replaced_matrices = [matrix for matrix in previous_matrices if matrix['id'] not in current_ids]
+        # Merge the new matrix into the single DataFrame for the visualization.
+        db_entry = update_merged_entry(db_entry, replaced_matrices, df, db)
     # If you create a new visualization
     else: 
         # For new visualizations, convert the input file to a DataFrame and initialize a new database entry.
         df = convert_to_df(input_file, extension, metadata)
         df = rename_df_columns(df, metadata["title"])
-        db_entry = new_db_entry(df, metadata, pre_configured_plugins)
+        db_entry = new_db_entry(df, metadata, pre_configured_plugins, db)
 
     # Update the database entry with additional visualization properties.
     db_entry['preview_matrices'] = make_preview_matrices(db_entry['active_matrices'])
@@ -220,6 +251,7 @@ def add_matrix(input_file, metadata, extension, db, pre_configured_plugins):
 
     # Insert the new visualization entry into the database or update the existing one.
     if metadata['db_entry_id'] == '': # Enter new DB entry when creating a new visualization
+        metrics.observe_document(db_entry, 'insert')
         db_entry_id = db.visualizations.insert_one(db_entry).inserted_id
     else:  #Update existing DB entry when modifying an existing visualization
         db_entry_id = insert_update_entry(db_entry, db.visualizations, metadata)
@@ -228,72 +260,133 @@ def add_matrix(input_file, metadata, extension, db, pre_configured_plugins):
 
 
 
+#---
+# FUNCTION: update_merged_entry
+# PURPOSE: Updates the merged DataFrame of a database entry after matrices have been added or removed. Depending on MERGE_MODE,
+#          an added matrix is joined into the current merged DataFrame, or it is rebuilt from all active matrices.
+# PARAMETERS:
+#   db_entry: The current database entry, with active_matrices already updated.
+#   removed_matrices: The matrices that were removed (or replaced) from active_matrices.
+#   added_df: The DataFrame of the newly added matrix (the last one in make_active_matrix), or None if nothing was added.
+#   db: The database connection object, used to read and store the dataframes.
+# RETURNS: The updated database entry with the merged DataFrame.
+# NOTES: The outer merge joins on every shared column, sorts the rows by them and changes the dtypes of columns that get
+#        missing values, so its result depends on the order of the joins. Only the last join of the rebuild can be
+#        repeated in place: a matrix added in the last slot is joined, every other change (a removed or replaced matrix,
+#        a matrix in an earlier slot) rebuilds the DataFrame. benchmarks/check_merge_modes.py compares both paths.
+#        The incremental path is only used if the entry records the matrices of its merged DataFrame (merged_matrices, see
+#        store_merged_entry). Older entries are rebuilt once and are updated incrementally from then on.
+#---
+def update_merged_entry(db_entry, removed_matrices, added_df, db):
+    flattened_am = sum(db_entry['active_matrices'], [])
+    if MERGE_MODE != 'incremental' or added_df is None or len(removed_matrices) > 0 or not can_merge_incrementally(db_entry):
+        return merge_db_entry(db_entry, flattened_am, db)
+
+    # The added matrix is already part of active_matrices, but not yet part of the merged DataFrame. All other matrices have
+    # to be merged in slot order.
+    merged_ids = db_entry['merged_matrices']['ids']
+    if [matrix['id'] for matrix in flattened_am[:-1]] != merged_ids or flattened_am[-1]['id'] in merged_ids:
+        return merge_db_entry(db_entry, flattened_am, db)
+    df_merged = join_matrix(blob_store.read_df(db, db_entry['transformed_dataframe']), added_df)
+
+    return store_merged_entry(db_entry, df_merged, [matrix['id'] for matrix in flattened_am], db)
+
+
+
+#---
+# FUNCTION: can_merge_incrementally
+# PURPOSE: Checks if the merged DataFrame of a database entry can be updated in place.
+# PARAMETERS:
+#   db_entry: The current database entry.
+# RETURNS: True if the entry has a merged DataFrame and records which matrices it was merged from.
+#---
+def can_merge_incrementally(db_entry):
+    if not blob_store.has_blob(db_entry.get('transformed_dataframe')) or not isinstance(db_entry.get('merged_matrices'), dict):
+        return False
+    # The matrices have to belong to the current merged DataFrame (e.g. not to the one before all matrices were removed).
+    return db_entry['merged_matrices'].get('frame') == blob_store.blob_id_of(db_entry['transformed_dataframe'])
+
+
+
+#---
+# FUNCTION: join_matrix
+# PURPOSE: Joins the DataFrame of a single matrix into the merged DataFrame, using the same outer merge as merge_db_entry.
+# PARAMETERS:
+#   df_merged: The current merged DataFrame.
+#   df: The DataFrame of the matrix to join.
+# RETURNS: The new merged DataFrame.
+#---
+def join_matrix(df_merged, df):
+    if len(df_merged.columns) == 0:
+        return df.reset_index(drop=True)
+    return pd.merge(df_merged, df, how='outer') # NOTE: Performance - a single merge per added matrix
+
+
+
 #---
 # FUNCTION: merge_db_entry
-# PURPOSE: Merges multiple DataFrames (from a flattened active matrices list) into a single DataFrame, and updates the database entry with this merged DataFrame stored in a binary format suitable for MongoDB.
+# PURPOSE: Merges multiple DataFrames (from a flattened active matrices list) into a single DataFrame, and updates the database entry with a reference to this merged DataFrame in the blob store.
 # PARAMETERS:
 #   db_entry: The current database entry being worked on.
-#   flattened_am: A flattened list of active matrices, each containing a reference to a DataFrame stored as a binary object.
+#   flattened_am: A flattened list of active matrices, each containing a blob reference to its DataFrame.
+#   db: The database connection object, used to read and store the dataframes.
 # RETURNS: The updated database entry with the merged DataFrame.
-# NOTES: This function is critical for consolidating multiple DataFrames into a single, comprehensive DataFrame. It utilizes an outer join to ensure all data is retained, which may highlight the need for performance optimization in future updates.
+# NOTES: This is the full rebuild. It utilizes an outer join to ensure all data is retained. The order of the merged matrices
+#        is recorded, so a later matrix can be joined incrementally (see update_merged_entry).
 #---
-def merge_db_entry(db_entry, flattened_am):
+def merge_db_entry(db_entry, flattened_am, db):
     # Initialize merging with the first DataFrame to establish the base for subsequent merges.
-    df_merged = pd.read_parquet(BytesIO(flattened_am[0]['dataframe']))
+    df_merged = pd.DataFrame()
 
     # Iterate over each matrix, merging its DataFrame with the accumulated DataFrame.
-    for i in range(len(flattened_am)): # Looping through. This could be replaced in the future by merging only with the single transformed_dataframe.
-        df_merged = pd.merge(df_merged, pd.read_parquet(BytesIO(flattened_am[i]['dataframe'])), how='outer') # NOTE: Performance
+    # The first matrix is not merged with itself anymore, this duplicated rows without adding any information.
+    for matrix in flattened_am:
+        df_merged = join_matrix(df_merged, blob_store.read_df(db, matrix['dataframe']))
     # df_merged.fillna(np.nan, inplace=True) # Replace NA values with 0
     
-    # Convert the merged DataFrame back into a binary format for storage in the database.
-    db_entry['transformed_dataframe'] = df_to_parquet(df_merged)
-    return db_entry
+    return store_merged_entry(db_entry, df_merged, [matrix['id'] for matrix in flattened_am], db)
 
 
 
 #---
-# FUNCTION: df_to_parquet
-# PURPOSE: Converts a pandas DataFrame into a binary format using Parquet, suitable for storage in a binary field in MongoDB.
-# PARAMETERS:
-#   df: The pandas DataFrame to be converted.
-# RETURNS: A binary representation of the DataFrame.
-# NOTES: Parquet is chosen for its efficient compression and retrieval capabilities, making it ideal for storing large DataFrames in binary database fields.
+# FUNCTION: store_merged_entry
+# PURPOSE: Stores the merged DataFrame in the blob store and keeps the reference in the database entry, together with the IDs of
+#          the matrices it was merged from, in slot order.
 #---
-def df_to_parquet(df):
-    from bson.binary import Binary
-    # Create a BytesIO stream to hold the Parquet-formatted data.
-    output = BytesIO()
-    # Convert the DataFrame to Parquet and write to the stream.
-    df.to_parquet(output)
-    # Rewind the stream to the beginning for reading.
-    output.seek(0)
-    # Return the binary data, ready for database insertion.
-    # df = pd.read_parquet(BytesIO(test))
-    return Binary(output.getvalue())
+def store_merged_entry(db_entry, df_merged, matrix_ids, db):
+    db_entry['transformed_dataframe'] = blob_store.store_df(db, df_merged)
+    # Remember which merged DataFrame the matrix IDs belong to.
+    db_entry['merged_matrices'] = {'ids': matrix_ids, 'frame': db_entry['transformed_dataframe']['blob_id']}
+    return db_entry
+
 
 
 #---
 # FUNCTION: new_db_entry
-# PURPOSE: Creates a new database entry structure for a visualization, initializing it with a DataFrame, metadata, and pre-configured plugins. This includes converting the DataFrame to a binary format for storage and setting up the active matrices structure.
+# PURPOSE: Creates a new database entry structure for a visualization, initializing it with a DataFrame, metadata, and pre-configured plugins. This includes storing the DataFrame in the blob store and setting up the active matrices structure.
 # PARAMETERS:
 #   df: The DataFrame to include in the new database entry.
 #   metadata: Metadata for the new entry, such as titles and transformation details.
 #   pre_configured_plugins: A list of IDs for plugins pre-configured for use with this visualization.
+#   db: The database connection object, used to store the DataFrame.
 # RETURNS: A dictionary representing the new database entry, ready for insertion into the database.
 # NOTES: This function is a crucial part of initializing new visualizations, ensuring they're set up with all necessary information and data from the outset.
 #---
-def new_db_entry(df, metadata, pre_configured_plugins):
+def new_db_entry(df, metadata, pre_configured_plugins, db):
     db_entry = {}
     # Initialize the database entry with default and provided values.
     db_entry['locked'] = False
     db_entry['active_matrices'] = [[]]
     db_entry['plugins_id'] = pre_configured_plugins
     # db_entry['active_plugin_id'] = ""
-    db_entry['transformed_dataframe'] = df_to_parquet(df)
+    # The single matrix and the transformed dataframe have the same content, so both point to the same blob.
+    dataframe = blob_store.store_df(db, df)
+    db_entry['transformed_dataframe'] = dataframe
     
     # Create and position the initial active matrix based on the provided DataFrame and metadata.
-    db_entry['active_matrices'], added_axis = make_active_matrix(metadata, df, db_entry['active_matrices'], df_to_parquet(df))
+    db_entry['active_matrices'], added_axis = make_active_matrix(metadata, df, db_entry['active_matrices'], dataframe)
+    # The merged DataFrame consists of this single matrix.
+    db_entry['merged_matrices'] = {'ids': [db_entry['active_matrices'][0][0]['id']], 'frame': dataframe['blob_id']}
     return db_entry
 
 
@@ -305,15 +398,15 @@ def new_db_entry(df, metadata, pre_configured_plugins):
 #   metadata: Contains metadata for the matrix, including position (x, y), title, and any other relevant information.
 #   df: The pandas DataFrame from which the matrix's content is derived, used to determine the matrix's size if it's smaller than the maximum preview dimensions.
 #   active_matrices: The current structure of matrices (a nested list) being visualized, which will be updated with the new matrix.
-#   dataframe: The binary representation of the DataFrame, to be stored in the new matrix's 'dataframe' field.
+#   dataframe: The blob reference of the DataFrame, to be stored in the new matrix's 'dataframe' field.
 # RETURNS: A tuple containing the updated active_matrices structure and an indicator (added_axis) of whether a new row or column was added to the layout.
-# NOTES: The function handles positioning logic to ensure the matrix is added in the correct location within the layout, potentially adjusting the overall structure of active_matrices. The presence of both 'df' and 'dataframe' parameters might be confusing; 'df' is used for dimension calculations, while 'dataframe' is the binary data to be stored.
+# NOTES: The function handles positioning logic to ensure the matrix is added in the correct location within the layout, potentially adjusting the overall structure of active_matrices. The presence of both 'df' and 'dataframe' parameters might be confusing; 'df' is used for dimension calculations, while 'dataframe' is the blob reference to be stored.
 #---
 def make_active_matrix(metadata, df, active_matrices, dataframe): # NOTE: Why is there a df and a dataframe argument?
     # This is neither readable, nor necessary, but it works for now. I'm truly sorry (Titus).
     
     #print('make_active_matrix')
-    # Create the new matrix with specified properties and the binary dataframe.
+    # Create the new matrix with specified properties and the dataframe reference.
     added_matrix = make_single_matrix(metadata['x'],metadata['y'],max_preview_columns,max_preview_rows,metadata['title'],True, dataframe)
     
     # Initialize added_axis to indicate if a new row or column is added.
@@ -411,7 +504,7 @@ def make_preview_matrices(active_matrices):
 #   width, height: The width and height of the matrix, determining its size.
 #   title: The title of the matrix, which may be used for labeling or identification.
 #   active: A boolean indicating whether the matrix is active or part of the main visualization (True) or a supplementary preview element (False).
-#   dataframe: The binary representation of the DataFrame associated with this matrix, stored for data persistence and retrieval.
+#   dataframe: The blob reference of the DataFrame associated with this matrix, stored for data persistence and retrieval.
 # RETURNS: A dictionary representing the matrix with the specified properties.
 # NOTES: This function is a foundational element for building and manipulating the data structure of a visualization, allowing for dynamic and flexible layout designs.
 #---
@@ -425,6 +518,6 @@ def make_single_matrix(x, y, width, height, title, active, dataframe):
         'x': x,
         'y': y,
         'isActive': active,
-        'dataframe': dataframe  # Store the data content as a binary object.
+        'dataframe': dataframe  # Store the reference to the data content in the blob store.
     }
     return ADD_MATRIX
\ No newline at end of file
@@ -0,0 +1,243 @@
+#--------------------------------
+#
+# On-demand profiling of single requests
+#
+#--------------------------------
+
+# Slow '/query' and '/upload' requests depend on the session they are made for, so they can often only be reproduced
+# with the session of the user. Here, a single request can be run under the deterministic profiler of Python (cProfile)
+# on the production backend:
+#   - The request sends the header 'X-Micromix-Profile: <token>'. The token is not accepted in the URL, where it would end
+#     up in the access log of the server.
+#   - The token has to be one of MICROMIX_PROFILE_TOKENS (comma-separated). If MICROMIX_PROFILE_NETWORKS is set
+#     (comma-separated addresses or networks, e.g. '10.0.0.0/8'), the request also has to come from one of them.
+#     Without tokens, profiling is switched off.
+#   - The profile is stored in the capped MongoDB collection 'profiles' (MICROMIX_PROFILE_COLLECTION_BYTES), together with
+#     the route, the session ID and the duration. The oldest profiles are removed by MongoDB when the collection is full.
+#     The ID of the profile is returned in the response header 'X-Micromix-Profile-Id'.
+#   - '/profiles' lists the stored profiles, '/profiles/<profile_id>' downloads one as a .prof file (open it with
+#     'python -m pstats' or snakeviz), or as a text summary with '?format=text'. Both need a token as well.
+# An upload is processed by a background job (see jobs.py), so its job is profiled as well. The profile of the job
+# refers to the profile of the request in 'request_profile_id'.
+#
+# cProfile only records the thread it is enabled in, so other requests of the same process are not affected.
+
+import os
+import io
+import hmac
+import json
+import time
+import uuid
+import marshal
+import pstats
+import cProfile
+import ipaddress
+from datetime import datetime
+from bson.binary import Binary
+from pymongo import DESCENDING
+from pymongo.errors import CollectionInvalid
+
+
+# Configuration
+PROFILE_TOKENS = [token.strip() for token in os.environ.get('MICROMIX_PROFILE_TOKENS', '').split(',') if token.strip()]
+PROFILE_NETWORKS = [ipaddress.ip_network(network.strip(), strict=False) for network in os.environ.get('MICROMIX_PROFILE_NETWORKS', '').split(',') if network.strip()]
+PROFILE_COLLECTION_BYTES = int(os.environ.get('MICROMIX_PROFILE_COLLECTION_BYTES', 256 * 1024 * 1024))
+
+PROFILE_HEADER = 'X-Micromix-Profile'
+PROFILE_SUMMARY_LINES = 40 # Functions in the text summary, by cumulative time
+MAX_STATS_BYTES = 12 * 1024 * 1024 # Larger call trees are only stored as summary (MongoDB documents are limited to 16 MB)
+
+
+
+#---
+# FUNCTION: is_allowed
+# PURPOSE: Checks if a profiling token (and the address of the client) is on the allow-list.
+#---
+def is_allowed(token, address):
+    if not token or len(PROFILE_TOKENS) == 0:
+        return False
+    if not any(hmac.compare_digest(token, allowed) for allowed in PROFILE_TOKENS):
+        return False
+    if len(PROFILE_NETWORKS) > 0:
+        try:
+            return any(ipaddress.ip_address(address) in network for network in PROFILE_NETWORKS)
+        except ValueError:
+            return False
+    return True
+
+
+
+#---
+# FUNCTION: request_is_allowed
+# PURPOSE: Checks if the current Flask request carries an allowed profiling token.
+# NOTES: The token is only read from the header, so the body of an upload is not parsed here.
+#---
+def request_is_allowed():
+    from flask import request
+    token = request.headers.get(PROFILE_HEADER)
+    return is_allowed(token, request.remote_addr)
+
+
+
+#---
+# FUNCTION: init_app
+# PURPOSE: Profiles the requests of a Flask application that ask for it.
+# PARAMETERS:
+#   app: The Flask application.
+#   db: The micromix database, the profiles are stored in its collection 'profiles'.
+#---
+def init_app(app, db):
+    from flask import g, request
+
+    @app.before_request
+    def start_profiler():
+        if request.path.startswith('/profiles') or not request_is_allowed():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: # Another profiler is active in this thread
+            return
+        g.profiler = profiler
+        g.profile_id = uuid.uuid4().hex
+        g.profile_start = time.perf_counter()
+
+    @app.after_request
+    def store_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler != None:
+            profiler.disable()
+            try:
+                store(db, profiler, g.profile_id,
+                      kind='request',
+                      route=request.url_rule.rule if request.url_rule != None else request.path,
+                      method=request.method,
+                      status=response.status_code,
+                      session_id=session_id_of(request),
+                      seconds=time.perf_counter() - g.profile_start)
+                response.headers['X-Micromix-Profile-Id'] = g.profile_id
+            except Exception as e:
+                print('The profile could not be stored: ', str(e))
+        return response
+
+
+
+#---
+# FUNCTION: current_profile_id
+# PURPOSE: Returns the ID of the profile of the current request, or None if the request is not profiled.
+#---
+def current_profile_id():
+    from flask import g
+    return g.get('profile_id') if 'profiler' in g else None
+
+
+
+#---
+# FUNCTION: profiled
+# PURPOSE: Wraps a function (e.g. of a background job), so it is run under the profiler and its profile is stored.
+# PARAMETERS:
+#   db: The micromix database.
+#   function: The function to profile.
+#   route: The route the function belongs to, e.g. '/upload'.
+#   session_id: The session the function works on (None for a new session).
+#   request_profile_id: The profile of the request that started the function.
+# RETURNS: A function with the same arguments and return value.
+#---
+def profiled(db, function, route, session_id, request_profile_id):
+    def run_profiled(*args):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        status = 'done'
+        try:
+            profiler.enable()
+            return function(*args)
+        except Exception:
+            status = 'failed'
+            raise
+        finally:
+            profiler.disable()
+            try:
+                store(db, profiler, uuid.uuid4().hex, kind='job', route=route, method=None, status=status,
+                      session_id=session_id, seconds=time.perf_counter() - start, request_profile_id=request_profile_id)
+            except Exception as e:
+                print('The profile could not be stored: ', str(e))
+    return run_profiled
+
+
+
+#---
+# FUNCTION: session_id_of
+# PURPOSE: Finds the session ID in the form of a request ('url', or 'db_entry_id' in the upload form).
+# RETURNS: The session ID as a string, or None.
+#---
+def session_id_of(request):
+    try:
+        if request.values.get('url') not in (None, 'undefined'):
+            return str(json.loads(request.values['url']))
+        if 'form' in request.form:
+            return json.loads(request.form['form']).get('db_entry_id') or None
+    except Exception:
+        pass
+    return None
+
+
+
+#---
+# FUNCTION: store
+# PURPOSE: Stores the profile of a profiler in the collection 'profiles'.
+# PARAMETERS:
+#   db: The micromix database.
+#   profiler: The cProfile.Profile, already disabled.
+#   profile_id: The ID of the profile.
+#   **fields: The description of the profile (kind, route, method, status, session_id, seconds, ...).
+#---
+def store(db, profiler, profile_id, **fields):
+    profiler.create_stats()
+    stats = marshal.dumps(profiler.stats) # The format of pstats.Stats.dump_stats
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+    profile = dict(fields, _id=profile_id, created=datetime.utcnow(), summary=summary.getvalue())
+    if len(stats) <= MAX_STATS_BYTES:
+        profile['stats'] = Binary(stats)
+    get_collection(db).insert_one(profile)
+
+
+
+#---
+# FUNCTION: list_profiles
+# PURPOSE: Returns the stored profiles without their call trees, the newest first.
+# PARAMETERS:
+#   db: The micromix database.
+#   route, session_id: Optional filters.
+#   limit: The maximum number of profiles.
+#---
+def list_profiles(db, route=None, session_id=None, limit=100):
+    query = {}
+    if route != None:
+        query['route'] = route
+    if session_id != None:
+        query['session_id'] = session_id
+    return list(get_collection(db).find(query, {'stats': False, 'summary': False}).sort('created', DESCENDING).limit(limit))
+
+
+
+#---
+# FUNCTION: get_profile
+# PURPOSE: Returns a stored profile with its call tree, or None if it does not exist (anymore).
+#---
+def get_profile(db, profile_id):
+    return get_collection(db).find_one({'_id': profile_id})
+
+
+
+#---
+# FUNCTION: get_collection
+# PURPOSE: Returns the capped collection of the profiles, creating it on first use.
+#---
+def get_collection(db):
+    if 'profiles' not in db.list_collection_names():
+        try:
+            db.create_collection('profiles', capped=True, size=PROFILE_COLLECTION_BYTES)
+        except CollectionInvalid: # Created by another process in the meantime
+            pass
+    return db.profiles
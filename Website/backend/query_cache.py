@@ -0,0 +1,92 @@
+#--------------------------------
+#
+# Cache for the results of '/query'
+#
+#--------------------------------
+
+# The same query is often run several times on the same data: a shared link is reopened, or a user toggles a filter
+# block off and on again. Each time, the transformed dataframe had to be decoded and run through the whole
+# filter_dataframe.main pipeline.
+#
+# Here, the result of a query is remembered by a key made of
+#   - the content hash of the transformed dataframe (its blob_id), and
+#   - the sha256 hash of the canonical JSON of the query (sorted keys, no whitespace).
+# The cached value is the blob reference of the filtered dataframe, so a hit only costs a dictionary lookup and the
+# filtered parquet already stored in the blob store is re-used.
+#
+# The cache lives in the memory of the backend process. It is bounded by the number of entries and evicts the least
+# recently used entry first. The entries are small (references only), so the default of 1024 entries needs well below
+# a megabyte.
+
+import os
+import json
+import hashlib
+import copy
+import threading
+from collections import OrderedDict
+
+
+# Configuration
+CACHE_SIZE = int(os.environ.get('MICROMIX_QUERY_CACHE_SIZE', 1024)) # Maximum number of entries, 0 disables the cache.
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+
+#---
+# FUNCTION: make_key
+# PURPOSE: Builds the cache key of a query on a dataframe.
+# PARAMETERS:
+#   frame_id: The content hash of the dataframe the query runs on (see blob_store.blob_id_of).
+#   query: The query as sent by the frontend. Must be called before the query is passed to filter_dataframe.main,
+#          which modifies it.
+# RETURNS: The cache key as a string.
+#---
+def make_key(frame_id, query):
+    canonical_query = json.dumps(query, sort_keys=True, separators=(',', ':'), default=str)
+    return frame_id + ':' + hashlib.sha256(canonical_query.encode('utf-8')).hexdigest()
+
+
+
+#---
+# FUNCTION: get
+# PURPOSE: Looks up a cached query result and marks it as recently used.
+# RETURNS: A tuple (filtered_dataframe, query) as passed to put, or None if the key is unknown.
+#---
+def get(key):
+    with _lock:
+        if key not in _entries:
+            return None
+        _entries.move_to_end(key)
+        filtered_dataframe, query = _entries[key]
+    return copy.deepcopy(filtered_dataframe), copy.deepcopy(query)
+
+
+
+#---
+# FUNCTION: put
+# PURPOSE: Stores a query result, evicting the least recently used entries if the cache is full.
+# PARAMETERS:
+#   key: The cache key (see make_key).
+#   filtered_dataframe: The blob reference of the filtered dataframe.
+#   query: The query as it is saved in the session document.
+#---
+def put(key, filtered_dataframe, query):
+    if CACHE_SIZE <= 0:
+        return
+    with _lock:
+        _entries[key] = (copy.deepcopy(filtered_dataframe), copy.deepcopy(query))
+        _entries.move_to_end(key)
+        while len(_entries) > CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+
+#---
+# FUNCTION: discard
+# PURPOSE: Removes an entry, e.g. if its filtered dataframe is no longer available in the blob store.
+#---
+def discard(key):
+    with _lock:
+        _entries.pop(key, None)
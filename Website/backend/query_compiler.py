@@ -0,0 +1,267 @@
+import pandas as pd
+import numpy as np
+from functools import partial
+import initial_transformation
+import filter_genelists
+import row_filters
+import parallel_rows
+import metrics
+
+#-------
+#Query Compiler Summary
+#-------
+
+#filter_dataframe.main runs the query in three steps (transformations, genelist filters, row filters), and each step walks
+#the whole query again. The "any column" / "all columns" filters also built one boolean Series per column in a Python loop.
+
+#Here, the query is walked once and turned into a plan (compile_query), which is then evaluated by run_plan:
+#Step 1) The transformations are applied with initial_transformation.transform_df, as before.
+#Step 2) The masks of all filter blocks are built and combined with their AND/OR logics (filter_genelists.apply_logics).
+#Step 3) The row filters are applied in order.
+
+#The masks in Step 2 and 3 are evaluated on 2D NumPy blocks: all selected columns with the same dtype are compared in a
+#single operation and reduced with any()/all() per row. The result is identical to the one of the three separate steps,
+#including the dropped duplicate rows. Queries the compiler does not support are run by the original functions.
+
+#Blocks of large dataframes are split into row partitions and compared on several cores (see parallel_rows.py). The
+#comparisons are therefore functools.partial objects of module-level functions, which can be sent to other processes.
+
+
+#The transformations that are run in Step 1 (see filter_dataframe.main)
+TRANSFORMATIONS = {"Round Values",
+                   "Change Values",
+                   "Convert to index column",
+                   "Hide Column",
+                   "Calculate fold change",
+                   "Convert to log",
+                   "Calculate log fold change"}
+
+#The blocks that are run as row filters in Step 3
+ROW_FILTERS = {"Filter values"}
+
+
+
+
+#---
+# FUNCTION: run
+# PURPOSE:  Compiles and evaluates a query. Drop-in replacement for filter_dataframe.main
+#---
+def run(query, df):
+    if len(query) == 0:
+        return df
+    plan = compile_query(query)
+    return run_plan(plan, query, df)
+
+
+
+
+#---
+# FUNCTION: compile_query
+# PURPOSE: Walks the query once and sorts its blocks into the steps of the plan.
+# PARAMETERS:
+#   query - The list of sub queries (lists of blocks) as sent by the frontend.
+# RETURNS: The plan, a dictionary with
+#   transform - True if the query contains a transformation block
+#   filters - The filter blocks of Step 2, in query order
+#   logics - The AND/OR operators of the logic blocks, in query order
+#   has_filter - True if a block of type 'filter' exists (the mask of Step 2 has to be applied)
+#   row_filters - The 'Filter values' blocks of Step 3, in query order
+#---
+def compile_query(query):
+    plan = {'transform': False, 'filters': [], 'logics': [], 'has_filter': False, 'row_filters': []}
+    for sub_query in query:
+        for block in sub_query:
+            if block['name'] in TRANSFORMATIONS:
+                plan['transform'] = True
+            if block['name'] in ROW_FILTERS:
+                plan['row_filters'].append(block)
+            elif block["properties"]["type"] == "filter":
+                plan['has_filter'] = True
+                plan['filters'].append(block)
+            elif block["properties"]["type"] == "logic":
+                plan['logics'].append(block["forms"]["operator"])
+    return plan
+
+
+
+
+#---
+# FUNCTION: run_plan
+# PURPOSE: Evaluates a compiled plan on a dataframe.
+# PARAMETERS:
+#   plan - The plan created by compile_query.
+#   query - The query the plan was compiled from (the transformations of Step 1 need the whole query).
+#   df - The dataframe to filter.
+# RETURNS: The filtered dataframe.
+#---
+def run_plan(plan, query, df):
+
+    #Step 1 - Transformations
+    if plan['transform']:
+        with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='transform'):
+            df2 = initial_transformation.transform_df(query, df)
+    else:
+        df2 = df
+
+
+    #Step 2 - Genelist filters
+    filtered_df = df2
+    if plan['has_filter']:
+        with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='filter'):
+            filtered_df = apply_filters(plan, query, df2)
+
+
+    #Step 3 - Row filters
+    if len(plan['row_filters']) > 0:
+        with metrics.timed(metrics.FILTER_STAGE_SECONDS, stage='row_filter'):
+            for block in plan['row_filters']:
+                filtered_df = filtered_df[row_filter_mask(block["forms"], filtered_df)]
+
+    return filtered_df
+
+
+
+
+#---
+# FUNCTION: apply_filters
+# PURPOSE: Step 2 of run_plan. Builds the masks of the filter blocks, combines them and selects the matching rows.
+#---
+def apply_filters(plan, query, df2):
+    masks = []
+    for block in plan['filters']:
+        comparison_operator, filter_area, any_column = filter_genelists.setup_query_parameters(block["forms"], df2)
+        masks.append(filter_mask(block["forms"], block["properties"], df2, comparison_operator, filter_area))
+
+    if any(mask is None for mask in masks) or len(set(np.ndim(mask) for mask in masks)) > 1:
+        # Masks of different shapes can't be combined here, so the original function handles this query.
+        return filter_genelists.filter_genelists(query, df2)
+
+    if len(masks) > 1:
+        final_mask = filter_genelists.apply_logics(masks, plan['logics'])
+    else:
+        final_mask = masks[0]
+    # Selecting rows with a 2D mask returns a row once for every matching cell. These copies are removed by
+    # drop_duplicates() anyway, so a row is selected once if any of its cells match.
+    if np.ndim(final_mask) > 1:
+        final_mask = np.asarray(final_mask).any(axis=1)
+    return df2[np.asarray(final_mask, dtype=bool)].drop_duplicates()
+
+
+
+
+#---
+# FUNCTION: filter_mask
+# PURPOSE: Builds the mask of a filter block. Same result as filter_genelists.filter_for, but numeric filters on several
+#          columns are evaluated per dtype block instead of per column.
+# RETURNS: A 1D mask for numeric and annotation filters, a 2D mask (rows x columns) for string and NaN filters, or None
+#          if the block is not supported.
+#---
+def filter_mask(forms, properties, df2, comparison_operator, filter_area):
+    if properties["query"] != "expression":
+        if properties["query"] == "annotation_code":
+            return np.asarray(filter_genelists.filter_for(forms, properties, df2, comparison_operator, filter_area))
+        return None
+
+    try:
+        is_nan = not (forms["filter_value"].lower() != "nan" or forms["filter_value"] == " ")
+        filter_value = None if is_nan else float(forms["filter_value"])
+    except ValueError:
+        # Strings and semicolon-separated lists of strings. These masks are already built on the whole block.
+        return filter_genelists.filter_for(forms, properties, df2, comparison_operator, filter_area)
+    if is_nan:
+        return filter_genelists.filter_for(forms, properties, df2, comparison_operator, filter_area)
+
+    # Non-numeric columns are skipped by numeric filters.
+    numeric_columns = []
+    for column in filter_area:
+        if df2[column].dtype.kind in 'biufc':
+            numeric_columns.append(column)
+        else:
+            print(f"Column {column} is not numeric. Skipping...")
+    reduce_all = "all columns" in forms["filter_area"]
+    return combine_columns(df2, numeric_columns, partial(compare_values, comparison_operator=comparison_operator, filter_value=filter_value), reduce_all)
+
+
+
+
+#---
+# FUNCTION: row_filter_mask
+# PURPOSE: Builds the mask of a 'Filter values' block. Same result as one iteration of row_filters.row_filters.
+#---
+def row_filter_mask(forms, filtered_df):
+    filter_input_value = forms["filter_value"]
+    filter_logic = forms["logical_operator"]
+    filter_columns = forms["filter_area"]
+
+    # Convert input to numeric if possible, otherwise keep as string
+    try:
+        value = float(filter_input_value)
+        is_numeric = True
+    except ValueError:
+        value = filter_input_value
+        is_numeric = False
+
+    # Enforce specific logic operators for string filters
+    if not is_numeric and filter_logic not in ['= equal to', '!= not']:
+        raise ValueError("String filters must use '= equal to' or '!= not'.")
+
+    # Determine the columns to filter based on user imput: all, any, or specified columns
+    if "all columns" in filter_columns or "any column" in filter_columns:
+        cols_to_filter = list(filtered_df.select_dtypes(include=[np.number] if is_numeric else [object, 'category']).columns)
+    else:
+        cols_to_filter = filter_columns
+
+    if is_numeric:
+        compare = partial(row_filters.apply_numeric_filter, logic=filter_logic, value=value)
+    else:
+        compare = partial(row_filters.apply_string_filter, logic=filter_logic, value=value)
+    return combine_columns(filtered_df, cols_to_filter, compare, "all columns" in filter_columns, strings=not is_numeric)
+
+
+
+
+#---
+# FUNCTION: compare_values
+# PURPOSE: Compares values with the value of a numeric filter, e.g. operator.gt(values, 5.0).
+#---
+def compare_values(values, comparison_operator, filter_value):
+    return comparison_operator(values, filter_value)
+
+
+
+
+#---
+# FUNCTION: combine_columns
+# PURPOSE: Applies a comparison to several columns and combines the results per row.
+# PARAMETERS:
+#   df - The dataframe.
+#   columns - The columns to compare.
+#   compare - Function that compares a Series or a 2D array with the filter value. Must be picklable, see parallel_rows.py.
+#   reduce_all - True if all columns have to match (AND), False if any column has to match (OR).
+#   strings - True for string comparisons. These are only run on a block of object columns.
+# RETURNS: A 1D boolean array with one entry per row.
+# NOTES: The columns are grouped by dtype. Each group of plain NumPy columns is compared as one 2D block, so no values
+#        are cast to another dtype. Other columns (e.g. nullable or categorical dtypes) are compared one by one, as before.
+#---
+def combine_columns(df, columns, compare, reduce_all, strings=False):
+    mask = np.full(len(df), reduce_all, dtype=bool)
+    reduce = np.logical_and if reduce_all else np.logical_or
+
+    groups = {}
+    for column in columns:
+        groups.setdefault(df[column].dtype, []).append(column)
+
+    for dtype, group in groups.items():
+        if isinstance(dtype, np.dtype) and (dtype.kind in 'biuf' if not strings else dtype.kind == 'O'):
+            block = df[group].to_numpy()
+            group_mask = parallel_rows.block_mask(block, compare, reduce_all)
+            mask = reduce(mask, group_mask)
+        else:
+            mask_series = pd.Series(mask, index=df.index)
+            for column in group:
+                if reduce_all:
+                    mask_series &= compare(df[column])
+                else:
+                    mask_series |= compare(df[column])
+            mask = mask_series.to_numpy(dtype=bool)
+    return mask
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+#--------------------------------
+#
+# Retention of old sessions
+#
+#--------------------------------
+
+# Old sessions used to be removed by hand with the scripts in the 'scripts' folder: the dates and the sessions to keep
+# were edited into MONGO_remove_records_between_dates.py, the locked sessions had to be looked up with a second script,
+# and all sessions were removed with a single delete_many, which kept MongoDB busy for minutes.
+#
+# Here, the policy is configured with environment variables:
+#   MICROMIX_RETENTION_DAYS: Sessions that have not been opened for this many days are removed (0 switches the
+#       retention off). A session counts as opened when its '/config' is requested, which sets its 'last_used' date
+#       (at most once per RETENTION_TOUCH_INTERVAL). Sessions stored before 'last_used' existed use their creation time,
+#       which is part of their ObjectId.
+#   MICROMIX_RETENTION_KEEP_IDS: Comma-separated session IDs that are always kept, e.g. the links of a publication.
+#   MICROMIX_RETENTION_BATCH_SIZE, MICROMIX_RETENTION_BATCH_PAUSE: Sessions are removed in batches of this size, with a
+#       pause (in seconds) after each batch, so the removal does not saturate the I/O of MongoDB.
+#   MICROMIX_RETENTION_BLOB_GRACE: Blobs that are no longer used by any session are removed as well, but only if they
+#       were stored more than this many seconds ago, so a blob that an upload has just stored is never removed.
+#   MICROMIX_RETENTION_TTL: If set to 1, MongoDB removes old sessions itself with a TTL index on 'last_used'. The index
+#       only covers unlocked sessions. The sweep below is still needed for the sessions without 'last_used' and for the
+#       blobs.
+# Locked sessions (shared links) are never removed, and neither are the ancestors of a session that is kept (see
+# sessions.py), the keep list or sessions created after the cutoff.
+#
+# The sweep is meant to be run by cron from this folder, with the same environment as the backend:
+#   python retention.py --dry-run     Prints what would be removed, without removing anything.
+#   python retention.py               Removes the old sessions and the blobs they leave behind.
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+import blob_store
+
+
+# Configuration
+RETENTION_DAYS = float(os.environ.get('MICROMIX_RETENTION_DAYS', 0)) # 0 keeps every session
+RETENTION_KEEP_IDS = [session_id.strip() for session_id in os.environ.get('MICROMIX_RETENTION_KEEP_IDS', '').split(',') if session_id.strip()]
+RETENTION_BATCH_SIZE = int(os.environ.get('MICROMIX_RETENTION_BATCH_SIZE', 500)) # Sessions removed per batch
+RETENTION_BATCH_PAUSE = float(os.environ.get('MICROMIX_RETENTION_BATCH_PAUSE', 1)) # Seconds between two batches
+RETENTION_BLOB_GRACE = int(os.environ.get('MICROMIX_RETENTION_BLOB_GRACE', 24 * 3600)) # Seconds before an unused blob is removed
+RETENTION_TTL = os.environ.get('MICROMIX_RETENTION_TTL', '0') == '1'
+
+RETENTION_TOUCH_INTERVAL = timedelta(days=1) # 'last_used' is updated at most once per interval
+TTL_INDEX = 'retention_ttl'
+TIMESTAMP_INDEX = 'retention_last_used'
+
+
+
+#---
+# FUNCTION: touch
+# PURPOSE: Records that a session has been opened, by setting its 'last_used' date.
+# PARAMETERS:
+#   db: The micromix database.
+#   session_id: The _id of the session.
+# NOTES: The date is only written if it is older than RETENTION_TOUCH_INTERVAL, so opening a session usually costs no
+#        write. Locked sessions are touched as well, the date is not part of the session the frontend sees.
+#---
+def touch(db, session_id):
+    now = datetime.utcnow()
+    db.visualizations.update_one({'_id': ObjectId(session_id), 'last_used': {'$not': {'$gte': now - RETENTION_TOUCH_INTERVAL}}},
+                                 {'$set': {'last_used': now}})
+
+
+
+#---
+# FUNCTION: ensure_indexes
+# PURPOSE: Creates the index on 'last_used' the retention needs: a TTL index (RETENTION_TTL) or a plain one.
+# PARAMETERS:
+#   db: The micromix database.
+#   days: The retention in days.
+#   ttl: Whether MongoDB removes old sessions itself.
+# NOTES: The other index is dropped, because MongoDB does not allow two indexes on the same key with different options.
+#---
+def ensure_indexes(db, days=RETENTION_DAYS, ttl=RETENTION_TTL):
+    existing = db.visualizations.index_information()
+    if ttl and days > 0:
+        if TIMESTAMP_INDEX in existing:
+            db.visualizations.drop_index(TIMESTAMP_INDEX)
+        seconds = int(days * 24 * 3600)
+        if TTL_INDEX in existing and existing[TTL_INDEX].get('expireAfterSeconds') != seconds:
+            # Change the retention of the existing index instead of building it again
+            db.command('collMod', db.visualizations.name, index={'name': TTL_INDEX, 'expireAfterSeconds': seconds})
+        elif TTL_INDEX not in existing:
+            db.visualizations.create_index([('last_used', ASCENDING)], name=TTL_INDEX, expireAfterSeconds=seconds,
+                                           partialFilterExpression={'locked': False})
+    else:
+        if TTL_INDEX in existing:
+            db.visualizations.drop_index(TTL_INDEX)
+        if TIMESTAMP_INDEX not in existing:
+            db.visualizations.create_index([('last_used', ASCENDING)], name=TIMESTAMP_INDEX)
+
+
+
+#---
+# FUNCTION: candidate_query
+# PURPOSE: Returns the MongoDB query of the sessions that are older than the cutoff and not protected by the policy.
+# PARAMETERS:
+#   cutoff: Sessions last used before this date (UTC) are removed.
+#   keep_ids: Session IDs that are always kept.
+#---
+def candidate_query(cutoff, keep_ids=()):
+    return {
+        '$or': [
+            {'last_used': {'$lt': cutoff}},
+            {'last_used': {'$exists': False}, '_id': {'$lt': ObjectId.from_datetime(cutoff)}},
+        ],
+        'locked': {'$ne': True},
+        '_id': {'$nin': [ObjectId(session_id) for session_id in keep_ids]},
+    }
+
+
+
+#---
+# FUNCTION: protected_ancestors
+# PURPOSE: Returns the IDs of the sessions that are still needed as ancestors of a session that is kept.
+# NOTES: Ancestors are locked sessions (see sessions.insert_child), so this only matters for sessions that were locked
+#        by hand or stored by an older version. A child that is removed in the same sweep does not protect its ancestors.
+#---
+def protected_ancestors(db, cutoff, keep_ids=()):
+    kept = {'$nor': [candidate_query(cutoff, keep_ids)], 'ancestors.0': {'$exists': True}}
+    return set(db.visualizations.distinct('ancestors', kept))
+
+
+
+#---
+# FUNCTION: sweep
+# PURPOSE: Removes the sessions that have not been used for the retention period, and the blobs they leave behind.
+# PARAMETERS:
+#   db: The micromix database.
+#   days: The retention in days.
+#   keep_ids: Session IDs that are always kept.
+#   batch_size, batch_pause: Sessions removed per batch, and the seconds to wait after each batch.
+#   dry_run: If True, nothing is removed and only the report is returned.
+#   log: Called with a line of progress, e.g. print.
+# RETURNS: The report, a dictionary with the cutoff and the numbers of sessions and blobs found and removed.
+#---
+def sweep(db, days=RETENTION_DAYS, keep_ids=RETENTION_KEEP_IDS, batch_size=RETENTION_BATCH_SIZE,
+          batch_pause=RETENTION_BATCH_PAUSE, dry_run=False, log=None):
+    if days <= 0:
+        raise ValueError('The retention is switched off, set MICROMIX_RETENTION_DAYS (or --days) to a number of days.')
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    log = log or (lambda line: None)
+    report = {
+        'cutoff': cutoff.isoformat(),
+        'dry_run': dry_run,
+        'sessions': db.visualizations.estimated_document_count(),
+        'locked': db.visualizations.count_documents({'locked': True}),
+        'kept_by_id': len(keep_ids),
+    }
+
+    # Only the _ids are read, the large fields of the sessions stay on disk
+    ancestors = protected_ancestors(db, cutoff, keep_ids)
+    candidates = [entry['_id'] for entry in db.visualizations.find(candidate_query(cutoff, keep_ids), {'_id': True})]
+    to_remove = [session_id for session_id in candidates if session_id not in ancestors]
+    report['expired'] = len(candidates)
+    report['kept_as_ancestor'] = len(candidates) - len(to_remove)
+    report['batches'] = -(-len(to_remove) // batch_size)
+    log('{} of {} sessions were last used before {} ({} are still needed as ancestors)'.format(
+        len(candidates), report['sessions'], cutoff.date(), report['kept_as_ancestor']))
+
+    report['removed_sessions'] = 0
+    if not dry_run:
+        for start in range(0, len(to_remove), batch_size):
+            batch = to_remove[start:start + batch_size]
+            # The conditions are checked again, a session may have been opened or locked in the meantime
+            result = db.visualizations.delete_many({'$and': [{'_id': {'$in': batch}}, candidate_query(cutoff, keep_ids)]})
+            report['removed_sessions'] += result.deleted_count
+            log('Batch {}/{}: {} sessions removed'.format(start // batch_size + 1, report['batches'], result.deleted_count))
+            if start + batch_size < len(to_remove):
+                time.sleep(batch_pause)
+
+    # In a dry run, the blobs of the sessions that would be removed count as unused
+    report.update(sweep_blobs(db, dry_run, batch_size, batch_pause, set(to_remove) if dry_run else set(), log))
+    return report
+
+
+
+#---
+# FUNCTION: sweep_blobs
+# PURPOSE: Removes the blobs that no session refers to anymore.
+# PARAMETERS:
+#   db: The micromix database.
+#   dry_run: If True, the unused blobs are only counted.
+#   batch_size, batch_pause: Blobs removed per batch, and the seconds to wait after each batch.
+#   removed: The IDs of sessions that count as removed (for the report of a dry run).
+#   log: Called with a line of progress.
+# RETURNS: The part of the report about the blobs.
+# NOTES: Only blobs stored more than RETENTION_BLOB_GRACE seconds ago are removed. A job that saves a session stores its
+#        blobs first, which renews the date of a blob that already exists (see blob_store.put_blob). The sessions are
+#        therefore read before the blobs are listed, and the date of each blob is checked again right before it is
+#        removed, so the blobs of a session that is saved in the meantime are kept.
+#---
+def sweep_blobs(db, dry_run=False, batch_size=RETENTION_BATCH_SIZE, batch_pause=RETENTION_BATCH_PAUSE,
+                removed=frozenset(), log=None):
+    log = log or (lambda line: None)
+    referenced = set()
+    fields = {'transformed_dataframe': True, 'filtered_dataframe': True, 'active_matrices': True}
+    for db_entry in db.visualizations.find({}, fields):
+        if db_entry['_id'] not in removed:
+            referenced |= blob_store.session_blob_ids(db_entry)
+    stored = set(blob_store.list_blob_ids(db, older_than=RETENTION_BLOB_GRACE))
+    unused = sorted(stored - referenced)
+    log('{} of {} stored blobs are no longer used'.format(len(unused), len(stored)))
+
+    deleted = 0
+    if not dry_run:
+        for start in range(0, len(unused), batch_size):
+            deleted += blob_store.delete_blobs(db, unused[start:start + batch_size], older_than=RETENTION_BLOB_GRACE)
+            if start + batch_size < len(unused):
+                time.sleep(batch_pause)
+    return {'unused_blobs': len(unused), 'removed_blobs': deleted}
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Removes the Micromix sessions that have not been used for a while, see retention.py.')
+    parser.add_argument('--days', type=float, default=RETENTION_DAYS, help='Retention in days (default: MICROMIX_RETENTION_DAYS, {}).'.format(RETENTION_DAYS))
+    parser.add_argument('--keep', default=','.join(RETENTION_KEEP_IDS), help='Comma-separated session IDs that are always kept (default: MICROMIX_RETENTION_KEEP_IDS).')
+    parser.add_argument('--batch-size', type=int, default=RETENTION_BATCH_SIZE, help='Sessions removed per batch (default: {}).'.format(RETENTION_BATCH_SIZE))
+    parser.add_argument('--batch-pause', type=float, default=RETENTION_BATCH_PAUSE, help='Seconds between two batches (default: {}).'.format(RETENTION_BATCH_PAUSE))
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args()
+
+    import mongo
+    db = mongo.get_db()
+    keep_ids = [session_id.strip() for session_id in args.keep.split(',') if session_id.strip()]
+    try:
+        if not args.dry_run:
+            ensure_indexes(db, args.days)
+        report = sweep(db, args.days, keep_ids, args.batch_size, args.batch_pause, args.dry_run, log=None if args.json else print)
+    except (ValueError, OperationFailure) as e:
+        sys.exit(str(e))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('{} sessions {}, {} unused blobs {}'.format(
+            report['expired'] - report['kept_as_ancestor'], 'would be removed' if args.dry_run else 'removed',
+            report['unused_blobs'], 'would be removed' if args.dry_run else 'removed'))
+
+
+
+if __name__ == '__main__':
+    main()
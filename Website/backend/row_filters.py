@@ -39,7 +39,7 @@ def row_filters(query, filtered_df, all_filters):
         
         # Determine the columns to filter based on user imput: all, any, or specified columns
         if "all columns" in filter_columns or "any column" in filter_columns:
-            cols_to_filter = filtered_df.select_dtypes(include=[np.number if is_numeric else object]).columns
+            cols_to_filter = filtered_df.select_dtypes(include=[np.number] if is_numeric else [object, 'category']).columns # Repeated strings are stored as categories
         else:
             cols_to_filter = filter_columns
 
@@ -0,0 +1,149 @@
+#--------------------------------
+#
+# Version chains of the session documents
+#
+#--------------------------------
+
+# A locked session (a shared link) must never change. Editing it used to insert a complete copy of the session
+# document as a new, unlocked session, including every matrix and frame reference (and, for sessions stored before the
+# blob store, the dataframes themselves).
+#
+# Here, the new session is a child of the locked one. It only stores
+#   - parent_id: The _id of the session it was created from,
+#   - ancestors: The _ids of all its ancestors, the root first and the parent last,
+#   - the small fields it always owns (locked, vis_links, plugins_id, ...), and
+#   - the INHERITED_FIELDS that differ from its parent.
+# The remaining INHERITED_FIELDS are read from the ancestors. find_session resolves a session with two queries: the
+# session itself and all of its ancestors at once ('$in'). The fields are laid over each other from the root to the
+# session. A chain can only grow from locked sessions, which are never modified, so the ancestors of a session never
+# change. Chains longer than MAX_CHAIN_LENGTH are flattened, i.e. the next child is stored as a complete document again.
+#
+# The fields a session always owns are the ones that are changed with '$push' (vis_links, plugins_id), which would
+# otherwise start a new list instead of extending the inherited one.
+
+import os
+from datetime import datetime
+from bson.json_util import ObjectId
+import metrics
+
+
+# Configuration
+MAX_CHAIN_LENGTH = int(os.environ.get('MICROMIX_MAX_CHAIN_LENGTH', 32))
+
+# The (large) fields a child session reads from its ancestors if it does not store them itself.
+INHERITED_FIELDS = ('active_matrices', 'preview_matrices', 'transformed_dataframe', 'filtered_dataframe', 'merged_matrices', 'query')
+
+# The fields that link a child session to its ancestors.
+CHAIN_FIELDS = ('parent_id', 'ancestors')
+
+
+
+#---
+# FUNCTION: find_session
+# PURPOSE: Loads a session document and resolves the fields it inherits from its ancestors.
+#          Drop-in replacement for db.visualizations.find_one({'_id': session_id}, projection).
+# PARAMETERS:
+#   db: The micromix database.
+#   session_id: The _id of the session (ObjectId or string).
+#   projection: An optional MongoDB projection, either including fields ({'field': True}) or excluding them
+#               ({'_id': False}).
+# RETURNS: The resolved session document, or None if the session does not exist.
+#---
+def find_session(db, session_id, projection=None):
+    inclusive = projection_is_inclusive(projection)
+    session_projection = projection
+    if inclusive:
+        session_projection = dict(projection, ancestors=True)
+    db_entry = db.visualizations.find_one({'_id': ObjectId(session_id)}, session_projection)
+    if db_entry == None or not db_entry.get('ancestors'):
+        return db_entry
+
+    # Only the inherited fields that are requested and not stored in the session itself are read from the ancestors.
+    fields = [field for field in INHERITED_FIELDS if field not in db_entry]
+    if inclusive:
+        fields = [field for field in fields if projection.get(field)]
+    elif projection != None:
+        fields = [field for field in fields if projection.get(field, True)]
+    if inclusive and not projection.get('ancestors'):
+        ancestor_ids = db_entry.pop('ancestors')
+    else:
+        ancestor_ids = db_entry['ancestors']
+    if len(fields) == 0:
+        return db_entry
+
+    ancestors = {ancestor['_id']: ancestor for ancestor in db.visualizations.find({'_id': {'$in': ancestor_ids}}, {field: True for field in fields})}
+    resolved = {}
+    for ancestor_id in ancestor_ids: # From the root to the parent
+        if ancestor_id not in ancestors:
+            raise ValueError('The session {} is missing its ancestor {}.'.format(session_id, ancestor_id))
+        for field in fields:
+            if field in ancestors[ancestor_id]:
+                resolved[field] = ancestors[ancestor_id][field]
+    resolved.update(db_entry)
+    return resolved
+
+
+
+#---
+# FUNCTION: projection_is_inclusive
+# PURPOSE: Checks if a MongoDB projection lists the fields to include (instead of the fields to exclude).
+#---
+def projection_is_inclusive(projection):
+    if not projection:
+        return False
+    return any(value for field, value in projection.items() if field != '_id')
+
+
+
+#---
+# FUNCTION: insert_child
+# PURPOSE: Stores the changes to a locked session as a new, unlocked child session.
+# PARAMETERS:
+#   db: The micromix database.
+#   parent_id: The _id of the locked session.
+#   changes: The fields that are changed, as in a '$set' update.
+# RETURNS: The _id of the new session.
+# NOTES: The parent is read from the database (and not taken from the caller), so the child only stores the fields that
+#        really differ from what it inherits.
+#---
+def insert_child(db, parent_id, changes):
+    parent_id = ObjectId(parent_id)
+    parent = find_session(db, parent_id)
+    if parent == None:
+        raise ValueError('The session {} does not exist.'.format(parent_id))
+    ancestors = parent.get('ancestors', []) + [parent_id]
+
+    if len(ancestors) > MAX_CHAIN_LENGTH:
+        # Start a new chain with a complete document.
+        child = {field: value for field, value in parent.items() if field != '_id' and field not in CHAIN_FIELDS}
+        child.update(changes)
+    else:
+        child = {field: value for field, value in parent.items() if field != '_id' and field not in INHERITED_FIELDS and field not in CHAIN_FIELDS}
+        for field, value in changes.items():
+            if field in CHAIN_FIELDS or field == '_id':
+                continue
+            if field not in INHERITED_FIELDS or field not in parent or parent[field] != value:
+                child[field] = value
+        child['parent_id'] = parent_id
+        child['ancestors'] = ancestors
+    child['locked'] = False
+    child['last_used'] = datetime.utcnow() # A new session, not the date it copied from its parent (see retention.py)
+    metrics.observe_document(child, 'insert')
+    return db.visualizations.insert_one(child).inserted_id
+
+
+
+#---
+# FUNCTION: changed_fields
+# PURPOSE: Compares an edited session document with the stored session.
+# PARAMETERS:
+#   db: The micromix database.
+#   session_id: The _id of the stored session.
+#   db_entry: The edited (resolved) session document.
+# RETURNS: A dictionary of the fields of db_entry that differ from the stored session, for a '$set' update.
+# NOTES: The chain fields and the _id are never part of the changes.
+#---
+def changed_fields(db, session_id, db_entry):
+    stored = find_session(db, session_id) or {}
+    return {field: value for field, value in db_entry.items()
+            if field != '_id' and field not in CHAIN_FIELDS and (field not in stored or stored[field] != value)}
@@ -0,0 +1,188 @@
+#--------------------------------
+#
+# Pre-parsed columnar cache for the bundled datasets in static/
+#
+#--------------------------------
+
+# Most uploads refer to one of the bundled datasets in static/. Parsing these CSV/TSV files (decimal characters,
+# skipping bad lines, choosing the numeric dtypes) took up most of the time of such an upload, although the files never
+# change between requests.
+#
+# Here, every bundled file is parsed once with the regular convert_to_df logic and stored as a parquet file in CACHE_DIR,
+# with its dtypes already finalized. Later requests memory-map this file and only read the requested columns
+# (metadata["database_columns"]).
+#
+# The cache is invalidated by a manifest (CACHE_DIR/manifest.json) that stores the sha256 checksum of each source file.
+# The checksum is only recomputed if the size or modification time of the source file changed. Bump CACHE_VERSION
+# whenever the parsing in convert_to_df or experimental_features.adjust_numeric_dtype changes, so old entries are rebuilt.
+
+import os
+import json
+import hashlib
+import tempfile
+import pandas as pd
+
+
+# Configuration
+CACHE_DIR = os.environ.get('MICROMIX_STATIC_CACHE_DIR', 'static/.cache')
+CACHE_ENABLED = os.environ.get('MICROMIX_STATIC_CACHE', 'on') != 'off'
+CACHE_VERSION = 2
+MANIFEST_FILE = 'manifest.json'
+
+
+
+#---
+# FUNCTION: read_static_df
+# PURPOSE: Returns the parsed DataFrame of a bundled dataset from the cache, building the cache entry if needed.
+# PARAMETERS:
+#   input_file: Path to the bundled file (e.g. 'static/TYG_growth.tsv').
+#   extension: The file extension, as passed to convert_to_df.
+#   metadata: The upload metadata with the formatting details and the requested database_columns.
+#   parse: Function that parses the full file, i.e. convert_to_df without column selection. Only called on a cache miss.
+# RETURNS: The DataFrame, or None if the file can't be cached. The caller then parses the file itself.
+# NOTES: Column selection follows convert_to_df: database_columns are only applied to .csv files, and refer to the
+#        column names in the file (dots are replaced with underscores afterwards).
+#---
+def read_static_df(input_file, extension, metadata, parse):
+    if not CACHE_ENABLED:
+        return None
+    import pyarrow.parquet as pq
+    import experimental_features
+
+    options = parse_options(extension, metadata)
+    key = cache_key(input_file, options)
+    cache_file = os.path.join(CACHE_DIR, key + '.parquet')
+    manifest = load_manifest()
+    entry = manifest.get(key)
+
+    if entry is None or not os.path.exists(cache_file) or not is_current(entry, input_file):
+        entry = build_entry(input_file, options, cache_file, parse)
+        if entry is None:
+            return None
+        manifest = load_manifest() # Re-read, another worker may have added entries in the meantime.
+        manifest[key] = entry
+        save_manifest(manifest)
+
+    columns = None
+    if extension == '.csv' and len(metadata['database_columns']) > 0:
+        requested = set(column.replace('.', '_') for column in metadata['database_columns'])
+        # Keep the column order of the file, like pd.read_csv(usecols=...) does.
+        columns = [column for column in entry['columns'] if column in requested]
+    # The parquet file is memory-mapped, so only the pages of the selected columns are read.
+    table = pq.read_table(cache_file, columns=columns, memory_map=True)
+    # Missing text is None in Arrow, but NaN when convert_to_df parses the file.
+    return experimental_features.missing_text_to_nan(table.to_pandas())
+
+
+
+#---
+# FUNCTION: parse_options
+# PURPOSE: Collects the options that influence how a file is parsed. Each combination gets its own cache entry.
+#---
+def parse_options(extension, metadata):
+    file_formatting = metadata['formatting']['file']
+    separator = '\t' if extension in ('.txt', '.tsv') else file_formatting.get('csv_seperator')
+    return {'extension': extension, 'separator': separator, 'decimal_character': file_formatting.get('decimal_character'), 'version': CACHE_VERSION}
+
+
+
+#---
+# FUNCTION: cache_key
+# PURPOSE: Returns the name of the cache entry for a file and its parse options.
+#---
+def cache_key(input_file, options):
+    name = json.dumps([os.path.basename(input_file), options], sort_keys=True)
+    return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+
+
+#---
+# FUNCTION: is_current
+# PURPOSE: Checks if a cache entry still matches its source file.
+# NOTES: If size and modification time are unchanged, the file is assumed to be unchanged. Otherwise its checksum decides,
+#        so copying or touching a file (e.g. a new docker image) does not invalidate the cache.
+#---
+def is_current(entry, input_file):
+    stat = os.stat(input_file)
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return True
+    if entry['size'] != stat.st_size or entry['sha256'] != file_checksum(input_file):
+        return False
+    entry['mtime'] = stat.st_mtime # Unchanged content. The manifest is updated with the next rebuilt entry.
+    return True
+
+
+
+#---
+# FUNCTION: build_entry
+# PURPOSE: Parses a bundled file and writes it to the cache.
+# RETURNS: The manifest entry for the file, or None if the parsed DataFrame can't be stored as parquet
+#          (e.g. columns with mixed types).
+#---
+def build_entry(input_file, options, cache_file, parse):
+    stat = os.stat(input_file)
+    checksum = file_checksum(input_file)
+    df = parse()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temporary file first, so concurrent readers never see a partially written file. The name is unique, as
+    # several threads of a worker may build the same entry.
+    handle, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+    try:
+        with os.fdopen(handle, 'wb') as parquet_file:
+            df.to_parquet(parquet_file, index=False)
+    except Exception as e:
+        print('Static cache: Could not cache {}: {}'.format(input_file, e))
+        os.remove(tmp_file)
+        return None
+    os.replace(tmp_file, cache_file)
+    print('Static cache: Cached {}'.format(input_file))
+    return {
+        'source': os.path.basename(input_file),
+        'sha256': checksum,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'options': options,
+        'columns': [str(column) for column in df.columns],
+    }
+
+
+
+#---
+# FUNCTION: file_checksum
+# PURPOSE: Computes the sha256 checksum of a file, reading it in blocks.
+#---
+def file_checksum(input_file):
+    checksum = hashlib.sha256()
+    with open(input_file, 'rb') as source:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+
+#---
+# FUNCTION: load_manifest
+# PURPOSE: Reads the manifest of the cache. A missing or broken manifest results in an empty cache.
+#---
+def load_manifest():
+    try:
+        with open(os.path.join(CACHE_DIR, MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+
+#---
+# FUNCTION: save_manifest
+# PURPOSE: Writes the manifest of the cache.
+#---
+def save_manifest(manifest):
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+    try:
+        with os.fdopen(handle, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, MANIFEST_FILE))
+    except Exception:
+        os.remove(tmp_path)
+        raise
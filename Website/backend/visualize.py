@@ -1,5 +1,67 @@
 # This is the main point for visualizations.
 # Parse all relevant dataframes to this module and decide what plugin to use with route().
+#
+# Plugins may call external servers (e.g. Clustergrammer), so a request worker must not wait for them. submit() runs
+# route() on a dedicated pool of worker threads (PLUGIN_WORKERS) and returns a visualization ID at once. The state is
+# kept in the MongoDB collection 'jobs' (see jobs.py) and can be polled at '/visualization/<visualization_id>':
+#   queued -> running -> done (with the visualization) or failed (with an error message)
+#   - Each plugin has a timeout (MICROMIX_PLUGIN_TIMEOUT, or per plugin in MICROMIX_PLUGIN_TIMEOUTS, e.g.
+#     'Clustergrammer=120,Heatmap=5'). The time left is passed to the plugin as parameters['timeout'], so it can limit
+#     its own requests. A visualization that is not finished by then is reported as failed, and its late result is
+#     discarded.
+#   - Each plugin has a concurrency limit (MICROMIX_PLUGIN_CONCURRENCY, or per plugin in MICROMIX_PLUGIN_CONCURRENCY_LIMITS).
+#     If a plugin is already creating that many visualizations in this process, submit() raises a RuntimeError.
+#
+# The plugins in plugins/ are imported once, when the app is created (load_plugins), and kept in a registry. With
+# MICROMIX_PLUGIN_RELOAD=on, a plugin whose file has changed is reloaded with its next visualization.
+#
+# Creating a visualization can mean uploading the whole matrix to an external server. The links are remembered in the
+# MongoDB collection 'visualization_links', keyed by the plugin and the fingerprint of the dataframe (its blob ID, see
+# blob_store.blob_id_of). Visualizing the same dataframe with the same plugin again returns the remembered link at once
+# (for MICROMIX_PLUGIN_LINK_TTL seconds, as external servers may not keep their visualizations forever). Plugins whose
+# links point to the session itself (e.g. the heatmap, which loads '/config' of a session) set LINK_PER_SESSION = True,
+# so their links are remembered per session.
+
+import os
+import re
+import uuid
+import pkgutil
+import importlib
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+#---
+# FUNCTION: parse_limits
+# PURPOSE: Reads a limit per plugin from an environment variable ('Name=value,Name=value').
+# RETURNS: A dictionary from plugin name to value.
+#---
+def parse_limits(value, convert):
+    limits = {}
+    for entry in value.split(','):
+        if '=' in entry:
+            name, limit = entry.split('=', 1)
+            limits[name.strip()] = convert(limit)
+    return limits
+
+
+# Configuration
+PLUGIN_WORKERS = int(os.environ.get('MICROMIX_PLUGIN_WORKERS', 4)) # Visualizations that are created at the same time
+PLUGIN_TIMEOUT = float(os.environ.get('MICROMIX_PLUGIN_TIMEOUT', 60)) # Seconds, from the submission to the result
+PLUGIN_TIMEOUTS = parse_limits(os.environ.get('MICROMIX_PLUGIN_TIMEOUTS', ''), float)
+PLUGIN_CONCURRENCY = int(os.environ.get('MICROMIX_PLUGIN_CONCURRENCY', 2)) # Visualizations of one plugin that may wait or run
+PLUGIN_CONCURRENCY_LIMITS = parse_limits(os.environ.get('MICROMIX_PLUGIN_CONCURRENCY_LIMITS', ''), int)
+PLUGIN_RESULT_TTL = 3600 # Seconds a finished visualization can be polled
+PLUGIN_RELOAD = os.environ.get('MICROMIX_PLUGIN_RELOAD', 'off') != 'off' # Reload changed plugins (for development)
+PLUGIN_LINK_TTL = int(os.environ.get('MICROMIX_PLUGIN_LINK_TTL', 7 * 24 * 3600)) # Seconds a link is reused
+PLUGIN_PACKAGE = 'plugins'
+
+_executor = None
+_plugin_slots = {}
+_plugins = {} # name -> (module, modification time of its file)
+_lock = threading.Lock()
+_plugin_lock = threading.Lock()
 
 #---
 # FUNCTION: route
@@ -12,20 +74,17 @@
 #   - df: The DataFrame to be processed by the plugin.
 #   - plugin: A dictionary containing plugin details (name and ID).
 #   - db_entry_id: The database entry ID for the data being processed.
+#   - timeout: The seconds the plugin may take, passed on as parameters['timeout'] (None: no limit).
 # RETURNS: A dictionary with plugin name, plugin ID, and the generated link to the visualization.
 #---
 
 
-def route(collection, df, plugin, db_entry_id):
-    import importlib
-    from bson.json_util import ObjectId
-    from pymongo import MongoClient
-    
+def route(collection, df, plugin, db_entry_id, timeout=None):
     #Print to console
     print("Loading plugin....")
     
-     # Dynamically import the plugin module based on the plugin name provided.
-    plugin_module = importlib.import_module("plugins.{}".format(plugin['name']))
+     # Get the plugin module from the registry (it is imported on first use).
+    plugin_module = get_plugin(plugin['name'])
     
     # Initialize a dictionary to store visualization metadata.
     visualization = {}
@@ -34,10 +93,213 @@ def route(collection, df, plugin, db_entry_id):
 
     # Call the main function of the plugin module with the DataFrame and db_entry_id as arguments.
     # Store the returned link (to the generated visualization) in the visualization dictionary.
-    visualization['link'] = plugin_module.main({"df":df, "db_entry_id": db_entry_id})
+    import metrics
+    with metrics.timed(metrics.PLUGIN_DISPATCH_SECONDS, plugin=plugin['name']):
+        visualization['link'] = plugin_module.main({"df":df, "db_entry_id": db_entry_id, "timeout": timeout})
     
      # Print the visualization link(s) for debugging
     #print('vis_links: ', visualization)
     
     # Return the visualization dictionary, including the name, ID, and link of the plugin-generated visualization.
-    return visualization
\ No newline at end of file
+    return visualization
+
+
+
+#---
+# FUNCTION: submit
+# PURPOSE: Queues the creation of a visualization with a plugin.
+# PARAMETERS:
+#   - collection: The MongoDB collection that holds the states (db.jobs).
+#   - df, plugin, db_entry_id: See route.
+#   - finish: Optional function that is called with the visualization once it has been created in time, e.g. to store
+#     the link in the session.
+#   - memo_key: Optional key of the visualization (see memo_key). A visualization with the same key that is still queued
+#     or running is returned instead of creating it twice.
+# RETURNS: The ID of the visualization.
+# NOTES: Raises a RuntimeError if the plugin has reached its concurrency limit in this process.
+#---
+def submit(collection, df, plugin, db_entry_id, finish=None, memo_key=None):
+    if memo_key != None:
+        pending = collection.find_one({'kind': 'visualization', 'memo_key': memo_key, 'status': {'$in': ['queued', 'running']}, 'deadline': {'$gt': datetime.utcnow()}})
+        if pending != None:
+            return pending['_id']
+    slots = get_plugin_slots(plugin['name'])
+    if not slots.acquire(blocking=False):
+        raise RuntimeError('Too many visualizations are being created with {}. Please try again in a moment.'.format(plugin['name']))
+    visualization_id = uuid.uuid4().hex
+    try:
+        now = datetime.utcnow()
+        timeout = PLUGIN_TIMEOUTS.get(plugin['name'], PLUGIN_TIMEOUT)
+        collection.insert_one({'_id': visualization_id, 'kind': 'visualization', 'plugin_name': plugin['name'], 'memo_key': memo_key, 'status': 'queued',
+                               'submitted': now, 'deadline': now + timedelta(seconds=timeout),
+                               'expires': now + timedelta(seconds=timeout + PLUGIN_RESULT_TTL)})
+        get_executor().submit(run_visualization, collection, visualization_id, df, plugin, db_entry_id, finish, slots)
+    except Exception:
+        slots.release()
+        raise
+    return visualization_id
+
+
+
+#---
+# FUNCTION: run_visualization
+# PURPOSE: Creates a visualization in a worker thread and records its state.
+# NOTES: A thread can't be stopped from outside, so a plugin that exceeds its timeout keeps its slot until it returns.
+#        Its result is not stored and finish is not called.
+#---
+def run_visualization(collection, visualization_id, df, plugin, db_entry_id, finish, slots):
+    try:
+        job = collection.find_one_and_update({'_id': visualization_id, 'status': 'queued'}, {'$set': {'status': 'running', 'started': datetime.utcnow()}})
+        if job == None or job['deadline'] <= datetime.utcnow():
+            return
+        try:
+            visualization = route(None, df, plugin, db_entry_id, timeout=(job['deadline'] - datetime.utcnow()).total_seconds())
+            if datetime.utcnow() > job['deadline']:
+                return
+            if finish != None:
+                finish(visualization)
+            update = {'status': 'done', 'result': visualization}
+        except Exception as e:
+            print('Visualization {} with {} failed: {}'.format(visualization_id, plugin['name'], e))
+            update = {'status': 'failed', 'error': str(e)}
+        update['finished'] = datetime.utcnow()
+        collection.update_one({'_id': visualization_id, 'status': 'running'}, {'$set': update})
+    finally:
+        slots.release()
+
+
+
+#---
+# FUNCTION: status
+# PURPOSE: Returns the state of a visualization, marking it as failed once its timeout has passed.
+# RETURNS: The state document (status, result or error, timestamps), or None if the visualization is unknown or expired.
+#---
+def status(collection, visualization_id):
+    job = collection.find_one({'_id': visualization_id, 'kind': 'visualization'})
+    now = datetime.utcnow()
+    if job == None or job['expires'] < now:
+        return None
+    if job['status'] in ('queued', 'running') and job['deadline'] < now:
+        error = '{} did not finish within {:g} seconds.'.format(job['plugin_name'], PLUGIN_TIMEOUTS.get(job['plugin_name'], PLUGIN_TIMEOUT))
+        collection.update_one({'_id': visualization_id, 'status': job['status']}, {'$set': {'status': 'failed', 'error': error, 'finished': now}})
+        job = collection.find_one({'_id': visualization_id})
+    return job
+
+
+
+#---
+# FUNCTION: get_plugin_slots
+# PURPOSE: Returns the semaphore that limits the concurrent visualizations of a plugin.
+#---
+def get_plugin_slots(name):
+    with _lock:
+        if name not in _plugin_slots:
+            _plugin_slots[name] = threading.BoundedSemaphore(PLUGIN_CONCURRENCY_LIMITS.get(name, PLUGIN_CONCURRENCY))
+        return _plugin_slots[name]
+
+
+
+#---
+# FUNCTION: get_executor
+# PURPOSE: Returns the plugin pool of this process, creating it with the first visualization.
+# NOTES: The pool is created lazily, so forked server processes don't inherit the threads of their parent (as in jobs.py).
+#---
+def get_executor():
+    global _executor
+    if _executor == None:
+        with _lock:
+            if _executor == None:
+                _executor = ThreadPoolExecutor(max_workers=PLUGIN_WORKERS, thread_name_prefix='micromix-plugin')
+    return _executor
+
+
+
+#---
+# FUNCTION: load_plugins
+# PURPOSE: Imports all plugins in plugins/ into the registry, so the first visualization doesn't wait for the import.
+# NOTES: A plugin that can't be imported is reported and skipped, it is imported again with its first visualization.
+#---
+def load_plugins():
+    package = importlib.import_module(PLUGIN_PACKAGE)
+    for module_info in pkgutil.iter_modules(package.__path__):
+        try:
+            get_plugin(module_info.name)
+        except Exception as e:
+            print('The plugin {} could not be loaded: {}'.format(module_info.name, e))
+
+
+
+#---
+# FUNCTION: get_plugin
+# PURPOSE: Returns the module of a plugin from the registry, importing it on first use (and reloading it if its file
+#          has changed and MICROMIX_PLUGIN_RELOAD is on).
+# NOTES: Only modules of the plugins package can be loaded. Raises a ValueError for other names.
+#---
+def get_plugin(name):
+    if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+        raise ValueError('Invalid plugin name {}.'.format(name))
+    entry = _plugins.get(name)
+    if entry != None and not PLUGIN_RELOAD:
+        return entry[0]
+    with _plugin_lock:
+        entry = _plugins.get(name)
+        if entry == None:
+            module = importlib.import_module('{}.{}'.format(PLUGIN_PACKAGE, name))
+        elif entry[1] != modification_time(entry[0]):
+            print('Reloading plugin {}'.format(name))
+            module = importlib.reload(entry[0])
+        else:
+            return entry[0]
+        if not hasattr(module, 'main'):
+            raise ValueError('The plugin {} has no main function.'.format(name))
+        _plugins[name] = (module, modification_time(module))
+        return module
+
+
+
+#---
+# FUNCTION: modification_time
+# PURPOSE: Returns the modification time of the file of a module (None if it has no file).
+#---
+def modification_time(module):
+    try:
+        return os.path.getmtime(module.__file__)
+    except (TypeError, OSError):
+        return None
+
+
+
+#---
+# FUNCTION: memo_key
+# PURPOSE: Returns the key under which the link of a visualization is remembered.
+# PARAMETERS:
+#   - plugin: A dictionary containing plugin details (name and ID).
+#   - fingerprint: The fingerprint of the visualized dataframe (see blob_store.blob_id_of).
+#   - db_entry_id: The session, only part of the key for plugins with LINK_PER_SESSION.
+#---
+def memo_key(plugin, fingerprint, db_entry_id):
+    key = '{}:{}:{}'.format(plugin['name'], plugin['_id'], fingerprint)
+    if getattr(get_plugin(plugin['name']), 'LINK_PER_SESSION', False):
+        key += ':{}'.format(db_entry_id)
+    return key
+
+
+
+#---
+# FUNCTION: find_link
+# PURPOSE: Returns the remembered visualization (plugin name, plugin ID and link) of a key, or None.
+#---
+def find_link(collection, key):
+    entry = collection.find_one({'_id': key})
+    if entry == None or entry['created'] < datetime.utcnow() - timedelta(seconds=PLUGIN_LINK_TTL):
+        return None
+    return entry['visualization']
+
+
+
+#---
+# FUNCTION: remember_link
+# PURPOSE: Remembers the visualization (plugin name, plugin ID and link) of a key.
+#---
+def remember_link(collection, key, visualization):
+    collection.replace_one({'_id': key}, {'_id': key, 'visualization': visualization, 'created': datetime.utcnow()}, upsert=True)
@@ -0,0 +1,75 @@
+// Uploads files above the size limit of a single request in chunks (see chunked_uploads.py of the backend).
+// The ID of an unfinished upload is kept in localStorage, so the upload of the same file continues with the next
+// missing chunk after a lost connection or a reload of the page.
+import axios from "axios";
+
+// Files above this size are uploaded in chunks (the backend accepts requests up to 16 MB)
+export const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 5; // Attempts per chunk before the upload is given up
+const RETRY_DELAY = 2000; // Milliseconds, doubled after each failed attempt
+
+function storage_key(file) {
+  return `micromix-upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+function wait(milliseconds) {
+  return new Promise(resolve => setTimeout(resolve, milliseconds));
+}
+
+// Returns the state of the unfinished upload of a file, or null if there is none
+async function find_upload(backend_url, file) {
+  const upload_id = localStorage.getItem(storage_key(file));
+  if (!upload_id) {
+    return null;
+  }
+  try {
+    const res = await axios.get(`${backend_url}/chunked_upload/${upload_id}`);
+    return res.data.status == "receiving" ? res.data : null;
+  } catch (error) {
+    localStorage.removeItem(storage_key(file));
+    return null;
+  }
+}
+
+// Sends one chunk, retrying after network errors. Returns the state of the upload.
+async function send_chunk(backend_url, upload, file, index) {
+  const start = index * upload.chunk_size;
+  const chunk = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const res = await axios.put(`${backend_url}/chunked_upload/${upload.upload_id}/${index}`, chunk, {
+        headers: { "Content-Type": "application/octet-stream" }
+      });
+      return res.data;
+    } catch (error) {
+      // The backend expects another chunk, continue with that one
+      if (error.response && error.response.status == 409 && error.response.data.received !== undefined) {
+        return error.response.data;
+      }
+      if ((error.response && error.response.status < 500) || attempt + 1 >= CHUNK_RETRIES) {
+        throw error;
+      }
+      await wait(RETRY_DELAY * 2 ** attempt);
+    }
+  }
+}
+
+// Uploads a file in chunks and returns the ID of the complete upload, which is then committed with the form
+// (POST /chunked_upload/<upload_id>/commit). on_progress is called with the percentage of the received bytes.
+export async function upload_in_chunks(backend_url, file, on_progress) {
+  let upload = await find_upload(backend_url, file);
+  if (upload == null) {
+    const data = new FormData();
+    data.append("filename", file.name);
+    data.append("size", file.size);
+    upload = (await axios.post(`${backend_url}/chunked_upload`, data)).data;
+    localStorage.setItem(storage_key(file), upload.upload_id);
+  }
+  while (upload.received < upload.chunks) {
+    on_progress(Math.round((upload.received_bytes * 100) / upload.size));
+    upload = await send_chunk(backend_url, upload, file, upload.received);
+  }
+  on_progress(100);
+  localStorage.removeItem(storage_key(file));
+  return upload.upload_id;
+}
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+#------------------------
+#
+# Script reports how the storage of the sessions is used
+#
+#------------------------
+
+#The report is computed by MongoDB with aggregation pipelines, so the sessions are never downloaded (MongoDB 4.4 or
+#newer is needed for $bsonSize). It lists:
+#  - The number and size distribution of the session documents and of the blobs (the dataframes, see
+#    Website/backend/blob_store.py). Sessions stored before the blob store keep their dataframes inline.
+#  - The number of matrices per session.
+#  - How much the blobs are shared: the bytes the sessions refer to, and the bytes that are really stored.
+#  - The fields children of locked sessions store although they are equal to those of their parent (see
+#    Website/backend/sessions.py), i.e. what deduplication could still save.
+#  - The sessions and blobs added per day.
+#  - The largest sessions.
+#For example:
+#  python MONGO_storage_report.py --days 60 --top 20
+#  python MONGO_storage_report.py --uri mongodb://localhost:27017/ --json > report.json
+
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+
+#The large fields a child session reads from its parent, as in Website/backend/sessions.py
+INHERITED_FIELDS = ('active_matrices', 'preview_matrices', 'transformed_dataframe', 'filtered_dataframe', 'merged_matrices', 'query')
+#The fields that can hold a dataframe (a blob reference, or the parquet bytes for older sessions)
+DATAFRAME_FIELDS = ('transformed_dataframe', 'filtered_dataframe')
+#Upper bounds of the size classes of the distributions
+SIZE_BOUNDARIES = [0, 1024, 16 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 1024 ** 4]
+BLOB_COLLECTION = 'blobs.files'
+
+
+def document_size():
+    #Size of the whole session document in BSON
+    return {'$bsonSize': '$$ROOT'}
+
+
+def matrices():
+    #The matrices of a session (active_matrices is a list of lists), an empty list if the session does not store them
+    return {'$reduce': {
+        'input': {'$cond': [{'$isArray': '$active_matrices'}, '$active_matrices', []]},
+        'initialValue': [],
+        'in': {'$concatArrays': ['$$value', {'$cond': [{'$isArray': '$$this'}, '$$this', []]}]},
+    }}
+
+
+def blob_references():
+    #The blob references of a session ({'blob_id': ..., 'size': ...}), of its dataframes and of its matrices
+    values = {'$concatArrays': [['$' + field for field in DATAFRAME_FIELDS],
+                                {'$map': {'input': matrices(), 'as': 'matrix', 'in': '$$matrix.dataframe'}}]}
+    return {'$filter': {'input': values, 'as': 'reference', 'cond': {'$eq': [{'$type': '$$reference.blob_id'}, 'string']}}}
+
+
+def inline_size():
+    #Bytes of the dataframes stored inside the session document (binary parquet data of older sessions)
+    return {'$add': [{'$cond': [{'$eq': [{'$type': '$' + field}, 'binData']}, {'$bsonSize': {'value': '$' + field}}, 0]}
+                     for field in DATAFRAME_FIELDS]}
+
+
+def size_distribution(collection, size, match=None):
+    #Number and bytes of the documents in each size class
+    pipeline = [{'$match': match}] if match else []
+    pipeline += [
+        {'$bucket': {'groupBy': size, 'boundaries': SIZE_BOUNDARIES, 'default': 'larger',
+                     'output': {'count': {'$sum': 1}, 'bytes': {'$sum': size}}}},
+    ]
+    buckets = list(collection.aggregate(pipeline, allowDiskUse=True))
+    for bucket in buckets:
+        if bucket['_id'] != 'larger':
+            bucket['_id'] = '< ' + format_bytes(SIZE_BOUNDARIES[SIZE_BOUNDARIES.index(bucket['_id']) + 1])
+    return buckets
+
+
+def summary(collection, size, match=None):
+    #Count, total, mean and largest size of the documents
+    pipeline = [{'$match': match}] if match else []
+    pipeline += [{'$group': {'_id': None, 'count': {'$sum': 1}, 'bytes': {'$sum': size}, 'mean': {'$avg': size}, 'max': {'$max': size}}}]
+    result = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return result[0] if result else {'_id': None, 'count': 0, 'bytes': 0, 'mean': 0, 'max': 0}
+
+
+def sessions_report(db):
+    #Documents, locked sessions, children and the bytes inside the session documents
+    result = list(db.visualizations.aggregate([
+        {'$group': {
+            '_id': None,
+            'count': {'$sum': 1},
+            'bytes': {'$sum': document_size()},
+            'mean': {'$avg': document_size()},
+            'max': {'$max': document_size()},
+            'locked': {'$sum': {'$cond': [{'$eq': ['$locked', True]}, 1, 0]}},
+            'children': {'$sum': {'$cond': [{'$eq': [{'$type': '$parent_id'}, 'objectId']}, 1, 0]}},
+            'inline_dataframe_bytes': {'$sum': inline_size()},
+        }},
+    ], allowDiskUse=True))
+    return result[0] if result else {'_id': None, 'count': 0, 'bytes': 0, 'mean': 0, 'max': 0, 'locked': 0, 'children': 0, 'inline_dataframe_bytes': 0}
+
+
+def matrices_report(db):
+    #Number of sessions by their number of matrices. Children that inherit their matrices are counted separately.
+    return list(db.visualizations.aggregate([
+        {'$project': {'matrices': {'$cond': [{'$isArray': '$active_matrices'}, {'$size': matrices()}, 'inherited']}}},
+        {'$group': {'_id': '$matrices', 'sessions': {'$sum': 1}}},
+        {'$sort': {'_id': 1}},
+    ], allowDiskUse=True))
+
+
+def sharing_report(db):
+    #Bytes the sessions refer to (a blob counted once per reference) compared to the bytes of the distinct blobs
+    result = list(db.visualizations.aggregate([
+        {'$project': {'references': blob_references()}},
+        {'$unwind': '$references'},
+        {'$group': {'_id': '$references.blob_id', 'size': {'$first': '$references.size'}, 'references': {'$sum': 1}}},
+        {'$group': {
+            '_id': None,
+            'blobs': {'$sum': 1},
+            'references': {'$sum': '$references'},
+            'referenced_bytes': {'$sum': {'$multiply': ['$size', '$references']}},
+            'distinct_bytes': {'$sum': '$size'},
+            'shared_blobs': {'$sum': {'$cond': [{'$gt': ['$references', 1]}, 1, 0]}},
+        }},
+    ], allowDiskUse=True))
+    return result[0] if result else {'_id': None, 'blobs': 0, 'references': 0, 'referenced_bytes': 0, 'distinct_bytes': 0, 'shared_blobs': 0}
+
+
+def duplication_report(db):
+    #Fields of child sessions that are equal to the field of their parent, and their size in the child document
+    #Children created by the current backend only store the fields that changed, copies made by older versions (without
+    #parent_id) cannot be found this way.
+    parent_fields = {field: True for field in INHERITED_FIELDS}
+    duplicated = {field: {'$cond': [
+        {'$and': [{'$ne': [{'$type': '$' + field}, 'missing']}, {'$eq': ['$' + field, {'$arrayElemAt': ['$parent.' + field, 0]}]}]},
+        {'$bsonSize': {'value': '$' + field}}, 0]} for field in INHERITED_FIELDS}
+    result = list(db.visualizations.aggregate([
+        {'$match': {'parent_id': {'$type': 'objectId'}}},
+        {'$lookup': {'from': db.visualizations.name, 'let': {'parent_id': '$parent_id'}, 'as': 'parent', 'pipeline': [
+            {'$match': {'$expr': {'$eq': ['$_id', '$$parent_id']}}},
+            {'$project': parent_fields},
+        ]}},
+        {'$project': duplicated},
+        {'$group': dict({'_id': None, 'children': {'$sum': 1}}, **{field: {'$sum': '$' + field} for field in INHERITED_FIELDS})},
+    ], allowDiskUse=True))
+    if not result:
+        return {'children': 0, 'bytes': 0, 'fields': {}}
+    fields = {field: result[0][field] for field in INHERITED_FIELDS if result[0][field] > 0}
+    return {'children': result[0]['children'], 'bytes': sum(fields.values()), 'fields': fields}
+
+
+def growth_report(db, days):
+    #Sessions and bytes added per day (the creation time is part of the ObjectId), and blobs stored per day
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    day = {'$dateToString': {'format': '%Y-%m-%d', 'date': {'$toDate': '$_id'}}}
+    growth = {entry['_id']: {'day': entry['_id'], 'sessions': entry['sessions'], 'session_bytes': entry['bytes'], 'blobs': 0, 'blob_bytes': 0}
+              for entry in db.visualizations.aggregate([
+                  {'$match': {'_id': {'$gte': ObjectId.from_datetime(start)}}},
+                  {'$group': {'_id': day, 'sessions': {'$sum': 1}, 'bytes': {'$sum': document_size()}}},
+              ], allowDiskUse=True)}
+    for entry in db[BLOB_COLLECTION].aggregate([
+        {'$match': {'uploadDate': {'$gte': start}}},
+        {'$group': {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$uploadDate'}}, 'blobs': {'$sum': 1}, 'bytes': {'$sum': '$length'}}},
+    ], allowDiskUse=True):
+        growth.setdefault(entry['_id'], {'day': entry['_id'], 'sessions': 0, 'session_bytes': 0})
+        growth[entry['_id']].update({'blobs': entry['blobs'], 'blob_bytes': entry['bytes']})
+    return [growth[day] for day in sorted(growth)]
+
+
+def largest_report(db, top):
+    #The sessions with the most bytes, in the document and in the blobs they refer to
+    largest = list(db.visualizations.aggregate([
+        {'$project': {
+            'locked': True,
+            'parent_id': True,
+            'document_bytes': document_size(),
+            'blob_bytes': {'$sum': {'$map': {'input': blob_references(), 'as': 'reference', 'in': '$$reference.size'}}},
+            'matrices': {'$cond': [{'$isArray': '$active_matrices'}, {'$size': matrices()}, None]},
+        }},
+        {'$addFields': {'bytes': {'$add': ['$document_bytes', '$blob_bytes']}}},
+        {'$sort': {'bytes': -1}},
+        {'$limit': top},
+    ], allowDiskUse=True))
+    for session in largest:
+        session['created'] = session['_id'].generation_time.strftime('%Y-%m-%d')
+        session['_id'] = str(session['_id'])
+        if session.get('parent_id') != None:
+            session['parent_id'] = str(session['parent_id'])
+    return largest
+
+
+def create_report(db, days, top):
+    #Collect all parts of the report
+    #The blobs are only known to MongoDB if they are stored in GridFS (MICROMIX_BLOB_STORE=gridfs, the default)
+    blob_size = '$length'
+    return {
+        'created': datetime.utcnow().isoformat(),
+        'sessions': sessions_report(db),
+        'session_sizes': size_distribution(db.visualizations, document_size()),
+        'blobs': summary(db[BLOB_COLLECTION], blob_size),
+        'blob_sizes': size_distribution(db[BLOB_COLLECTION], blob_size),
+        'matrices': matrices_report(db),
+        'sharing': sharing_report(db),
+        'duplication': duplication_report(db),
+        'growth': growth_report(db, days),
+        'largest': largest_report(db, top),
+    }
+
+
+def format_bytes(size):
+    #Print a number of bytes in the largest fitting unit
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def print_report(report):
+    sessions = report['sessions']
+    print('---Sessions---')
+    print('{} sessions, {} in total, {} on average, {} the largest'.format(
+        sessions['count'], format_bytes(sessions['bytes']), format_bytes(sessions['mean'] or 0), format_bytes(sessions['max'] or 0)))
+    print('{} locked, {} children of locked sessions, {} of dataframes stored inline (older sessions)'.format(
+        sessions['locked'], sessions['children'], format_bytes(sessions['inline_dataframe_bytes'])))
+    for bucket in report['session_sizes']:
+        print('  {:>10}: {:>8} sessions, {:>10}'.format(bucket['_id'], bucket['count'], format_bytes(bucket['bytes'])))
+
+    blobs = report['blobs']
+    print('\n---Blobs (GridFS)---')
+    print('{} blobs, {} in total, {} on average, {} the largest'.format(
+        blobs['count'], format_bytes(blobs['bytes']), format_bytes(blobs['mean'] or 0), format_bytes(blobs['max'] or 0)))
+    for bucket in report['blob_sizes']:
+        print('  {:>10}: {:>8} blobs, {:>10}'.format(bucket['_id'], bucket['count'], format_bytes(bucket['bytes'])))
+
+    print('\n---Matrices per session---')
+    for entry in report['matrices']:
+        print('  {:>10}: {:>8} sessions'.format(entry['_id'], entry['sessions']))
+
+    sharing = report['sharing']
+    print('\n---Shared blobs---')
+    print('{} references to {} distinct blobs ({} shared by several references)'.format(sharing['references'], sharing['blobs'], sharing['shared_blobs']))
+    print('{} referenced, {} stored, {} saved by sharing'.format(
+        format_bytes(sharing['referenced_bytes']), format_bytes(sharing['distinct_bytes']), format_bytes(sharing['referenced_bytes'] - sharing['distinct_bytes'])))
+
+    duplication = report['duplication']
+    print('\n---Fields children store although their parent has the same---')
+    print('{} children, {} duplicated'.format(duplication['children'], format_bytes(duplication['bytes'])))
+    for field, size in duplication['fields'].items():
+        print('  {:>22}: {:>10}'.format(field, format_bytes(size)))
+
+    print('\n---Growth per day---')
+    for entry in report['growth']:
+        print('  {}: {:>6} sessions {:>10}, {:>6} blobs {:>10}'.format(
+            entry['day'], entry['sessions'], format_bytes(entry['session_bytes']), entry['blobs'], format_bytes(entry['blob_bytes'])))
+
+    print('\n---Largest sessions---')
+    for session in report['largest']:
+        print('  {} (created {}{}): {} document, {} blobs, {} matrices'.format(
+            session['_id'], session['created'], ', locked' if session.get('locked') else '', format_bytes(session['document_bytes']),
+            format_bytes(session['blob_bytes']), 'inherited' if session['matrices'] == None else session['matrices']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reports how the storage of the Micromix sessions is used.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/', help='MongoDB server (default: mongodb://localhost:27017/)')
+    parser.add_argument('--database', default='micromix', help='Database name (default: micromix)')
+    parser.add_argument('--days', type=int, default=30, help='Days of the growth report (default: 30)')
+    parser.add_argument('--top', type=int, default=10, help='Number of largest sessions (default: 10)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    #Connect to MongoDB
+    client = MongoClient(args.uri)
+    db = client[args.database]
+    version = tuple(int(part) for part in client.server_info()['version'].split('.')[:2])
+    if version < (4, 4):
+        sys.exit('MongoDB 4.4 or newer is needed for the report ($bsonSize), the server runs ' + client.server_info()['version'])
+
+    report = create_report(db, args.days, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
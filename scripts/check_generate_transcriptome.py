@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks generate_transcriptome.py against Biopython (pip install biopython): the features of small fasta files are
+extracted with both and have to be equal. The fasta files have lines of the same width, lines of different widths (e.g.
+50/80/70/60 bases, which samtools faidx rejects), Windows line breaks and sequences on a single line. Each file is
+extracted twice, the second time with the .fai index of the first run, and once more after replacing the index with
+one that does not fit the file (e.g. written by an older version of the script).
+-----
+python check_generate_transcriptome.py
+-----
+Exits with 1 if any sequence differs.
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import generate_transcriptome
+from Bio import SeqIO
+
+#Line widths of the sequences of each fasta file, None for a single line
+FASTA_FILES = {
+    'even': ([60] * 20, [60] * 3, [70]),
+    'uneven': ([50, 80, 70, 60], [60, 60, 61, 60, 59], [10, 80] * 6),
+    'single_line': (None, None),
+}
+
+
+def write_fasta(fasta_file, line_widths, line_break):
+    #Write random sequences with the given line widths, return their lengths
+    lengths = []
+    with open(fasta_file, 'w', newline='') as fasta:
+        for number, widths in enumerate(line_widths):
+            widths = widths if widths != None else [random.randint(50, 500)]
+            sequence = ''.join(random.choice('ACGTN') for _ in range(sum(widths)))
+            fasta.write('>contig_{} description{}'.format(number, line_break))
+            position = 0
+            for width in widths:
+                fasta.write(sequence[position:position + width] + line_break)
+                position += width
+            lengths.append(len(sequence))
+    return lengths
+
+
+def write_gff(gff_file, lengths):
+    #Write features covering the start, the end, line breaks and the whole sequence, on both strands
+    with open(gff_file, 'w') as gff:
+        for number, length in enumerate(lengths):
+            positions = [(1, length), (1, 1), (length, length)] + [sorted(random.sample(range(1, length + 1), 2)) for _ in range(30)]
+            for feature, (start, end) in enumerate(positions):
+                strand = '+' if feature % 2 == 0 else '-'
+                gff.write('contig_{0}\tcheck\tgene\t{1}\t{2}\t.\t{3}\t.\tID=gene_{0}_{4}\n'.format(number, start, end, strand, feature))
+
+
+def expected_sequences(fasta_file, gff_file):
+    #Extract the features with Biopython, as generate_transcriptome.py did before the fasta files were indexed
+    sequences = SeqIO.to_dict(SeqIO.parse(fasta_file, 'fasta'))
+    expected = []
+    for line in open(gff_file):
+        d_list = line.rstrip('\n').split('\t')
+        sequence = sequences[d_list[0]].seq[int(d_list[3]) - 1:int(d_list[4])]
+        if d_list[6] == '-':
+            sequence = sequence.reverse_complement()
+        expected.append((d_list[8].split('=')[1], str(sequence)))
+    return expected
+
+
+def check(name, fasta_file, gff_file, output_file_name, threads):
+    #Extract the features and compare them with Biopython, return the number of differences
+    if os.path.exists(output_file_name):
+        os.remove(output_file_name)
+    generate_transcriptome.fasta_maps.clear()
+    generate_transcriptome.create_transcriptome([fasta_file], [gff_file], ['gene'], 'ID', output_file_name, threads)
+    extracted = [(record.id, str(record.seq)) for record in SeqIO.parse(output_file_name, 'fasta')]
+    expected = expected_sequences(fasta_file, gff_file)
+    differences = sum(1 for pair in zip(extracted, expected) if pair[0] != pair[1]) + abs(len(extracted) - len(expected))
+    print('{} {}'.format('ok  ' if differences == 0 else 'FAIL', name))
+    return differences
+
+
+def main():
+    random.seed(0)
+    folder = tempfile.mkdtemp(prefix='transcriptome-check-')
+    differences = 0
+    try:
+        for name, line_widths in FASTA_FILES.items():
+            for line_break in ('\n', '\r\n'):
+                label = name + (' (CRLF)' if line_break == '\r\n' else '')
+                fasta_file = os.path.join(folder, name + '.fa')
+                gff_file = os.path.join(folder, name + '.gff')
+                output_file_name = os.path.join(folder, name + '_genes.fa')
+                if os.path.exists(fasta_file + '.fai'):
+                    os.remove(fasta_file + '.fai')
+                write_gff(gff_file, write_fasta(fasta_file, line_widths, line_break))
+                differences += check(label, fasta_file, gff_file, output_file_name, 1)
+                differences += check(label + ', second run', fasta_file, gff_file, output_file_name, 2)
+                #An index that assumes the width of the first line for every line
+                with open(fasta_file + '.fai', 'w') as fai:
+                    for record in SeqIO.parse(fasta_file, 'fasta'):
+                        offset = open(fasta_file, 'rb').read().index(('>' + record.description).encode())
+                        offset += len(record.description) + 1 + len(line_break)
+                        fai.write('{}\t{}\t{}\t{}\t{}\n'.format(record.id, len(record), offset, 50, 50 + len(line_break)))
+                differences += check(label + ', index that does not fit', fasta_file, gff_file, output_file_name, 1)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print('{} differences'.format(differences))
+    if differences > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,66 +4,282 @@
 Created on Tue Apr 16 11:26:46 2019
 @author: B. Mika-Gospodorz and R. Hayward
 Input files: Fasta and GFF
-Output file: Fasta
-Description: Used to create a transcriptome fasta from user specified fields within a GFF file. 
+Output file: Fasta (optionally gzip or bgzip compressed)
+Description: Used to create a transcriptome fasta from user specified fields within a GFF file.
 -----
 For example, from the host, you can extract genes and gene IDs:
 -----
 python gff_to_fasta_transcriptome.py -fasta chr1.fa -gff chr1.gff -f gene -a gene_id -o chr1_genes.fa
 -----
-Or, transcripts and associated IDs:  
+Or, transcripts and associated IDs:
 -----
 python gff_to_fasta_transcriptome.py -fasta chr1.fa -gff chr1.gff -f transcript -a ID -o chr1_transcripts.fa
+-----
+Large genomes are not loaded into memory. Each fasta file is indexed once (a samtools-style .fai file next to it, reused
+on the next run) and memory-mapped, so only the sequences of the features are read. The features are extracted by
+several processes (-t), in batches of consecutive features of the same contig, and written in the order of the GFF
+file. An output file ending in .gz is gzip compressed, use --compress bgzip for a bgzip file (e.g. for samtools faidx).
+Sequences whose lines have different widths can't be described by a .fai index. The offsets of their lines are kept in
+memory instead, and the index of such a fasta file is not written.
 """
 
+import os
+import gzip
+import mmap
+import bisect
 import argparse
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+
+BATCH_FEATURES = 2000 #Features extracted by a process at once
+COUNT_CHUNK = 64 * 1024 * 1024 #Bytes of a sequence searched for line breaks at once
+WRITE_BUFFER = 16 * 1024 * 1024 #Bytes buffered before writing to the output file
+
+#Complement of the IUPAC nucleotide codes, as in Bio.Seq.reverse_complement
+COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHNSWacgturykmbvdhnsw', b'TGCAAYRMKVBHDNSWtgcaayrmkvbhdnsw')
+
+#Memory-mapped fasta files of a process, opened once per process (see open_fasta)
+fasta_maps = {}
+
+
+def index_fasta(fasta_file):
+    #Return the index of a fasta file: {name: (length, offset, line bases, line width, fasta file)}
+    #The index is read from <fasta_file>.fai if it is newer than the fasta file and fits it, otherwise the fasta file is
+    #scanned once and the index is written there (samtools faidx format). For a sequence with lines of different widths,
+    #line bases is 0 and line width holds the offsets of its lines (see index_record).
+    fai_file = fasta_file + '.fai'
+    index = {}
+    if os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        for line in open(fai_file):
+            name, length, offset, line_bases, line_width = line.split('\t')[:5]
+            index[name] = (int(length), int(offset), int(line_bases), int(line_width), fasta_file)
+        if fai_fits(fasta_file, index):
+            return index
+        print('The index ' + fai_file + ' does not fit the fasta file, it is created again')
+        index = {}
+
+    with open(fasta_file, 'rb') as fasta:
+        fasta_map = mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_file) > 0 else b''
+        position = 0 if fasta_map[:1] == b'>' else fasta_map.find(b'\n>') + 1
+        while position < len(fasta_map) and fasta_map[position:position + 1] == b'>':
+            header_end = fasta_map.find(b'\n', position)
+            offset = header_end + 1 if header_end >= 0 else len(fasta_map)
+            name = fasta_map[position + 1:offset].split()[0].decode()
+            next_header = fasta_map.find(b'\n>', offset - 1)
+            end = next_header + 1 if next_header >= 0 else len(fasta_map)
+            index[name] = index_record(fasta_map, offset, end) + (fasta_file,)
+            position = end
+        if isinstance(fasta_map, mmap.mmap):
+            fasta_map.close()
+    uneven = [name for name, entry in index.items() if entry[2] == 0]
+    if uneven:
+        print('The lines of ' + ', '.join(uneven[:5]) + (' and others' if len(uneven) > 5 else '') + ' in ' + fasta_file +
+              ' have different widths, the index ' + fai_file + ' is not written')
+        return index
+    try:
+        with open(fai_file, 'w') as fai:
+            for name, (length, offset, line_bases, line_width, _) in index.items():
+                fai.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, offset, line_bases, line_width))
+    except OSError: #e.g. a read-only folder, the index is only kept in memory
+        print('The index ' + fai_file + ' could not be written')
+    return index
+
 
-def create_transcriptome(fasta_records_dict, gff_files,feature, gene_attribute, output_file_name):
-    with open(output_file_name, 'a') as out_name: #Open output file
-        for gff_file in gff_files: 
-            for line in open(gff_file):
-                 if len(line.split()) == 0: #ignore blank lines
+def index_record(fasta_map, offset, end):
+    #Return (length, offset, line bases, line width) of the sequence between offset and end
+    #If all lines but the last have the same width (as samtools requires), the length follows from the size of the
+    #sequence. This holds if there is a line break at the end of every full line and nowhere else, which is checked
+    #without splitting the sequence into lines. Otherwise, line bases is 0 and line width is a tuple of the first base
+    #and the offset of every line, so fetch can still find the bases.
+    first_line_end = fasta_map.find(b'\n', offset, end)
+    if first_line_end < 0: #A single line without line break at the end of the file
+        return (len(fasta_map[offset:end].rstrip(b'\r')), offset, end - offset, end - offset)
+    line_width = first_line_end - offset + 1
+    line_bases = len(fasta_map[offset:first_line_end + 1].rstrip(b'\r\n'))
+    full_lines, rest = divmod(end - offset, line_width)
+    last_line = fasta_map[end - rest:end]
+    if line_bases > 0 and last_line.count(b'\n') <= 1 and (rest == 0 or last_line.strip()):
+        line_ends = fasta_map[offset + line_width - 1:offset + full_lines * line_width:line_width]
+        if line_ends.count(b'\n') == full_lines and count_line_breaks(fasta_map, offset, end) == full_lines + last_line.count(b'\n'):
+            return (full_lines * line_bases + len(last_line.rstrip(b'\r\n')), offset, line_bases, line_width)
+    first_bases, line_offsets = [], []
+    length, line_offset = 0, offset
+    for line in fasta_map[offset:end].split(b'\n'):
+        first_bases.append(length)
+        line_offsets.append(line_offset)
+        length += len(line.rstrip(b'\r'))
+        line_offset += len(line) + 1
+    return (length, offset, 0, (tuple(first_bases), tuple(line_offsets)))
+
+
+def count_line_breaks(fasta_map, start, end):
+    #Count the line breaks between start and end, a chunk at a time so large sequences are not copied at once
+    return sum(fasta_map[chunk:min(chunk + COUNT_CHUNK, end)].count(b'\n') for chunk in range(start, end, COUNT_CHUNK))
+
+
+def fai_fits(fasta_file, index):
+    #Check that an index read from a .fai file describes the fasta file: every sequence has to start after a line break,
+    #have a line break at the end of every full line and nowhere else, and end with its last base. An index written by
+    #an older version of this script for lines of different widths, or of an edited fasta file, is created again instead
+    #of extracting the wrong bases.
+    if os.path.getsize(fasta_file) == 0:
+        return len(index) == 0
+    with open(fasta_file, 'rb') as fasta:
+        fasta_map = mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for length, offset, line_bases, line_width, _ in index.values():
+                if length == 0:
                     continue
-                 d = line.rstrip()  #remove '\n'
-                 if ((d[0] != '#') and (d != '') and (d != ' ')): #Ignore comments
-                    d_list = d.split('\t') #Split based on tabs
-                    if d_list[2] in feature: 
-                        reference_name = d_list[0]
-                        split_8 = d_list[8].split(';') #Further split based on ;
-                        #print(split_8)
-                        #find index of id of interest
-                        index_feature = [split_8.index(el) for el in split_8 if gene_attribute in el]
-                        description = [s.split("=")[1] for s in split_8]
-                        #re-order ids from column 8
-                        if not index_feature:
-                            print('lack of ' + gene_attribute + ' attribute for record:' + split_8[0].split('=')[1] )
-                        else: 
-                            out_name.write('>' + description[index_feature[0]] + '\n')
-                            #Determine sequence based on direction
-                            if d_list[6] == '+' :
-                                out_name.write(str(fasta_records_dict[reference_name].seq[int(d_list[3])-1:int(d_list[4])]) + '\n') 
-                            elif d_list[6] == '-' :
-                                out_name.write(str(fasta_records_dict[reference_name].seq[int(d_list[3])-1:int(d_list[4])].reverse_complement()) + '\n') 
-                        
-
-#Script arguments and descriptions                         
-parser = argparse.ArgumentParser()
-parser.add_argument("-fasta",nargs='+',help="genome fasta file")
-parser.add_argument("-gff", nargs='+', help="gff file")
-parser.add_argument("-f", "--gene_feature", nargs='+', help="gene feature defined in the 3rd column of the gff file")
-parser.add_argument("-a", "--gene_attribute", help="gene attribute")
-parser.add_argument("-o", help="output file name")
-
-#Parse params
-args = parser.parse_args()
-
-#Format features when multiple options are parsed 
-gene_features = [feature.replace('[' , '').replace(']','').replace(',','') for feature in args.gene_feature ]
-#Create empty dict.
-fasta_records_dict = dict()
-#Add fasta into dict.
-for fasta_file in args.fasta:
-        fasta_records_dict.update(SeqIO.to_dict(SeqIO.parse(fasta_file, 'fasta')))
-#pass fasta, features and attributes to function
-create_transcriptome(fasta_records_dict, args.gff, gene_features, args.gene_attribute, args.o)
+                if line_bases <= 0 or line_width < line_bases or fasta_map[offset - 1:offset] != b'\n':
+                    return False
+                full_lines = (length - 1) // line_bases
+                last = offset + full_lines * line_width + (length - 1) % line_bases
+                if fasta_map[last:last + 1] in (b'', b'\n', b'\r', b'>'):
+                    return False
+                line_ends = fasta_map[offset + line_width - 1:offset + full_lines * line_width:line_width]
+                if line_ends.count(b'\n') != full_lines or count_line_breaks(fasta_map, offset, last + 1) != full_lines:
+                    return False
+                #After the last base, only the line break and the next header (or blank lines) may follow
+                next_line = fasta_map.find(b'\n', last)
+                if fasta_map[last + 1:next_line if next_line >= 0 else len(fasta_map)].strip(b'\r'):
+                    return False
+                if next_line >= 0 and fasta_map[next_line + 1:next_line + 2] not in (b'', b'>', b'\n', b'\r'):
+                    return False
+        finally:
+            fasta_map.close()
+    return True
+
+
+def open_fasta(fasta_file):
+    #Return the memory map of a fasta file, opened once per process
+    if fasta_file not in fasta_maps:
+        with open(fasta_file, 'rb') as fasta:
+            fasta_maps[fasta_file] = mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ)
+    return fasta_maps[fasta_file]
+
+
+def fetch(entry, start, end):
+    #Return the bases start..end (1-based, inclusive, as in GFF) of a contig, without line breaks
+    length, offset, line_bases, line_width, fasta_file = entry
+    start, end = max(start - 1, 0), min(end, length)
+    if start >= end:
+        return b''
+    fasta = open_fasta(fasta_file)
+    if line_bases == 0: #Lines of different widths, find the lines of the first and the last base
+        first_bases, line_offsets = line_width
+        first_line = bisect.bisect_right(first_bases, start) - 1
+        last_line = bisect.bisect_right(first_bases, end - 1) - 1
+        first = line_offsets[first_line] + start - first_bases[first_line]
+        last = line_offsets[last_line] + end - 1 - first_bases[last_line]
+    else:
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+    return fasta[first:last + 1].replace(b'\n', b'').replace(b'\r', b'')
+
+
+def parse_gff(gff_files, features, gene_attribute):
+    #Read the features of the GFF files in a single pass
+    #Returns a list of (contig, start, end, strand, name), in the order of the files
+    records = []
+    for gff_file in gff_files:
+        for line in open(gff_file):
+            if line.startswith('##FASTA'): #Sequences appended to the GFF file
+                break
+            if line[0] == '#' or line.isspace(): #Ignore comments and blank lines
+                continue
+            d_list = line.rstrip('\r\n').split('\t', 8) #Split based on tabs
+            if len(d_list) < 9 or d_list[2] not in features:
+                continue
+            #Find the first attribute of column 8 that contains the attribute of interest
+            name = None
+            for attribute in d_list[8].split(';'):
+                if gene_attribute in attribute:
+                    name = attribute.split('=')[1]
+                    break
+            if name == None:
+                print('lack of ' + gene_attribute + ' attribute for record:' + d_list[8].split(';')[0].split('=')[-1])
+            elif d_list[6] not in ('+', '-'):
+                print('lack of strand for record:' + name)
+            else:
+                records.append((d_list[0], int(d_list[3]), int(d_list[4]), d_list[6], name))
+    return records
+
+
+def extract_batch(entry, batch):
+    #Return the fasta entries of a batch of features of one contig (entry: its index) as bytes
+    output = []
+    for reference_name, start, end, strand, name in batch:
+        sequence = fetch(entry, start, end)
+        #Determine sequence based on direction
+        if strand == '-':
+            sequence = sequence.translate(COMPLEMENT)[::-1]
+        output.append(b'>' + name.encode() + b'\n' + sequence + b'\n')
+    return b''.join(output)
+
+
+def make_batches(records):
+    #Split the features into batches of up to BATCH_FEATURES consecutive features of the same contig
+    batches = []
+    for record in records:
+        if len(batches) == 0 or batches[-1][0][0] != record[0] or len(batches[-1]) == BATCH_FEATURES:
+            batches.append([])
+        batches[-1].append(record)
+    return batches
+
+
+def open_output(output_file_name, compress):
+    #Open the output file for appending, compressed with gzip or bgzip if requested
+    if compress == 'auto':
+        compress = 'gzip' if output_file_name.endswith('.gz') else 'none'
+    if compress == 'bgzip':
+        from Bio import bgzf
+        return bgzf.BgzfWriter(output_file_name, 'ab')
+    if compress == 'gzip':
+        return gzip.open(output_file_name, 'ab')
+    return open(output_file_name, 'ab', buffering=WRITE_BUFFER)
+
+
+def create_transcriptome(fasta_files, gff_files, feature, gene_attribute, output_file_name, threads=1, compress='auto'):
+    index = {}
+    for fasta_file in fasta_files:
+        index.update(index_fasta(fasta_file))
+    records = parse_gff(gff_files, set(feature), gene_attribute)
+    missing = sorted(set(record[0] for record in records) - set(index))
+    if missing:
+        raise SystemExit('Sequences missing from the fasta files: ' + ', '.join(missing))
+
+    batches = make_batches(records)
+    with open_output(output_file_name, compress) as out_name: #Open output file
+        if threads <= 1 or len(batches) <= 1:
+            for batch in batches:
+                out_name.write(extract_batch(index[batch[0][0]], batch))
+        else:
+            #Keep a few batches per process in flight, so the memory used for the results stays small
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                pending = []
+                for batch in batches:
+                    pending.append(executor.submit(extract_batch, index[batch[0][0]], batch))
+                    if len(pending) >= 2 * threads:
+                        out_name.write(pending.pop(0).result())
+                for future in pending:
+                    out_name.write(future.result())
+    print('{} sequences written to {}'.format(len(records), output_file_name))
+
+
+if __name__ == '__main__':
+    #Script arguments and descriptions
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-fasta",nargs='+',help="genome fasta file")
+    parser.add_argument("-gff", nargs='+', help="gff file")
+    parser.add_argument("-f", "--gene_feature", nargs='+', help="gene feature defined in the 3rd column of the gff file")
+    parser.add_argument("-a", "--gene_attribute", help="gene attribute")
+    parser.add_argument("-o", help="output file name")
+    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count() or 1, help="processes extracting the sequences (default: all cores)")
+    parser.add_argument("--compress", choices=['auto', 'none', 'gzip', 'bgzip'], default='auto', help="compression of the output file (default: gzip if it ends in .gz)")
+
+    #Parse params
+    args = parser.parse_args()
+
+    #Format features when multiple options are parsed
+    gene_features = [feature.replace('[' , '').replace(']','').replace(',','') for feature in args.gene_feature ]
+    #pass fasta, features and attributes to function
+    create_transcriptome(args.fasta, args.gff, gene_features, args.gene_attribute, args.o, args.threads, args.compress)